@@ -262,12 +262,7 @@ class GDNet_dc6(nn.Module):
 
     def forward(self, x, y):
         if self.flip:
-            flip_x = x.data.cpu().numpy()
-            flip_y = y.data.cpu().numpy()
-            flip_x = torch.tensor(flip_x[..., ::-1].copy()).cuda()
-            flip_y = torch.tensor(flip_y[..., ::-1].copy()).cuda()
-            x = flip_y
-            y = flip_x
+            x, y = flip_stereo(x, y)
 
         g = self.conv_start(x)  # 32, H, W
         x = self.feature(x)
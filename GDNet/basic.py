@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from GDNet.function import checkpoint_module
 
 class BasicConv(nn.Module):
 
@@ -34,6 +35,8 @@ class Conv2x(nn.Module):
     def __init__(self, in_channels, out_channels, deconv=False, is_3d=False, concat=True, bn=True, relu=True):
         super(Conv2x, self).__init__()
         self.concat = concat
+        self.is_3d = is_3d
+        self.checkpoint = False
 
         if deconv and is_3d:
             # kernel = (3, 4, 4)
@@ -53,6 +56,11 @@ class Conv2x(nn.Module):
                                    padding=1)
 
     def forward(self, x, rem):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_module(self, self._forward, x, rem)
+        return self._forward(x, rem)
+
+    def _forward(self, x, rem):
         x = self.conv1(x)
         assert (x.size() == rem.size())
         if self.concat:
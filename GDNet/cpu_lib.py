@@ -0,0 +1,430 @@
+import torch
+import torch.nn.functional as F
+
+# CPU counterpart of gdnet_lib (GDNet/extensions/cuda_kernel.cu).
+# Every cpu_* function takes the same arguments as its cuda_* twin and fills the output tensors in place.
+# Scanlines of one direction are independent, so every step of a sweep updates a whole wavefront
+# (batch, channel, disparity and the orthogonal image axis) with tensor ops, which run on torch's
+# intra-op thread pool (see torch.set_num_threads).
+
+# (swept axis of cost, reverse)
+# cost: batch, channel, disparity, height, width
+SGA_DIRECTIONS = [
+    (4, False),  # left to right
+    (4, True),  # right to left
+    (3, False),  # up to down
+    (3, True),  # down to up
+]
+
+
+def _to_front(t, axis):
+    dims = list(range(t.dim()))
+    dims.insert(0, dims.pop(axis))
+    return t.permute(dims)
+
+
+def _from_front(t, axis):
+    dims = list(range(1, t.dim()))
+    dims.insert(axis, 0)
+    return t.permute(dims)
+
+
+def _steps(size, reverse):
+    return list(range(size - 1, -1, -1)) if reverse else list(range(size))
+
+
+def cpu_sga_forward(cost, cost_aggregation, weight, max_index):
+    for direction, (axis, reverse) in enumerate(SGA_DIRECTIONS):
+        c = _to_front(cost, axis).contiguous()  # shift, batch, channel, disparity, base
+        w = _to_front(weight[:, :, direction], axis).contiguous()  # shift, batch, channel, 5, base
+        agg = torch.empty_like(c)
+        index = torch.empty((c.size(0), c.size(1), c.size(2), c.size(4)), dtype=torch.long)
+
+        pre = None
+        for s in _steps(c.size(0), reverse):
+            ws = w[s].unsqueeze(3)
+            x = c[s] * ws[:, :, 0]
+            if pre is not None:
+                p = agg[pre]
+                x = x + p * ws[:, :, 1] + p.gather(2, index[pre].unsqueeze(2)) * ws[:, :, 4]
+                x[:, :, 1:] += p[:, :, :-1] * ws[:, :, 2]
+                x[:, :, :-1] += p[:, :, 1:] * ws[:, :, 3]
+            agg[s] = x
+            index[s] = x.argmax(dim=2)
+            pre = s
+
+        cost_aggregation[:, :, direction] = _from_front(agg, axis)
+        max_index[:, :, direction] = _from_front(index, axis - 1)
+
+
+def cpu_sga_backward(cost, cost_aggregation, weight, max_index,
+                     cost_gradient, weight_gradient, grad_output, grad_aggregation):
+    # grad_aggregation is scratch memory of the CUDA kernel, the CPU sweep only carries one wavefront
+    for direction, (axis, reverse) in enumerate(SGA_DIRECTIONS):
+        c = _to_front(cost, axis).contiguous()
+        w = _to_front(weight[:, :, direction], axis).contiguous()
+        agg = _to_front(cost_aggregation[:, :, direction], axis).contiguous()
+        index = _to_front(max_index[:, :, direction], axis - 1).long()
+        grad = _to_front(grad_output[:, :, direction], axis).contiguous()
+        cost_grad = torch.empty_like(c)
+        weight_grad = torch.zeros_like(w)
+
+        steps = _steps(c.size(0), reverse)
+        carry = torch.zeros_like(c[0])
+        for i in range(len(steps) - 1, -1, -1):
+            s = steps[i]
+            ws = w[s].unsqueeze(3)
+            total = grad[s] + carry
+            cost_grad[s] = total * ws[:, :, 0]
+            weight_grad[s, :, :, 0] = (total * c[s]).sum(2)
+
+            if i == 0:
+                break
+
+            pre = steps[i - 1]
+            p = agg[pre]
+            p_index = index[pre].unsqueeze(2)
+
+            carry = total * ws[:, :, 1]
+            carry[:, :, :-1] += total[:, :, 1:] * ws[:, :, 2]
+            carry[:, :, 1:] += total[:, :, :-1] * ws[:, :, 3]
+            carry.scatter_add_(2, p_index, (total * ws[:, :, 4]).sum(2, keepdim=True))
+
+            weight_grad[s, :, :, 1] = (total * p).sum(2)
+            weight_grad[s, :, :, 2] = (total[:, :, 1:] * p[:, :, :-1]).sum(2)
+            weight_grad[s, :, :, 3] = (total[:, :, :-1] * p[:, :, 1:]).sum(2)
+            weight_grad[s, :, :, 4] = total.sum(2) * p.gather(2, p_index).squeeze(2)
+
+        cost_gradient += _from_front(cost_grad, axis)
+        weight_gradient[:, :, direction] = _from_front(weight_grad, axis)
+
+
+def cpu_lga_forward(cost, output_cost, weight):
+    batch, max_disparity, height, width = cost.size()
+    kernel_size = weight.size(2)
+    mid = kernel_size // 2
+
+    # zero padding replaces the bound checks of lga_kernel_forward
+    padded = F.pad(cost, (mid, mid, mid, mid, 1, 1))
+
+    for kr in range(kernel_size):
+        for kc in range(kernel_size):
+            window = padded[:, :, kr:kr + height, kc:kc + width]
+            w = weight[:, :, kr, kc].unsqueeze(2)  # batch, 3, 1, height, width
+            output_cost += window[:, 1:max_disparity + 1] * w[:, 0]
+            output_cost += window[:, :max_disparity] * w[:, 1]
+            output_cost += window[:, 2:] * w[:, 2]
+
+
+def cpu_lga_backward(cost, weight, cost_gradient, weight_gradient, grad_output):
+    batch, max_disparity, height, width = cost.size()
+    kernel_size = weight.size(2)
+    mid = kernel_size // 2
+
+    padded = F.pad(cost, (mid, mid, mid, mid, 1, 1))
+    padded_grad = torch.zeros_like(padded)
+
+    for kr in range(kernel_size):
+        for kc in range(kernel_size):
+            window = padded[:, :, kr:kr + height, kc:kc + width]
+            w = weight[:, :, kr, kc].unsqueeze(2)
+            weight_gradient[:, 0, kr, kc] += (grad_output * window[:, 1:max_disparity + 1]).sum(1)
+            weight_gradient[:, 1, kr, kc] += (grad_output * window[:, :max_disparity]).sum(1)
+            weight_gradient[:, 2, kr, kc] += (grad_output * window[:, 2:]).sum(1)
+
+            grad_window = padded_grad[:, :, kr:kr + height, kc:kc + width]
+            grad_window[:, 1:max_disparity + 1] += grad_output * w[:, 0]
+            grad_window[:, :max_disparity] += grad_output * w[:, 1]
+            grad_window[:, 2:] += grad_output * w[:, 2]
+
+    cost_gradient += padded_grad[:, 1:max_disparity + 1, mid:mid + height, mid:mid + width]
+
+
+# guided diffusion, (swept axis of cost, reverse)
+GD_DIRECTIONS = [
+    (4, False),  # left to right
+    (4, True),  # right to left
+    (3, False),  # up to down
+    (3, True),  # down to up
+    (2, True),  # top to bottom (disparity max_disparity - 1 to 0)
+    (2, False),  # bottom to top (disparity 0 to max_disparity - 1)
+]
+
+
+def _gd_weight(g0, filter, axis):
+    # g0: batch, channel, height, width
+    # filter: batch, channel, k1, k2, height, width
+    # return g0 as (shift, batch, channel, 1, base) and filter as (shift, batch, channel, 1, base, k1, k2),
+    # or with a single shift of full (height, width) planes when the sweep runs along disparity
+    if axis == 2:
+        return g0.unsqueeze(0), filter.permute(0, 1, 4, 5, 2, 3).unsqueeze(0)
+    g0 = _to_front(g0, axis - 1).unsqueeze(3)
+    filter = _to_front(filter, axis + 1).permute(0, 1, 2, 5, 3, 4).unsqueeze(3)
+    return g0, filter
+
+
+def _gd_neighbour(agg, kernel_size):
+    # agg: batch, channel, p, q -> batch, channel, p, q, k1, k2 with zeros outside
+    mid = kernel_size // 2
+    return F.pad(agg, (mid, mid, mid, mid)).unfold(2, kernel_size, 1).unfold(3, kernel_size, 1)
+
+
+def _gd_neighbour_backward(grad, kernel_size):
+    # adjoint of _gd_neighbour, grad: batch, channel, p, q, k1, k2 -> batch, channel, p, q
+    batch, channels, p, q = grad.size()[:4]
+    mid = kernel_size // 2
+    grad = grad.permute(0, 1, 4, 5, 2, 3).reshape(batch, channels * kernel_size ** 2, p * q)
+    grad = F.fold(grad, (p + 2 * mid, q + 2 * mid), kernel_size)
+    return grad[:, :, mid:mid + p, mid:mid + q]
+
+
+def _gd_forward(cost, cost_agg, g0, filter, directions):
+    kernel_size = filter.size(3)
+    for direction, (axis, reverse) in enumerate(directions):
+        c = _to_front(cost, axis).contiguous()  # shift, batch, channel, p, q
+        g, f = _gd_weight(g0[:, :, direction], filter[:, :, direction], axis)
+        agg = torch.empty_like(c)
+
+        pre = None
+        for s in _steps(c.size(0), reverse):
+            i = s if g.size(0) > 1 else 0
+            x = c[s] * g[i]
+            if pre is not None:
+                x += (_gd_neighbour(agg[pre], kernel_size) * f[i]).sum((4, 5))
+            agg[s] = x
+            pre = s
+
+        cost_agg[:, :, direction] = _from_front(agg, axis)
+
+
+def _gd_backward(cost, cost_agg, g0, filter, cost_gradient, g0_gradient, filter_gradient, grad_output,
+                 directions):
+    kernel_size = filter.size(3)
+    for direction, (axis, reverse) in enumerate(directions):
+        c = _to_front(cost, axis).contiguous()
+        g, f = _gd_weight(g0[:, :, direction], filter[:, :, direction], axis)
+        agg = _to_front(cost_agg[:, :, direction], axis).contiguous()
+        grad = _to_front(grad_output[:, :, direction], axis).contiguous()
+        cost_grad = torch.empty_like(c)
+        g_grad = torch.zeros_like(g)
+        f_grad = torch.zeros_like(f)
+        sweep = g.size(0) == 1  # weights are shared by every step of a disparity sweep
+
+        steps = _steps(c.size(0), reverse)
+        carry = torch.zeros_like(c[0])
+        for n in range(len(steps) - 1, -1, -1):
+            s = steps[n]
+            i = 0 if sweep else s
+            total = grad[s] + carry
+            cost_grad[s] = total * g[i]
+            if sweep:
+                g_grad[0] += total * c[s]
+            else:
+                g_grad[s] = (total * c[s]).sum(2, keepdim=True)
+
+            if n == 0:
+                break
+
+            pre = steps[n - 1]
+            neighbour = _gd_neighbour(agg[pre], kernel_size)
+            t = total.unsqueeze(4).unsqueeze(5)
+            carry = _gd_neighbour_backward(t * f[i], kernel_size)
+            if sweep:
+                f_grad[0] += t * neighbour
+            else:
+                f_grad[s] = (t * neighbour).sum(2, keepdim=True)
+
+        cost_gradient += _from_front(cost_grad, axis)
+        if sweep:
+            g0_gradient[:, :, direction] = g_grad[0]
+            filter_gradient[:, :, direction] = f_grad[0].permute(0, 1, 4, 5, 2, 3)
+        else:
+            g0_gradient[:, :, direction] = _from_front(g_grad.squeeze(3), axis - 1)
+            filter_gradient[:, :, direction] = _from_front(f_grad.squeeze(3).permute(0, 1, 2, 4, 5, 3), axis + 1)
+
+
+def cpu_df4_forward(cost, cost_agg, g0, filter):
+    _gd_forward(cost, cost_agg, g0, filter, GD_DIRECTIONS[:4])
+
+
+def cpu_df4_backward(cost, cost_agg, g0, filter,
+                     cost_gradient, g0_gradient, filter_gradient, grad_aggregation, grad_output):
+    _gd_backward(cost, cost_agg, g0, filter, cost_gradient, g0_gradient, filter_gradient, grad_output,
+                 GD_DIRECTIONS[:4])
+
+
+def cpu_df6_forward(cost, cost_agg, g0, filter):
+    _gd_forward(cost, cost_agg, g0, filter, GD_DIRECTIONS)
+
+
+def cpu_df6_backward(cost, cost_agg, g0, filter,
+                     cost_gradient, g0_gradient, filter_gradient, grad_aggregation, grad_output):
+    _gd_backward(cost, cost_agg, g0, filter, cost_gradient, g0_gradient, filter_gradient, grad_output,
+                 GD_DIRECTIONS)
+
+
+# cost_type of calc_cost
+COST_SAD, COST_CENSUS_AVG, COST_CENSUS_FIX, COST_NCC = range(4)
+
+
+def _shift(x, disparity):
+    # x[..., col - disparity] at col, zeros where col - disparity is outside the image
+    width = x.size(-1)
+    out = torch.zeros_like(x)
+    if disparity >= 0:
+        out[..., disparity:] = x[..., :width - disparity]
+    else:
+        out[..., :width + disparity] = x[..., -disparity:]
+    return out
+
+
+def _column_mask(x, disparity):
+    # 1 at the columns whose match col - disparity is inside the image
+    height, width = x.size()[-2:]
+    mask = torch.zeros((1, 1, height, width), dtype=torch.float64)
+    mask[..., max(disparity, 0):width + min(disparity, 0)] = 1
+    return mask
+
+
+def _box_sum(x, kernel_size):
+    # window sums with zeros outside the image from an integral image, O(1) per pixel for any kernel_size
+    mid = kernel_size // 2
+    height, width = x.size()[-2:]
+    s = F.pad(x.double(), (mid + 1, mid, mid + 1, mid)).cumsum(-2).cumsum(-1)
+    return (s[..., kernel_size:, kernel_size:] - s[..., :height, kernel_size:]
+            - s[..., kernel_size:, :width] + s[..., :height, :width])
+
+
+def _census(image, kernel_size, average):
+    # bit k of channel c: window pixel k > center (or window average), plus the bits of the window pixels inside
+    # the image, one int64 word per channel, so kernel_size ** 2 <= 63
+    assert kernel_size ** 2 <= 63, 'census needs kernel_size <= 7'
+    batch, channels, height, width = image.size()
+    mid = kernel_size // 2
+    if average:
+        center = _box_sum(image, kernel_size) / _box_sum(torch.ones((1, 1, height, width)), kernel_size)
+    else:
+        center = image.double()
+
+    padded = F.pad(image.double(), (mid, mid, mid, mid))
+    inside = F.pad(torch.ones((1, 1, height, width), dtype=torch.bool), (mid, mid, mid, mid))
+    bits = torch.zeros(image.size(), dtype=torch.long)
+    valid = torch.zeros((1, 1, height, width), dtype=torch.long)
+    for k in range(kernel_size ** 2):
+        i, j = divmod(k, kernel_size)
+        window = padded[:, :, i:i + height, j:j + width]
+        bits |= (window > center).long() << k
+        valid |= inside[:, :, i:i + height, j:j + width].long() << k
+    return bits, valid
+
+
+def _popcount(x):
+    # bit count of non-negative int64
+    x = x - ((x >> 1) & 0x5555555555555555)
+    x = (x & 0x3333333333333333) + ((x >> 2) & 0x3333333333333333)
+    x = (x + (x >> 4)) & 0x0f0f0f0f0f0f0f0f
+    x = x + (x >> 8)
+    x = x + (x >> 16)
+    x = x + (x >> 32)
+    return x & 0x7f
+
+
+def _ncc(left_image, right, mask, kernel_size):
+    # means and (co)variances over the window pixels whose match is inside the right image
+    left = left_image.double() * mask
+    right = right.double()
+    n = _box_sum(mask, kernel_size).clamp(min=1)
+    sum_l, sum_r = _box_sum(left, kernel_size), _box_sum(right, kernel_size)
+    cov = _box_sum(left * right, kernel_size) - sum_l * sum_r / n
+    var_l = (_box_sum(left * left, kernel_size) - sum_l * sum_l / n).clamp(min=0)
+    var_r = (_box_sum(right * right, kernel_size) - sum_r * sum_r / n).clamp(min=0)
+    std = var_l.sqrt() * var_r.sqrt()
+    # a flat window has no correlation, the tolerance absorbs the rounding of the integral image
+    r = torch.where(std > 1e-9, cov / std.clamp(min=1e-9), torch.zeros_like(std))
+    return -r.mean(1)
+
+
+def cpu_calc_cost(left_image, right_image, cost, kernel_size, min_disparity, cost_type):
+    # census bits are computed once per image and matched with xor and popcount, SAD and NCC window sums come
+    # from integral images, so the cost of a (pixel, disparity) does not depend on kernel_size.
+    # CENSUS_AVG averages over every window pixel inside its own image, the kernel over the window pixels inside
+    # both images, which only differs at the columns where the window crosses the border of the other image
+    if cost_type in [COST_CENSUS_AVG, COST_CENSUS_FIX]:
+        average = cost_type == COST_CENSUS_AVG
+        bits_l, valid_l = _census(left_image, kernel_size, average)
+        bits_r, valid_r = _census(right_image, kernel_size, average)
+
+    for i in range(cost.size(1)):
+        disparity = i + min_disparity
+        mask = _column_mask(left_image, disparity)
+
+        if cost_type == COST_SAD:
+            diff = (left_image - _shift(right_image, disparity)).abs().sum(1, keepdim=True)
+            c = _box_sum(diff * mask, kernel_size)[:, 0]
+
+        elif cost_type in [COST_CENSUS_AVG, COST_CENSUS_FIX]:
+            valid = valid_l & _shift(valid_r, disparity)
+            c = _popcount((bits_l ^ _shift(bits_r, disparity)) & valid).sum(1)
+
+        elif cost_type == COST_NCC:
+            c = _ncc(left_image, _shift(right_image, disparity), mask, kernel_size)
+
+        else:
+            raise Exception('Unknown cost type: ' + str(cost_type))
+
+        cost[:, i] = c.to(cost.dtype) * mask[:, 0]
+
+
+# (row_offset, col_offset) of SGM_D0 ... SGM_D7 in GDNet/extensions/direction.h
+SGM_DIRECTIONS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+
+def _sgm_step(c, pre, p1, p2):
+    # c, pre: batch, disparity, base
+    min_pre = pre.min(dim=1, keepdim=True)[0]
+    best = torch.minimum(pre, min_pre + p2)
+    best[:, 1:] = torch.minimum(best[:, 1:], pre[:, :-1] + p1)
+    best[:, :-1] = torch.minimum(best[:, :-1], pre[:, 1:] + p1)
+    return c + best - min_pre
+
+
+def cpu_sgm_direction(cost, direction, p1, p2):
+    # columns are swept for the horizontal and diagonal paths, a diagonal step also moves one row,
+    # the pixels without a predecessor inside the image start a path with their own cost
+    row_offset, col_offset = SGM_DIRECTIONS[direction]
+    axis, reverse = (2, row_offset < 0) if col_offset == 0 else (3, col_offset < 0)
+    shift = row_offset if col_offset != 0 else 0
+
+    c = _to_front(cost, axis).contiguous()  # shift, batch, disparity, base
+    agg = torch.empty_like(c)
+
+    pre = None
+    for s in _steps(c.size(0), reverse):
+        if pre is None:
+            agg[s] = c[s]
+        elif shift == 0:
+            agg[s] = _sgm_step(c[s], agg[pre], p1, p2)
+        elif shift > 0:
+            agg[s, :, :, 0] = c[s, :, :, 0]
+            agg[s, :, :, 1:] = _sgm_step(c[s, :, :, 1:], agg[pre, :, :, :-1], p1, p2)
+        else:
+            agg[s, :, :, -1] = c[s, :, :, -1]
+            agg[s, :, :, :-1] = _sgm_step(c[s, :, :, :-1], agg[pre, :, :, 1:], p1, p2)
+        pre = s
+
+    return _from_front(agg, axis)
+
+
+def cpu_sgm(cost, cost_aggregation, p1, p2):
+    for direction in range(cost_aggregation.size(1)):
+        cost_aggregation[:, direction] = cpu_sgm_direction(cost, direction, p1, p2)
+
+
+def cpu_left_right_consistency_check(left_disparity, right_disparity, max_diff):
+    # right disparities are negative, a consistent pair sums to about zero
+    width = left_disparity.size(2)
+    q = (torch.arange(width, dtype=left_disparity.dtype) - left_disparity).trunc().long()
+    inside = (q >= 0) & (q < width)
+    dr = right_disparity.gather(2, q.clamp(0, width - 1))
+    inconsistent = inside & (left_disparity.int() != -1) & (dr.int() != -1) & ((left_disparity + dr).abs() >= max_diff)
+    left_disparity[inconsistent] = -1
@@ -2,22 +2,67 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
-import gdnet_lib
 import utils
+from GDNet import cpu_lib
+
+try:
+    import gdnet_lib
+except ImportError:
+    # CPU only installation, tensors on CPU are handled by GDNet/cpu_lib.py
+    gdnet_lib = None
 
 DEBUG = False
 
+# How the aggregation (B, C, directions, D, H, W) of SgaFunction, GD4_Function and GD6_Function is kept for backward
+# full: as it is
+# cpu: copied to host memory
+# half, bfloat16: stored in 16 bits, backward runs on the rounded values
+# recompute: nothing is kept, backward runs the forward kernel again
+STORAGES = ['full', 'cpu', 'half', 'bfloat16', 'recompute']
+
+
+def store_aggregation(cost_aggregation, storage):
+    if storage == 'full':
+        return cost_aggregation
+    elif storage == 'cpu':
+        return cost_aggregation.to('cpu')
+    elif storage in ['half', 'bfloat16']:
+        return cost_aggregation.to(getattr(torch, storage))
+    elif storage == 'recompute':
+        return None
+    raise Exception('Cannot find aggregation storage: ' + storage)
+
+
+def load_aggregation(cost_aggregation, cost):
+    return cost_aggregation.to(device=cost.device, dtype=cost.dtype).contiguous()
+
+
+def up_cast(*tensors):
+    # the kernels have no 16 bit versions, half and bfloat16 inputs (autocast) are computed in float,
+    # autograd casts the gradients back to the dtype of each input
+    return [t.float() if t.dtype in [torch.float16, torch.bfloat16] else t for t in tensors]
+
+
 class SgaFunction(Function):
     @staticmethod
-    def forward(ctx, cost, weight):
+    def aggregate(cost, weight):
+        batch, channels, max_disparity, height, width = cost.size()
+        direction = weight.size()[2]
+        cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
+        max_index = torch.zeros((batch, channels, direction, height, width), dtype=torch.uint8).to(cost.device)
+        if cost.is_cuda:
+            gdnet_lib.cuda_sga_forward(cost, cost_aggregation, weight, max_index)
+        else:
+            cpu_lib.cpu_sga_forward(cost, cost_aggregation, weight, max_index)
+        return cost_aggregation, max_index
+
+    @staticmethod
+    def forward(ctx, cost, weight, storage='cpu'):
+        cost, weight = up_cast(cost, weight)
         assert cost.is_contiguous() and weight.is_contiguous()
         with torch.cuda.device_of(cost):
-            batch, channels, max_disparity, height, width = cost.size()
-            direction = weight.size()[2]
-            cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
-            max_index = torch.zeros((batch, channels, direction, height, width), dtype=torch.uint8).to(cost.device)
-            gdnet_lib.cuda_sga_forward(cost, cost_aggregation, weight, max_index)
-            ctx.save_for_backward(cost, cost_aggregation.to('cpu'), weight, max_index)
+            cost_aggregation, max_index = SgaFunction.aggregate(cost, weight)
+            ctx.save_for_backward(cost, store_aggregation(cost_aggregation, storage), weight, max_index)
 
             if DEBUG:
                 print('[SGA forward]')
@@ -33,11 +78,19 @@ class SgaFunction(Function):
 
         assert grad_output.is_contiguous()
         with torch.cuda.device_of(cost):
+            if cost_aggregation is None:
+                cost_aggregation = SgaFunction.aggregate(cost, weight)[0]
+            else:
+                cost_aggregation = load_aggregation(cost_aggregation, cost)
             weight_grad = cost.new().resize_(weight.shape).zero_()
             cost_grad = cost.new().resize_(cost.shape).zero_()
             grad_aggregation = cost.new().resize_(cost.shape).zero_()
-            gdnet_lib.cuda_sga_backward(cost, cost_aggregation.to(cost.device), weight, max_index,
-                                        cost_grad, weight_grad, grad_output, grad_aggregation)
+            if cost.is_cuda:
+                gdnet_lib.cuda_sga_backward(cost, cost_aggregation, weight, max_index,
+                                            cost_grad, weight_grad, grad_output, grad_aggregation)
+            else:
+                cpu_lib.cpu_sga_backward(cost, cost_aggregation, weight, max_index,
+                                         cost_grad, weight_grad, grad_output, grad_aggregation)
             if DEBUG:
                 print('[SGA backward]')
                 print('\tcost mean: {:e}'.format(cost.view(-1).mean()))
@@ -53,15 +106,19 @@ class SgaFunction(Function):
                     utils.save((cost, cost_aggregation, weight, max_index, cost_grad, weight_grad, grad_output),
                                '../log/error-data.np')
                     exit(2)
-        return cost_grad, weight_grad
+        return cost_grad, weight_grad, None
 
 class LgaFunction(Function):
     @staticmethod
     def forward(ctx, cost, weight):
+        cost, weight = up_cast(cost, weight)
         assert cost.is_contiguous() and weight.is_contiguous()
         with torch.cuda.device_of(cost):
             output_cost = cost.new().resize_(cost.shape).zero_()
-            gdnet_lib.cuda_lga_forward(cost, output_cost, weight)
+            if cost.is_cuda:
+                gdnet_lib.cuda_lga_forward(cost, output_cost, weight)
+            else:
+                cpu_lib.cpu_lga_forward(cost, output_cost, weight)
             ctx.save_for_backward(cost, weight)
             if DEBUG:
                 print('[LGA forward]')
@@ -79,8 +136,12 @@ class LgaFunction(Function):
         with torch.cuda.device_of(cost):
             weight_grad = cost.new().resize_(weight.shape).zero_()
             cost_grad = cost.new().resize_(cost.shape).zero_()
-            gdnet_lib.cuda_lga_backward(cost, weight,
-                                       cost_grad, weight_grad, grad_output)
+            if cost.is_cuda:
+                gdnet_lib.cuda_lga_backward(cost, weight,
+                                           cost_grad, weight_grad, grad_output)
+            else:
+                cpu_lib.cpu_lga_backward(cost, weight,
+                                         cost_grad, weight_grad, grad_output)
             if DEBUG:
                 print('[LGA backward]')
                 print('\tcost mean: {:e}'.format(cost.view(-1).mean()))
@@ -93,15 +154,24 @@ class LgaFunction(Function):
 
 class GD4_Function(Function):
     @staticmethod
-    def forward(ctx, cost, g0, filter):
+    def aggregate(cost, g0, filter):
+        batch, channels, max_disparity, height, width = cost.size()
+        direction = g0.size()[2]
+        assert direction == 4
+        cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
+        if cost.is_cuda:
+            gdnet_lib.cuda_df4_forward(cost, cost_aggregation, g0, filter)
+        else:
+            cpu_lib.cpu_df4_forward(cost, cost_aggregation, g0, filter)
+        return cost_aggregation
+
+    @staticmethod
+    def forward(ctx, cost, g0, filter, storage='full'):
+        cost, g0, filter = up_cast(cost, g0, filter)
         assert cost.is_contiguous() and g0.is_contiguous() and filter.is_contiguous()
         with torch.cuda.device_of(cost):
-            batch, channels, max_disparity, height, width = cost.size()
-            direction = g0.size()[2]
-            assert direction == 4
-            cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
-            gdnet_lib.cuda_df4_forward(cost, cost_aggregation, g0, filter)
-            ctx.save_for_backward(cost, cost_aggregation, g0, filter)
+            cost_aggregation = GD4_Function.aggregate(cost, g0, filter)
+            ctx.save_for_backward(cost, store_aggregation(cost_aggregation, storage), g0, filter)
         return cost_aggregation
 
     @staticmethod
@@ -110,26 +180,43 @@ class GD4_Function(Function):
 
         assert grad_output.is_contiguous()
         with torch.cuda.device_of(cost):
+            if cost_aggregation is None:
+                cost_aggregation = GD4_Function.aggregate(cost, g0, filter)
+            else:
+                cost_aggregation = load_aggregation(cost_aggregation, cost)
             g0_grad = cost.new().resize_(g0.shape).zero_()
             filter_grad = cost.new().resize_(filter.shape).zero_()
             cost_grad = cost.new().resize_(cost.shape).zero_()
             grad_aggregation = cost.new().resize_(cost.shape).zero_()
-            gdnet_lib.cuda_df4_backward(cost, cost_aggregation, g0, filter,
-                                        cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
+            if cost.is_cuda:
+                gdnet_lib.cuda_df4_backward(cost, cost_aggregation, g0, filter,
+                                            cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
+            else:
+                cpu_lib.cpu_df4_backward(cost, cost_aggregation, g0, filter,
+                                         cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
 
-        return cost_grad, g0_grad, filter_grad
+        return cost_grad, g0_grad, filter_grad, None
 
 class GD6_Function(Function):
     @staticmethod
-    def forward(ctx, cost, g0, filter):
+    def aggregate(cost, g0, filter):
+        batch, channels, max_disparity, height, width = cost.size()
+        direction = g0.size()[2]
+        assert direction == 6
+        cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
+        if cost.is_cuda:
+            gdnet_lib.cuda_df6_forward(cost, cost_aggregation, g0, filter)
+        else:
+            cpu_lib.cpu_df6_forward(cost, cost_aggregation, g0, filter)
+        return cost_aggregation
+
+    @staticmethod
+    def forward(ctx, cost, g0, filter, storage='full'):
+        cost, g0, filter = up_cast(cost, g0, filter)
         assert cost.is_contiguous() and g0.is_contiguous() and filter.is_contiguous()
         with torch.cuda.device_of(cost):
-            batch, channels, max_disparity, height, width = cost.size()
-            direction = g0.size()[2]
-            assert direction == 6
-            cost_aggregation = cost.new().resize_((batch, channels, direction, max_disparity, height, width)).zero_()
-            gdnet_lib.cuda_df6_forward(cost, cost_aggregation, g0, filter)
-            ctx.save_for_backward(cost, cost_aggregation, g0, filter)
+            cost_aggregation = GD6_Function.aggregate(cost, g0, filter)
+            ctx.save_for_backward(cost, store_aggregation(cost_aggregation, storage), g0, filter)
         return cost_aggregation
 
     @staticmethod
@@ -138,14 +225,92 @@ class GD6_Function(Function):
 
         assert grad_output.is_contiguous()
         with torch.cuda.device_of(cost):
+            if cost_aggregation is None:
+                cost_aggregation = GD6_Function.aggregate(cost, g0, filter)
+            else:
+                cost_aggregation = load_aggregation(cost_aggregation, cost)
             g0_grad = cost.new().resize_(g0.shape).zero_()
             filter_grad = cost.new().resize_(filter.shape).zero_()
             cost_grad = cost.new().resize_(cost.shape).zero_()
             grad_aggregation = cost.new().resize_(cost.shape).zero_()
-            gdnet_lib.cuda_df6_backward(cost, cost_aggregation, g0, filter,
-                                        cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
+            if cost.is_cuda:
+                gdnet_lib.cuda_df6_backward(cost, cost_aggregation, g0, filter,
+                                            cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
+            else:
+                cpu_lib.cpu_df6_backward(cost, cost_aggregation, g0, filter,
+                                         cost_grad, g0_grad, filter_grad, grad_aggregation, grad_output)
+
+        return cost_grad, g0_grad, filter_grad, None
+
+class Checkpoint(Function):
+    # Run run_function(*args) without keeping its intermediate tensors, they are recomputed in backward.
+    # Same idea as torch.utils.checkpoint, which imports torch._dynamo -> cProfile -> profile and would
+    # pick up ./profile.py when scripts run from the repository root.
+    # Parameters used inside run_function (not passed in args) accumulate their .grad during the recompute.
+    @staticmethod
+    def forward(ctx, run_function, *args):
+        ctx.run_function = run_function
+        ctx.save_for_backward(*args)
+        # backward runs outside the caller's autocast block, the recompute has to use the same precision
+        ctx.device_type = next(a.device.type for a in args if torch.is_tensor(a))
+        ctx.autocast = torch.is_autocast_enabled(ctx.device_type)
+        ctx.autocast_dtype = torch.get_autocast_dtype(ctx.device_type)
+        return run_function(*args)
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        args = [a.detach().requires_grad_(needs_grad) if a is not None else None
+                for a, needs_grad in zip(ctx.saved_tensors, ctx.needs_input_grad[1:])]
+        with torch.enable_grad(), torch.autocast(ctx.device_type, dtype=ctx.autocast_dtype, enabled=ctx.autocast):
+            outputs = ctx.run_function(*args)
+        if torch.is_tensor(outputs):
+            outputs = (outputs,)
+
+        outputs, grad_outputs = zip(*[(o, g) for o, g in zip(outputs, grad_outputs)
+                                      if o.requires_grad and g is not None])
+        torch.autograd.backward(outputs, grad_outputs)
+        return (None,) + tuple(a.grad if needs_grad else None for a, needs_grad in zip(args, ctx.needs_input_grad[1:]))
+
+
+def checkpoint_module(module, function, *args):
+    # function(*args) through Checkpoint, function uses the parameters of module
+    # the recompute normalizes with the batch statistics as usual but leaves the running statistics alone,
+    # they were already updated in forward
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    calls = []
+
+    def run(*args):
+        if not calls:
+            calls.append(1)
+            return function(*args)
+        track = [m.track_running_stats for m in norms]
+        for m in norms:
+            m.track_running_stats = False
+        try:
+            return function(*args)
+        finally:
+            for m, value in zip(norms, track):
+                m.track_running_stats = value
 
-        return cost_grad, g0_grad, filter_grad
+    return Checkpoint.apply(run, *args)
+
+
+def set_storage(model, storage):
+    # aggregation storage (see STORAGES) of every SGA, GD4 and GD6 layer of model,
+    # single layers can be set directly, e.g. model.cost_aggregation.gd1.gdf6.storage = 'half'
+    if storage not in STORAGES:
+        raise Exception('Cannot find aggregation storage: ' + storage)
+    for m in model.modules():
+        if hasattr(m, 'storage'):
+            m.storage = storage
+
+
+def set_checkpoint(model, enabled=True):
+    # recompute the GD blocks and 3D Conv2x blocks of the cost aggregation in backward instead of keeping their
+    # activations, it only applies in training mode
+    for m in model.modules():
+        if hasattr(m, 'checkpoint') and getattr(m, 'is_3d', True):
+            m.checkpoint = enabled
 
 def softmax(x):
     e = torch.exp(x - x.max(dim=0)[0].unsqueeze(0))
@@ -182,9 +347,14 @@ class MinimumKernel(Function):
         cost_grad = ctx.saved_tensors[0]
         return grad * cost_grad, None
 
+def flip_stereo(x, y):
+    # mirror a stereo pair on its own device: the flipped right image becomes the left (reference) image
+    return torch.flip(y, dims=[-1]), torch.flip(x, dims=[-1])
+
 class FlipCost(Function):
     @staticmethod
     def forward(ctx, cost):
+        cost, = up_cast(cost)
         assert cost.is_contiguous()
         with torch.cuda.device_of(cost):
             flip_cost = cost.new().resize_(cost.shape).zero_()
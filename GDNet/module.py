@@ -5,6 +5,7 @@ import numpy as np
 class SGA(nn.Module):
     def __init__(self):
         super(SGA, self).__init__()
+        self.storage = 'cpu'
 
     def forward(self, x, g):
         batch, channels, max_disparity, height, width = x.size()
@@ -12,7 +13,7 @@ class SGA(nn.Module):
 
         g = g.view(batch, channels, directions, weights, height, width).contiguous()
         g = F.normalize(g, p=1, dim=3)
-        x = SgaFunction.apply(x, g)  # output: cost_aggregation
+        x = SgaFunction.apply(x, g, self.storage)  # output: cost_aggregation
         x = x.max(axis=2)[0]  # max in direction axis
 
         return x
@@ -65,10 +66,9 @@ class DisparityRegression(nn.Module):
 
     def forward(self, x):
         with torch.cuda.device_of(x):
-            disp = np.arange(self.maxdisp).reshape([1, self.maxdisp, 1, 1])
-            disp = torch.tensor(disp, requires_grad=False).to(x.device).float()
-            disp = disp.repeat(x.size(0), 1, x.size(2), x.size(3))
-            disp = torch.sum(x * disp, dim=1)
+            # contract the disparity axis directly, no (B, D, H, W) arange or product volume
+            disp = torch.arange(self.maxdisp, dtype=x.dtype, device=x.device)
+            disp = torch.einsum('bdhw,d->bhw', x, disp)
         return disp
 
 class DisparityClassRegressionLoss(nn.Module):
@@ -128,37 +128,221 @@ class SqueezeCostByGradient(nn.Module):
             cost_squeeze = F.normalize(cost_squeeze, dim=1, p=1)
         return mask, cost_squeeze
 
+class SqueezeDisparityRegression(nn.Module):
+    # F.softmax -> SqueezeCostByGradient -> DisparityRegression on the raw cost (B, D, H, W) in one operator,
+    # streaming over chunk_size disparities at a time, only (B, H, W) maps are kept.
+    # The unimodal mask of cost_mask_kernel keeps (a, disp] and [disp, b), where a is the last d <= disp with
+    # cost[d] <= cost[d - 1] (or 0) and b the first d >= disp with cost[d + 1] >= cost[d] (or D - 1).
+    # The softmax normalizer cancels in the normalized expectation, so only exp(cost - max) on the mask is summed.
+    # confidence: softmax probability mass inside the mask
+    def __init__(self, chunk_size=16):
+        super(SqueezeDisparityRegression, self).__init__()
+        self.chunk_size = chunk_size
+
+    def forward(self, cost, disp=None):
+        with torch.cuda.device_of(cost):
+            batch, max_disparity, height, width = cost.size()
+            if disp is None:
+                disp = torch.argmax(cost, dim=1)
+            disp = disp.long().unsqueeze(1)
+            # pass 2 accumulates in float32, also for a float16 / bfloat16 cost of an autocast forward
+            cost_max = cost.gather(1, disp).float()
+
+            # pass 1: bounds of the mask
+            a = torch.zeros_like(disp)
+            b = torch.full_like(disp, max_disparity - 1)
+            for begin in range(1, max_disparity, self.chunk_size):
+                end = min(begin + self.chunk_size, max_disparity)
+                d = torch.arange(begin, end, device=cost.device).view(1, -1, 1, 1)
+                step = cost[:, begin:end] - cost[:, begin - 1:end - 1]  # cost[d] - cost[d - 1]
+
+                down = (step <= 0) & (d <= disp)
+                a = torch.max(a, torch.where(down, d, 0).max(dim=1, keepdim=True).values)
+                up = (step >= 0) & (d - 1 >= disp)
+                b = torch.min(b, torch.where(up, d - 1, max_disparity - 1).min(dim=1, keepdim=True).values)
+
+            # pass 2: masked expectation
+            numerator = torch.zeros_like(cost_max)
+            denominator = torch.zeros_like(cost_max)
+            total = torch.zeros_like(cost_max)
+            for begin in range(0, max_disparity, self.chunk_size):
+                end = min(begin + self.chunk_size, max_disparity)
+                d = torch.arange(begin, end, device=cost.device).view(1, -1, 1, 1)
+                e = torch.exp(cost[:, begin:end].float() - cost_max)
+                total += e.sum(dim=1, keepdim=True)
+
+                mask = ((d > a) & (d <= disp)) | ((d >= disp) & (d < b))
+                e = e * mask
+                denominator += e.sum(dim=1, keepdim=True)
+                numerator += (e * d).sum(dim=1, keepdim=True)
+
+            disparity = numerator / denominator.clamp(min=1e-12)
+            confidence = denominator / total
+        return disparity[:, 0], confidence[:, 0]
+
+
+class SparseDisparityRegression(nn.Module):
+    # regression on a compact (B, k, H, W) cost instead of the full (B, D, H, W) volume
+    # mode 'topk': softmax and expectation over the k largest costs of each pixel
+    # mode 'window': the k disparities around the argmax, squeezed to the unimodal mask like SqueezeDisparityRegression,
+    # which gives the same result whenever the mask fits in the window
+    def __init__(self, k=24, mode='window'):
+        super(SparseDisparityRegression, self).__init__()
+        if mode not in ['topk', 'window']:
+            raise Exception('Cannot find sparse regression mode: ' + mode)
+        self.k = k
+        self.mode = mode
+        self.squeeze = SqueezeDisparityRegression(chunk_size=k)
+
+    def forward(self, cost, disp=None):
+        with torch.cuda.device_of(cost):
+            max_disparity = cost.size(1)
+            k = min(self.k, max_disparity)
+
+            if self.mode == 'topk':
+                cost, index = torch.topk(cost, k, dim=1, sorted=False)
+                prob = F.softmax(cost.float(), dim=1)
+                return torch.einsum('bkhw,bkhw->bhw', prob, index.to(prob.dtype))
+
+            if disp is None:
+                disp = torch.argmax(cost, dim=1)
+            disp = disp.long().unsqueeze(1)
+            start = (disp - k // 2).clamp(0, max_disparity - k)
+            index = start + torch.arange(k, device=cost.device).view(1, -1, 1, 1)
+            cost = cost.gather(1, index)
+            disparity = self.squeeze(cost, (disp - start)[:, 0])[0]
+        return disparity + start[:, 0].to(disparity.dtype)
+
+
+def build_cost_volume(x, y, max_disparity, out=None, min_disparity=0):
+    # cost[:, :F, d, :, w] = x[..., w], cost[:, F:, d, :, w] = y[..., w - d] for w >= d, zero otherwise
+    # with d in [min_disparity, max_disparity)
+    # out: optional (B, 2F, D, H, W) buffer, filled in place when no gradient is required
+    B, F, H, W = x.size()
+    D = int(max_disparity) - min_disparity
+
+    with torch.cuda.device_of(x):
+        # column 0 of source is zero padding, invalid (w < d) positions gather from it
+        source = torch.nn.functional.pad(torch.stack([x, y], dim=1), (1, 0))
+        source = source.unsqueeze(3).expand(B, 2, F, D, H, W + 1)
+
+        d = torch.arange(min_disparity, int(max_disparity), device=x.device).view(D, 1)
+        w = torch.arange(W, device=x.device).view(1, W)
+        valid = w >= d
+        index = torch.stack([torch.where(valid, w + 1, 0), torch.where(valid, w - d + 1, 0)])
+        index = index.view(1, 2, 1, D, 1, W).expand(B, 2, F, D, H, W)
+
+        if source.requires_grad and torch.is_grad_enabled():
+            out = None
+
+        if out is None or out.size() != (B, F * 2, D, H, W) or out.dtype != x.dtype or out.device != x.device:
+            return torch.gather(source, 5, index).view(B, F * 2, D, H, W)
+
+        torch.gather(source, 5, index, out=out.view(B, 2, F, D, H, W))
+    return out
+
+
+class LazyCostVolume:
+    # Concatenation volume of build_cost_volume that is never stored as a whole.
+    # F.conv3d (conv_start of the cost aggregation) consumes it chunk_size disparities at a time,
+    # any other torch function materializes the full volume first.
+    def __init__(self, x, y, max_disparity, chunk_size):
+        self.x = x
+        self.y = y
+        self.max_disparity = int(max_disparity)
+        self.chunk_size = chunk_size
+
+    @property
+    def shape(self):
+        B, F, H, W = self.x.size()
+        return torch.Size((B, F * 2, self.max_disparity, H, W))
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def dim(self):
+        return 5
+
+    @property
+    def device(self):
+        return self.x.device
+
+    def materialize(self):
+        return build_cost_volume(self.x, self.y, self.max_disparity)
+
+    def conv3d(self, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
+        stride, padding, dilation = [v if isinstance(v, (tuple, list)) else (v,) * 3 for v in (stride, padding, dilation)]
+        if isinstance(padding[0], str) or tuple(stride) != (1, 1, 1) or tuple(dilation) != (1, 1, 1) or groups != 1:
+            return torch.nn.functional.conv3d(self.materialize(), weight, bias, stride, padding, dilation, groups)
+
+        D = self.max_disparity
+        kernel_size, pad = weight.size(2), padding[0]
+        out_size = D + 2 * pad - kernel_size + 1
+
+        def chunk(start, end):
+            # input disparities [start - pad, end - pad + kernel_size - 1), zero outside [0, D)
+            first, last = start - pad, end - pad + kernel_size - 1
+
+            def run(x, y, weight, bias):
+                cost = build_cost_volume(x, y, min(last, D), min_disparity=max(first, 0))
+                cost = torch.nn.functional.pad(cost, (0, 0, 0, 0, max(-first, 0), max(last - D, 0)))
+                return torch.nn.functional.conv3d(cost, weight, bias, padding=(0, padding[1], padding[2]))
+            return run
+
+        if not torch.is_grad_enabled():
+            B, _, H, W = self.x.size()
+            out = self.x.new_empty((B, weight.size(0), out_size, H + 2 * padding[1] - weight.size(3) + 1,
+                                    W + 2 * padding[2] - weight.size(4) + 1))
+            for start in range(0, out_size, self.chunk_size):
+                end = min(start + self.chunk_size, out_size)
+                out[:, :, start:end] = chunk(start, end)(self.x, self.y, weight, bias)
+            return out
+
+        # the chunk volume is rebuilt in backward instead of being kept alive
+        outputs = []
+        for start in range(0, out_size, self.chunk_size):
+            run = chunk(start, min(start + self.chunk_size, out_size))
+            outputs.append(Checkpoint.apply(run, self.x, self.y, weight, bias))
+        return torch.cat(outputs, dim=2)
+
+    @classmethod
+    def __torch_function__(cls, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.nn.functional.conv3d and isinstance(args[0], LazyCostVolume):
+            return args[0].conv3d(*args[1:], **kwargs)
+        args = [a.materialize() if isinstance(a, LazyCostVolume) else a for a in args]
+        return func(*args, **kwargs)
+
+
 class CostVolume(nn.Module):
-    def __init__(self, max_disparity):
+    def __init__(self, max_disparity, reuse_buffer=False, lazy=False, chunk_size=8):
         super(CostVolume, self).__init__()
         self.max_disparity = int(max_disparity)
 
-    def forward(self, x, y):
-        assert x.is_contiguous()
-        with torch.cuda.device_of(x):
-            # Size of batch, feature, disparity
-            B, F, D = x.shape[0], x.shape[1], self.max_disparity
-
-            # Size of height, width
-            H, W = x.shape[2], x.shape[3]
+        # reuse_buffer: fill the same volume on every call without gradient (inference),
+        # the volume returned by the previous call is overwritten
+        self.reuse_buffer = reuse_buffer
+        self.buffer = None
 
-            size = (B, F * 2, D, H, W)
-            cost = torch.zeros([int(x) for x in size], requires_grad=False).to(x.device)
+        # lazy: return a LazyCostVolume, the following conv_start builds its output chunk by chunk
+        self.lazy = lazy
+        self.chunk_size = chunk_size
 
-            for i in range(D):
-                if i > 0:
-                    cost[:, :F, i, :, i:] = x[:, :, :, i:]
-                    cost[:, F:, i, :, i:] = y[:, :, :, :-i]
-                else:
-                    cost[:, :F, i, :, :] = x
-                    cost[:, F:, i, :, :] = y
+    def forward(self, x, y):
+        assert x.is_contiguous()
+        if self.lazy:
+            return LazyCostVolume(x, y, self.max_disparity, self.chunk_size)
 
-        return cost.contiguous()
+        cost = build_cost_volume(x, y, self.max_disparity, self.buffer if self.reuse_buffer else None)
+        if self.reuse_buffer and not cost.requires_grad:
+            self.buffer = cost
+        return cost
 
 class GD4(nn.Module):
     def __init__(self, kernel_size):
         super(GD4, self).__init__()
         self.kernel_size = kernel_size
+        self.storage = 'full'
 
     def forward(self, x, g):
         batch, channels, max_disparity, height, width = x.size()
@@ -171,7 +355,7 @@ class GD4(nn.Module):
         filter = g[:, :, :, 1:, :, :]
         filter = filter.view(batch, channels, direction, self.kernel_size, self.kernel_size, height, width).contiguous()
 
-        x = GD4_Function.apply(x, g0, filter)  # output: cost_aggregation
+        x = GD4_Function.apply(x, g0, filter, self.storage)  # output: cost_aggregation
         x = x.view(batch, channels*4, max_disparity, height, width)
 
         return x
@@ -180,6 +364,7 @@ class GD6(nn.Module):
     def __init__(self, kernel_size):
         super(GD6, self).__init__()
         self.kernel_size = kernel_size
+        self.storage = 'full'
 
     def forward(self, x, g):
         batch, channels, max_disparity, height, width = x.size()
@@ -192,7 +377,7 @@ class GD6(nn.Module):
         filter = g[:, :, :, 1:, :, :]
         filter = filter.view(batch, channels, direction, self.kernel_size, self.kernel_size, height, width).contiguous()
 
-        x = GD6_Function.apply(x, g0, filter)  # output: cost_aggregation
+        x = GD6_Function.apply(x, g0, filter, self.storage)  # output: cost_aggregation
         x = x.view(batch, channels*6, max_disparity, height, width)
 
         return x
@@ -202,6 +387,7 @@ class GD4_Block(nn.Module):
     def __init__(self, channels, kernel_size):
         super(GD4_Block, self).__init__()
         self.channels = channels
+        self.checkpoint = False
 
         self.sga = GD4(kernel_size)
         self.conv = BasicConv(channels*4, channels, is_3d=True, kernel_size=3, padding=1)
@@ -210,6 +396,11 @@ class GD4_Block(nn.Module):
     # x: input cost
     # g: guidance
     def forward(self, x, g):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_module(self, self._forward, x, g)
+        return self._forward(x, g)
+
+    def _forward(self, x, g):
         rem = x
         x = self.sga(x, g)
         x = self.conv(x)
@@ -223,6 +414,7 @@ class GD6_Block(nn.Module):
     def __init__(self, channels, kernel_size):
         super(GD6_Block, self).__init__()
         self.channels = channels
+        self.checkpoint = False
 
         self.gdf6 = GD6(kernel_size)
         self.conv = BasicConv(channels*6, channels, is_3d=True, kernel_size=3, padding=1)
@@ -231,6 +423,11 @@ class GD6_Block(nn.Module):
     # x: input cost
     # g: guidance
     def forward(self, x, g):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_module(self, self._forward, x, g)
+        return self._forward(x, g)
+
+    def _forward(self, x, g):
         rem = x
         x = self.gdf6(x, g)
         x = self.conv(x)
@@ -7,6 +7,7 @@ from LEAStereo.models.build_model_2d import CostInterpolation
 from LEAStereo.models.decoding_formulas import network_layer_to_space
 from LEAStereo.new_model_2d import newFeature
 from LEAStereo.skip_model_3d import newMatching
+from GDNet.module import build_cost_volume, flip_stereo
 
 
 class LEAStereo(nn.Module):
@@ -29,21 +30,16 @@ class LEAStereo(nn.Module):
         self.matching = newMatching(network_arch_mat, cell_arch_mat)
         self.cost_interpolation = CostInterpolation(self.maxdisp)
         self.maxdisp_downsampleing = maxdisp_downsampleing
+        self.flip = False
 
     def forward(self, x, y):
+        if self.flip:
+            x, y = flip_stereo(x, y)
+
         x = self.feature(x)
         y = self.feature(y)
 
-        with torch.cuda.device_of(x):
-            cost = x.new().resize_(x.size()[0], x.size()[1] * 2, int(self.maxdisp / self.maxdisp_downsampleing),
-                                   x.size()[2], x.size()[3]).zero_()
-        for i in range(int(self.maxdisp / self.maxdisp_downsampleing)):
-            if i > 0:
-                cost[:, :x.size()[1], i, :, i:] = x[:, :, :, i:]
-                cost[:, x.size()[1]:, i, :, i:] = y[:, :, :, :-i]
-            else:
-                cost[:, :x.size()[1], i, :, i:] = x
-                cost[:, x.size()[1]:, i, :, i:] = y
+        cost = build_cost_volume(x, y, int(self.maxdisp / self.maxdisp_downsampleing))
 
         cost = self.matching(cost)
         cost = self.cost_interpolation(cost)
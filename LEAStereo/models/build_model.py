@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from LEAStereo.models.build_model_2d import AutoFeature, Disp
 from LEAStereo.models.build_model_3d import AutoMatching
+from GDNet.module import build_cost_volume
 import pdb
 from time import time
 
@@ -44,16 +45,7 @@ class AutoStereo(nn.Module):
         x = self.feature(x)
         y = self.feature(y)
 
-        with torch.cuda.device_of(x):
-            cost = x.new().resize_(x.size()[0], x.size()[1] * 2, int(self.maxdisp / 3), x.size()[2],
-                                   x.size()[3]).zero_()
-        for i in range(int(self.maxdisp / 3)):
-            if i > 0:
-                cost[:, :x.size()[1], i, :, i:] = x[:, :, :, i:]
-                cost[:, x.size()[1]:, i, :, i:] = y[:, :, :, :-i]
-            else:
-                cost[:, :x.size()[1], i, :, i:] = x
-                cost[:, x.size()[1]:, i, :, i:] = y
+        cost = build_cost_volume(x, y, int(self.maxdisp / 3))
 
         cost = self.matching(cost)
         disp0 = self.disp(cost)
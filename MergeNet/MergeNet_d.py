@@ -1,11 +1,30 @@
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 import numpy as np
 
 
+def conv_matrix(conv, length):
+    # dense (length, output length) matrix of a single channel Conv1d / ConvTranspose1d without its bias,
+    # x @ conv_matrix(conv, x.size(-1)) + bias == conv(x), built by convolving the identity
+    eye = torch.eye(length, dtype=conv.weight.dtype, device=conv.weight.device).unsqueeze(1)
+    if isinstance(conv, nn.ConvTranspose1d):
+        matrix = F.conv_transpose1d(eye, conv.weight, stride=conv.stride, padding=conv.padding,
+                                    output_padding=conv.output_padding)
+    else:
+        matrix = F.conv1d(eye, conv.weight, stride=conv.stride, padding=conv.padding)
+    return matrix.squeeze(1)
+
+
 class MergeNet_d(nn.Module):
-    def __init__(self, max_disparity):
+    # use_gemm: the kernels (200, 201) are as long as the signal (2 * max_disparity), so every layer runs as
+    # one GEMM with its dense conv_matrix instead of a direct convolution, and the five bias free convolutions
+    # of conv_final collapse into a single matrix
+    # chunk_size: pixels per chunk in eval, bounds the memory of a full frame
+    def __init__(self, max_disparity, use_gemm=True, chunk_size=65536):
         super(MergeNet_d, self).__init__()
+        self.use_gemm = use_gemm
+        self.chunk_size = chunk_size
 
         self.conv_11 = nn.Sequential(nn.Conv1d(1, 1, kernel_size=201, stride=2, padding=100),
                                      nn.BatchNorm1d(1),
@@ -88,28 +107,67 @@ class MergeNet_d(nn.Module):
         cost = cost.reshape(-1, 1, disparityx2)
 
         # Disparity computing
-        rem0 = self.conv_11(cost)
-        rem1 = self.conv_12(rem0)
-        rem2 = self.conv_13(rem1)
-        rem3 = self.conv_14(rem2)
-        rem4 = self.conv_15(rem3)
-        rem5 = self.conv_16(rem4)
-        rem6 = self.conv_17(rem5)
-        rem7 = self.conv_18(rem6)
-        cost = self.conv_21(rem7)
-        cost = self.conv_22(cost + rem0)
-        cost = self.conv_23(cost + rem1)
-        cost = self.conv_24(cost + rem2)
-        cost = self.conv_25(cost + rem3)
-        cost = self.conv_26(cost + rem4)
-        cost = self.conv_27(cost + rem5)
-        cost = self.conv_28(cost + rem6)
-        disp = self.conv_final(cost + rem7)
-        disp = self.disparity_regression(disp)
+        matrices = self.gemm_matrices(disparityx2) if self.use_gemm else {}
+        if self.training:
+            # batch norm statistics are taken over every pixel
+            disp = self.compute(cost, matrices)
+        else:
+            disp = torch.cat([self.compute(c, matrices) for c in cost.split(self.chunk_size)])
         disp = disp.reshape(batch, height, width)
 
         return disp
 
+    def compute(self, cost, matrices):
+        # cost: pixel, 1, disparity*2
+        rem0 = self.layer(self.conv_11, cost, matrices)
+        rem1 = self.layer(self.conv_12, rem0, matrices)
+        rem2 = self.layer(self.conv_13, rem1, matrices)
+        rem3 = self.layer(self.conv_14, rem2, matrices)
+        rem4 = self.layer(self.conv_15, rem3, matrices)
+        rem5 = self.layer(self.conv_16, rem4, matrices)
+        rem6 = self.layer(self.conv_17, rem5, matrices)
+        rem7 = self.layer(self.conv_18, rem6, matrices)
+        cost = self.layer(self.conv_21, rem7, matrices)
+        cost = self.layer(self.conv_22, cost + rem0, matrices)
+        cost = self.layer(self.conv_23, cost + rem1, matrices)
+        cost = self.layer(self.conv_24, cost + rem2, matrices)
+        cost = self.layer(self.conv_25, cost + rem3, matrices)
+        cost = self.layer(self.conv_26, cost + rem4, matrices)
+        cost = self.layer(self.conv_27, cost + rem5, matrices)
+        cost = self.layer(self.conv_28, cost + rem6, matrices)
+        disp = self.layer(self.conv_final, cost + rem7, matrices)
+        return self.disparity_regression(disp)
+
+    def layer(self, layer, x, matrices):
+        if layer not in matrices:
+            return layer(x)
+
+        if layer is self.conv_final:
+            return x.matmul(matrices[layer])
+
+        conv, bn, relu = layer
+        x = x.matmul(matrices[layer])
+        if conv.bias is not None:
+            x = x + conv.bias
+        return relu(bn(x))
+
+    def gemm_matrices(self, length):
+        matrices = {}
+        for layer in [self.conv_11, self.conv_12, self.conv_13, self.conv_14,
+                      self.conv_15, self.conv_16, self.conv_17, self.conv_18,
+                      self.conv_21, self.conv_22, self.conv_23, self.conv_24,
+                      self.conv_25, self.conv_26, self.conv_27, self.conv_28]:
+            matrices[layer] = conv_matrix(layer[0], length)
+            length = matrices[layer].size(1)
+
+        matrix = None
+        for conv in self.conv_final:
+            m = conv_matrix(conv, length)
+            matrix = m if matrix is None else matrix.matmul(m)
+            length = m.size(1)
+        matrices[self.conv_final] = matrix
+        return matrices
+
 
 class DisparityRegression(nn.Module):
     def __init__(self, maxdisp):
@@ -1,10 +1,97 @@
-from torch.utils.data import Dataset, Subset
+from torch.utils.data import Dataset, Subset, Sampler
 import torch
 import os
 import utils
 import cv2
 import random
 import numpy as np
+import multiprocessing
+
+
+class PackedShards:
+    # Samples of one kind (e.g. cleanpass, left_disparity) packed by dataset/pack_flyingthings3D.py
+    # into a few large fixed stride .npy shards, {name}-{shard:03d}.npy, plus {name}-index.npy that maps
+    # a sample index to (shard, slot). Shards are opened with mmap, so reading a crop only touches
+    # its pages and DataLoader workers share the page cache.
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+        self.index = np.load(os.path.join(root, f'{name}-index.npy'))
+        self.shards = None
+
+    def __getitem__(self, index):
+        # return a read-only memmap view, nothing is read before it is sliced or copied
+        if self.shards is None:
+            self.shards = [np.load(os.path.join(self.root, f'{self.name}-{i:03d}.npy'), mmap_mode='r')
+                           for i in range(self.index[:, 0].max() + 1)]
+        shard, slot = self.index[index]
+        return self.shards[shard][slot]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # every worker opens its own mmap instead of receiving a pickled copy of the shards
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+class DecodedImageCache:
+    # Byte budgeted LRU cache of decoded uint8 frames (height, width, channel) keyed by sample index.
+    # Frames live in fixed size slots of one shared memory arena allocated in the main process, DataLoader
+    # workers (forked or spawned, and recreated every epoch) attach to the same arena, so a frame decoded
+    # by any worker is a hit for all of them.
+    def __init__(self, max_bytes, frame_shape):
+        self.frame_bytes = int(np.prod(frame_shape))
+        slots = max_bytes // self.frame_bytes
+        self.data = torch.empty((slots, self.frame_bytes), dtype=torch.uint8).share_memory_()
+        self.keys = torch.full((slots,), -1, dtype=torch.long).share_memory_()
+        self.shapes = torch.zeros((slots, 3), dtype=torch.long).share_memory_()
+        self.stamps = torch.zeros(slots, dtype=torch.long).share_memory_()  # last used clock, 0 is empty
+        self.clock = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.count = torch.zeros(2, dtype=torch.long).share_memory_()  # hit, miss
+        self.lock = multiprocessing.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            frame = self._lookup(key)
+        if frame is None:
+            # decode outside of the lock, other workers keep reading the cache
+            frame = load()
+            with self.lock:
+                self._insert(key, frame)
+        return frame
+
+    def hit_rate(self):
+        return self.count[0].item() / max(self.count.sum().item(), 1)
+
+    def _slot(self, key):
+        slot = (self.keys == key).nonzero()
+        return slot[0, 0].item() if len(slot) > 0 else None
+
+    def _lookup(self, key):
+        slot = self._slot(key)
+        if slot is None:
+            self.count[1] += 1
+            return None
+
+        self.count[0] += 1
+        self.clock += 1
+        self.stamps[slot] = self.clock[0]
+        shape = self.shapes[slot].tolist()
+        return self.data[slot, :int(np.prod(shape))].numpy().reshape(shape).copy()
+
+    def _insert(self, key, frame):
+        if len(self.keys) == 0 or frame.nbytes > self.frame_bytes or self._slot(key) is not None:
+            return
+
+        slot = self.stamps.argmin().item()
+        self.clock += 1
+        self.data[slot, :frame.nbytes] = torch.from_numpy(np.ascontiguousarray(frame).reshape(-1))
+        self.shapes[slot] = torch.tensor(frame.shape)
+        self.stamps[slot] = self.clock[0]
+        self.keys[slot] = key
 
 
 class FlyingThings3D(Dataset):
@@ -14,7 +101,8 @@ class FlyingThings3D(Dataset):
     # height, width = 540, 960
     def __init__(self, max_disparity, type='train', image='cleanpass', use_crop_size=False, crop_size=None,
                  crop_seed=None, use_resize=False, resize=(None, None),
-                 use_padding_crop_size=False, padding_crop_size=(None, None)):
+                 use_padding_crop_size=False, padding_crop_size=(None, None), use_packed=False,
+                 use_uint8=False):
 
         assert os.path.exists(self.ROOT), 'Dataset path is not exist'
         self.data_max_disparity = []
@@ -26,6 +114,9 @@ class FlyingThings3D(Dataset):
         self.resize = resize
         self.use_padding_crop_size = use_padding_crop_size
         self.padding_crop_size = padding_crop_size
+        # use_uint8: return the images as uint8, utils.to_device converts the batch on the device,
+        # the disparity is float32 in every case (samples of one batch share its dtype)
+        self.use_uint8 = use_uint8
         self.pass_info = {}
 
         if type == 'train':
@@ -50,28 +141,32 @@ class FlyingThings3D(Dataset):
         if image not in ['cleanpass', 'finalpass']:
             raise Exception(f'Unknown image: "{image}"')
 
+        # use_packed: read the shards written by dataset/pack_flyingthings3D.py instead of one pickle per sample
+        self.use_packed = use_packed
+        if use_packed:
+            self.packed = {name: PackedShards(os.path.join(self.root, 'packed'), name)
+                           for name in [image, 'left_disparity']}
+
         self._make_mask_index()
 
     def __getitem__(self, index):
         if self.use_crop_size:
             index = self.mask_index[index]
-            X = utils.load(os.path.join(self.root, f'{self.image}/{index:05d}.np'))  # channel, height, width
-            X = torch.from_numpy(X)
+            X = self._load(self.image, index)  # channel, height, width
 
+            # crop before copying, a packed sample only reads the cropped rows
             cropper = utils.RandomCropper(X.shape[1:3], self.crop_size, seed=self.crop_seed)
-            X = cropper.crop(X)
-            X = X.float() / 255
+            X = torch.from_numpy(np.ascontiguousarray(cropper.crop(X)))
 
             Y_list = []
-            Y = utils.load(os.path.join(self.root, f'left_disparity/{index:05d}.np'))
-            Y = torch.from_numpy(Y)
-            Y = cropper.crop(Y)
+            Y = self._load('left_disparity', index)
+            Y = torch.from_numpy(np.ascontiguousarray(cropper.crop(Y)))
             Y_list.append(Y.unsqueeze(0))
             Y = torch.cat(Y_list, dim=0)
 
         elif self.use_resize:
             index = self.mask_index[index]
-            X = utils.load(os.path.join(self.root, f'{self.image}/{index:05d}.np'))  # channel, height, width
+            X = self._load(self.image, index)  # channel, height, width
             self.pass_info['original_height'], self.pass_info['original_width'] = X.shape[1:]
 
             X1 = X[:3, :, :].swapaxes(0, 2).swapaxes(0, 1)
@@ -82,17 +177,16 @@ class FlyingThings3D(Dataset):
 
             X = np.concatenate([X1, X2], axis=2)
             X = X.swapaxes(0, 1).swapaxes(0, 2)
-            X = torch.from_numpy(X).float() / 255.0
+            X = torch.from_numpy(X)
 
             Y_list = []
-            Y = utils.load(os.path.join(self.root, f'left_disparity/{index:05d}.np'))
-            Y = torch.from_numpy(Y)
+            Y = torch.from_numpy(np.require(self._load('left_disparity', index), requirements='W'))
             Y_list.append(Y.unsqueeze(0))
             Y = torch.cat(Y_list, dim=0)
 
         elif self.use_padding_crop_size:
             index = self.mask_index[index]
-            X = utils.load(os.path.join(self.root, f'{self.image}/{index:05d}.np'))  # channel, height, width
+            X = self._load(self.image, index)  # channel, height, width
 
             self.pass_info['original_height'], self.pass_info['original_width'] = X.shape[1:]
             assert self.pass_info['original_height'] <= self.padding_crop_size[0]
@@ -101,19 +195,25 @@ class FlyingThings3D(Dataset):
             X_pad = np.zeros((6, *self.padding_crop_size), dtype=np.uint8)
             X_pad[:X.shape[0], :X.shape[1], :] = X[...]
             X = X_pad
-            X = torch.from_numpy(X).float() / 255.0
+            X = torch.from_numpy(X)
 
             Y_list = []
-            Y = utils.load(os.path.join(self.root, f'left_disparity/{index:05d}.np'))
-            Y = torch.from_numpy(Y)
+            Y = torch.from_numpy(np.require(self._load('left_disparity', index), requirements='W'))
             Y_list.append(Y.unsqueeze(0))
             Y = torch.cat(Y_list, dim=0)
 
-        return X, Y, self.pass_info
+        if not self.use_uint8:
+            X = X.float() / 255
+        return X, Y.float(), self.pass_info
 
     def __len__(self):
         return self.size
 
+    def _load(self, name, index):
+        if self.use_packed:
+            return self.packed[name][index]
+        return utils.load(os.path.join(self.root, f'{name}/{index:05d}.np'))
+
     def _make_mask_index(self):
         self.mask_index = np.zeros(self.size, dtype=np.int)
 
@@ -137,9 +237,13 @@ class KITTI_2015(Dataset):
     # HEIGHT, WIDTH = 384, 1248
     # HEIGHT, WIDTH = 352, 1216  # GTX 2080 Ti
     # HEIGHT, WIDTH = 256, 1248  # GTX 1660 Ti
+
+    # left (3), right (3) and disparity (1) of the largest image
+    FRAME_SHAPE = (376, 1242, 7)
+
     def __init__(self, type='train', use_crop_size=False, crop_size=None, crop_seed=None,
                  use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None),
-                 untexture_rate=0):
+                 untexture_rate=0, cache_bytes=0, use_uint8=False):
 
         assert os.path.exists(self.get_root_directory()), 'Dataset path is not exist'
         assert use_crop_size + use_resize <= 1, 'Using one of the crop size and the resize'
@@ -160,6 +264,8 @@ class KITTI_2015(Dataset):
         self.use_padding_crop_size = use_padding_crop_size
         self.padding_crop_size = padding_crop_size
         self.untexture_rate = untexture_rate
+        self.cache = DecodedImageCache(cache_bytes, self.FRAME_SHAPE) if cache_bytes > 0 else None
+        self.use_uint8 = use_uint8
         self.pass_info = {}
 
     def __getitem__(self, index):
@@ -173,136 +279,86 @@ class KITTI_2015(Dataset):
 
                 X = np.concatenate([X1, X2], axis=2)
                 X = X.swapaxes(0, 2).swapaxes(1, 2)
-                X, Y = torch.from_numpy(X).float(), torch.from_numpy(Y)
+                X, Y = torch.from_numpy(X), torch.from_numpy(Y)
                 Y = Y.unsqueeze(0)
 
                 if self.use_crop_size:
                     cropper = utils.RandomCropper(X1.shape[0:2], self.crop_size, seed=self.crop_seed)
                     X, Y = cropper.crop(X), cropper.crop(Y)
-                X, Y = X.float() / 255, Y.float()
 
             else:
                 if self.use_resize:
-                    X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                    X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-                    Y = cv2.imread(os.path.join(self.root, 'disp_occ_0/{:06d}_10.png'.format(index)))  # (376, 1241, 3) uint8
-                    self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
+                    frame = self._read(index)
+                    self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
 
-                    X1 = cv2.resize(X1, (self.resize[1], self.resize[0]))
-                    X2 = cv2.resize(X2, (self.resize[1], self.resize[0]))
-
-                    X1 = utils.rgb2bgr(X1)
-                    X2 = utils.rgb2bgr(X2)
-
-                    X = np.concatenate([X1, X2], axis=2)  # batch, height, width, channel
+                    X = cv2.resize(frame[..., :6], (self.resize[1], self.resize[0]))
                     X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                    Y = Y[:, :, 0]
-                    X, Y = torch.from_numpy(X).float() / 255, torch.from_numpy(Y).float().unsqueeze(0)
+                    Y = frame[..., 6]
+                    X, Y = torch.from_numpy(X), torch.from_numpy(Y).unsqueeze(0)
 
                 elif self.use_crop_size:
-                    X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                    X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-                    Y = cv2.imread(os.path.join(self.root, 'disp_occ_0/{:06d}_10.png'.format(index)))  # (376, 1241, 3) uint8
-
-                    X1 = utils.rgb2bgr(X1)
-                    X2 = utils.rgb2bgr(X2)
-
-                    X = np.concatenate([X1, X2], axis=2)
-                    X = X.swapaxes(0, 2).swapaxes(1, 2)
+                    frame = self._read(index)
 
-                    Y = Y[:, :, 0]
-                    X, Y = torch.from_numpy(X).float() / 255, torch.from_numpy(Y).float().unsqueeze(0)
-
-                    cropper = utils.RandomCropper(X1.shape[0:2], self.crop_size, seed=self.crop_seed)
-                    X, Y = cropper.crop(X), cropper.crop(Y)
+                    # crop the uint8 frame before converting it
+                    cropper = utils.RandomCropper(frame.shape[0:2], self.crop_size, seed=self.crop_seed)
+                    frame = cropper.crop(frame.transpose(2, 0, 1))  # channel*2 + 1, height, width
+                    X, Y = torch.from_numpy(frame[:6]), torch.from_numpy(frame[6:])
 
                 elif self.use_padding_crop_size:
+                    frame = self._read(index)
 
-                    X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                    X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-                    Y = cv2.imread(os.path.join(self.root, 'disp_occ_0/{:06d}_10.png'.format(index)))  # (376, 1241, 3) uint8
-
-                    self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
+                    self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
                     assert self.pass_info['original_height'] <= self.padding_crop_size[0]
                     assert self.pass_info['original_width'] <= self.padding_crop_size[1]
 
-                    X1 = utils.rgb2bgr(X1)
-                    X2 = utils.rgb2bgr(X2)
-
-                    X1_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-                    X2_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-
-                    X1_pad[:X1.shape[0], :X1.shape[1], :] = X1[...]
-                    X2_pad[:X1.shape[0], :X1.shape[1], :] = X2[...]
-
-                    X1 = X1_pad
-                    X2 = X2_pad
-
-                    X = np.concatenate([X1, X2], axis=2)  # batch, height, width, channel
+                    X = np.zeros((*self.padding_crop_size, 6), dtype=np.uint8)
+                    X[:frame.shape[0], :frame.shape[1], :] = frame[..., :6]
                     X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                    Y = Y[:, :, 0]
-                    X, Y = torch.from_numpy(X).float() / 255, torch.from_numpy(Y).float().unsqueeze(0)
+                    Y = frame[..., 6]
+                    X, Y = torch.from_numpy(X), torch.from_numpy(Y).unsqueeze(0)
 
         elif self.type == 'test':
-            if self.use_resize:
-                X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
-
-                X1 = cv2.resize(X1, (self.resize_width, self.resize_height))
-                X2 = cv2.resize(X2, (self.resize_width, self.resize_height))
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
+            frame = self._read(index)
 
-                X = np.concatenate([X1, X2], axis=2)  # batch, height, width, channel
+            if self.use_resize:
+                self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
+                X = cv2.resize(frame, (self.resize[1], self.resize[0]))
                 X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                Y = torch.ones((1, X.size(1), X.size(2)), dtype=torch.float)
-
             elif self.use_crop_size:
-                X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
-
-                X = np.concatenate([X1, X2], axis=2)
-                X = X.swapaxes(0, 2).swapaxes(1, 2)
-
-                cropper = utils.RandomCropper(X1.shape[0:2], self.crop_size, seed=self.crop_seed)
-                X = cropper.crop(X)
-
-                Y = torch.ones((1, X.size(1), X.size(2)), dtype=torch.float)
+                cropper = utils.RandomCropper(frame.shape[0:2], self.crop_size, seed=self.crop_seed)
+                X = cropper.crop(frame.transpose(2, 0, 1))
 
             elif self.use_padding_crop_size:
-                X1 = cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))
-                X2 = cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
+                self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
                 assert self.pass_info['original_height'] <= self.padding_crop_size[0]
                 assert self.pass_info['original_width'] <= self.padding_crop_size[1]
 
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
-
-                X1_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-                X2_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-
-                X1_pad[:X1.shape[0], :X1.shape[1], :] = X1[...]
-                X2_pad[:X1.shape[0], :X1.shape[1], :] = X2[...]
+                X = np.zeros((*self.padding_crop_size, 6), dtype=np.uint8)
+                X[:frame.shape[0], :frame.shape[1], :] = frame
+                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                X1 = X1_pad
-                X2 = X2_pad
+            X = torch.from_numpy(X)
+            Y = torch.ones((1, X.size(1), X.size(2)), dtype=torch.float)
 
-                X = np.concatenate([X1, X2], axis=2)  # batch, height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-                X = torch.from_numpy(X).float() / 255
+        if not self.use_uint8:
+            X = X.float() / 255
+        return X, Y.float(), self.pass_info
 
-                Y = torch.ones((1, X.size(1), X.size(2)), dtype=torch.float)
+    def _read(self, index):
+        # left and right image in RGB, plus the disparity on the train set, as one (height, width, 7 or 6) frame
+        if self.cache is not None:
+            return self.cache.get(index, lambda: self._decode(index))
+        return self._decode(index)
 
-        return X, Y, self.pass_info
+    def _decode(self, index):
+        images = [cv2.imread(os.path.join(self.root, 'image_2/{:06d}_10.png'.format(index)))[..., ::-1],
+                  cv2.imread(os.path.join(self.root, 'image_3/{:06d}_10.png'.format(index)))[..., ::-1]]
+        if self.type == 'train':
+            images.append(cv2.imread(os.path.join(self.root, 'disp_occ_0/{:06d}_10.png'.format(index)))[..., :1])
+        return np.concatenate(images, axis=2)
 
     def get_root_directory(self):
         return f'F:\Dataset\KITTI 2015'
@@ -332,11 +388,12 @@ class KITTI_2015_benchmark(Dataset):
     # KITTI 2015 original height and width (375, 1242, 3), dtype uint8
     # height and width: (370, 1224) is the smallest size
 
-    def __init__(self, use_padding_crop_size=False, padding_crop_size=(None, None)):
+    def __init__(self, use_padding_crop_size=False, padding_crop_size=(None, None), use_uint8=False):
         assert os.path.exists(self.ROOT), 'Dataset path is not exist'
         self.root = os.path.join(self.ROOT, 'testing')
         self.use_padding_crop_size = use_padding_crop_size
         self.padding_crop_size = padding_crop_size
+        self.use_uint8 = use_uint8
         self.pass_info = {}
 
     def __getitem__(self, index):
@@ -360,11 +417,13 @@ class KITTI_2015_benchmark(Dataset):
 
         X = np.concatenate([X1, X2], axis=2)  # height, width, channel
         X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-        X = torch.from_numpy(X) / 255.0
+        X = torch.from_numpy(X)
 
         Y = torch.ones((1, self.pass_info['original_height'], self.pass_info['original_width']), dtype=torch.float)
 
-        return X, Y, self.pass_info
+        if not self.use_uint8:
+            X = X.float() / 255
+        return X, Y.float(), self.pass_info
 
     def __len__(self):
         return 200
@@ -378,8 +437,12 @@ class KITTI_Augmentation(Dataset):
     # width range = [1224, 1242]
     # height range = [370, 376]
 
+    # left (3), right (3) and disparity (1) of the largest image
+    FRAME_SHAPE = (376, 1242, 7)
+
     def __init__(self, type='train', shuffle_seed=0, use_crop_size=False, crop_size=None, crop_seed=None,
-                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None)):
+                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None),
+                 cache_bytes=0, use_uint8=False):
         assert os.path.exists(self.get_root_directory()), 'Dataset path is not exist'
         assert use_crop_size + use_resize + use_padding_crop_size == 1, 'Using one of methods to produce disparity'
         self.type = type
@@ -403,164 +466,63 @@ class KITTI_Augmentation(Dataset):
         self.crop_size = crop_size
         self.padding_crop_size = padding_crop_size
         self.crop_seed = crop_seed
+        self.cache = DecodedImageCache(cache_bytes, self.FRAME_SHAPE) if cache_bytes > 0 else None
+        self.use_uint8 = use_uint8
         self.pass_info = {}
 
     def __getitem__(self, index):
-        if self.type == 'train':
-            if self.use_resize:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_left_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_right_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'training/{self.get_disp_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
-
-                X1 = cv2.resize(X1, (self.resize[1], self.resize[0]))
-                X2 = cv2.resize(X2, (self.resize[1], self.resize[0]))
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
+        frame = self._read(index)
 
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float() / 255, torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
+        if self.use_resize:
+            self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
 
-            elif self.use_crop_size:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_left_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_right_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'training/{self.get_disp_image_folder()}/{self.files[self.train_indexes[index]]}'))
+            X = cv2.resize(frame[..., :6], (self.resize[1], self.resize[0]))
+            X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
+            Y = frame[..., 6]
+            X, Y = torch.from_numpy(X), torch.from_numpy(Y)
+            Y = Y.unsqueeze(0)
 
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float(), torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
+        elif self.use_crop_size:
+            # crop the uint8 frame before converting it
+            cropper = utils.RandomCropper(frame.shape[0:2], self.crop_size, seed=self.crop_seed)
+            frame = cropper.crop(frame.transpose(2, 0, 1))  # channel*2 + 1, height, width
+            X, Y = torch.from_numpy(frame[:6]), torch.from_numpy(frame[6:])
 
-                cropper = utils.RandomCropper(X1.shape[0:2], self.crop_size, seed=self.crop_seed)
-                X, Y = cropper.crop(X), cropper.crop(Y)
-                X, Y = X.float() / 255, Y.float()
-
-            elif self.use_padding_crop_size:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_left_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'training/{self.get_right_image_folder()}/{self.files[self.train_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'training/{self.get_disp_image_folder()}/{self.files[self.train_indexes[index]]}'))
-
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
-                assert self.pass_info['original_height'] <= self.padding_crop_size[0]
-                assert self.pass_info['original_width'] <= self.padding_crop_size[1]
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
-
-                X1_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-                X2_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-
-                X1_pad[:X1.shape[0], :X1.shape[1], :] = X1[...]
-                X2_pad[:X1.shape[0], :X1.shape[1], :] = X2[...]
-
-                X1 = X1_pad
-                X2 = X2_pad
-
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float(), torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
-                X, Y = X.float() / 255, Y.float()
-
-        elif self.type == 'test':
-            if self.use_resize:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_left_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_right_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'testing/{self.get_disp_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
-
-                X1 = cv2.resize(X1, (self.resize_width, self.resize_height))
-                X2 = cv2.resize(X2, (self.resize_width, self.resize_height))
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
-
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float() / 255, torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
-
-            elif self.use_crop_size:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_left_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_right_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'testing/{self.get_disp_image_folder()}/{self.files[self.test_indexes[index]]}'))
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
-
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
-
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float(), torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
-
-                cropper = utils.RandomCropper(X1.shape[0:2], self.crop_size, seed=self.crop_seed)
-                X, Y = cropper.crop(X), cropper.crop(Y)
-                X, Y = X.float() / 255, Y.float()
-
-            elif self.use_padding_crop_size:
-                X1 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_left_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                X2 = cv2.imread(os.path.join(self.get_root_directory(),
-                                             f'testing/{self.get_right_image_folder()}/{self.files[self.test_indexes[index]]}'))
-                Y = cv2.imread(os.path.join(self.get_root_directory(),
-                                            f'testing/{self.get_disp_image_folder()}/{self.files[self.test_indexes[index]]}'))
-
-                self.pass_info['original_height'], self.pass_info['original_width'] = X1.shape[:2]
-                assert self.pass_info['original_height'] < self.padding_crop_size[0]
-                assert self.pass_info['original_height'] < self.padding_crop_size[1]
-
-                X1 = utils.rgb2bgr(X1)
-                X2 = utils.rgb2bgr(X2)
+        elif self.use_padding_crop_size:
+            self.pass_info['original_height'], self.pass_info['original_width'] = frame.shape[:2]
+            assert self.pass_info['original_height'] <= self.padding_crop_size[0]
+            assert self.pass_info['original_width'] <= self.padding_crop_size[1]
 
-                X1_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
-                X2_pad = np.zeros((*self.padding_crop_size, 3), dtype=np.uint8)
+            X = np.zeros((*self.padding_crop_size, 6), dtype=np.uint8)
+            X[:frame.shape[0], :frame.shape[1], :] = frame[..., :6]
+            X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
 
-                X1_pad[:X1.shape[0], :X1.shape[1], :] = X1[...]
-                X2_pad[:X1.shape[0], :X1.shape[1], :] = X2[...]
+            Y = frame[..., 6]
+            X, Y = torch.from_numpy(X), torch.from_numpy(Y).unsqueeze(0)
 
-                X1 = X1_pad
-                X2 = X2_pad
+        if not self.use_uint8:
+            X = X.float() / 255
+        return X, Y.float(), self.pass_info
 
-                X = np.concatenate([X1, X2], axis=2)  # height, width, channel
-                X = X.swapaxes(0, 2).swapaxes(1, 2)  # channel*2, height, width
+    def _read(self, index):
+        # left and right image in RGB and the disparity as one (height, width, 7) uint8 frame
+        if self.type == 'train':
+            file_index = self.train_indexes[index]
+        else:
+            file_index = self.test_indexes[index]
 
-                Y = Y[:, :, 0]
-                X, Y = torch.from_numpy(X).float(), torch.from_numpy(Y)
-                Y = Y.unsqueeze(0)
-                X, Y = X.float() / 255, Y.float()
+        if self.cache is not None:
+            return self.cache.get(file_index, lambda: self._decode(file_index))
+        return self._decode(file_index)
 
-        return X, Y, self.pass_info
+    def _decode(self, file_index):
+        folder = os.path.join(self.get_root_directory(), 'training' if self.type == 'train' else 'testing')
+        file = self.files[file_index]
+        X1 = cv2.imread(os.path.join(folder, self.get_left_image_folder(), file))
+        X2 = cv2.imread(os.path.join(folder, self.get_right_image_folder(), file))
+        Y = cv2.imread(os.path.join(folder, self.get_disp_image_folder(), file))
+        return np.concatenate([X1[..., ::-1], X2[..., ::-1], Y[..., :1]], axis=2)
 
     def get_root_directory(self):
         return ''
@@ -593,12 +555,13 @@ class KITTI_Augmentation(Dataset):
 class KITTI_2015_Augmentation(KITTI_Augmentation):
 
     def __init__(self, type='train', shuffle_seed=0, use_crop_size=False, crop_size=None, crop_seed=None,
-                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None)):
+                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None),
+                 cache_bytes=0, use_uint8=False):
 
         super().__init__(type=type, use_crop_size=use_crop_size, crop_size=crop_size, crop_seed=crop_seed,
                          shuffle_seed=shuffle_seed, use_resize=use_resize, resize=resize,
                          use_padding_crop_size=use_padding_crop_size,
-                         padding_crop_size=padding_crop_size)
+                         padding_crop_size=padding_crop_size, cache_bytes=cache_bytes, use_uint8=use_uint8)
 
     def get_root_directory(self):
         return f'F:\Dataset\KITTI 2015 Data Augmentation'
@@ -626,12 +589,13 @@ class KITTI_2012_Augmentation(KITTI_Augmentation):
     ROOT = r'F:\Dataset\KITTI 2015 Data Augmentation'
 
     def __init__(self, type='train', shuffle_seed=0, use_crop_size=False, crop_size=None, crop_seed=None,
-                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None)):
+                 use_resize=False, resize=(None, None), use_padding_crop_size=False, padding_crop_size=(None, None),
+                 cache_bytes=0, use_uint8=False):
 
         super().__init__(type=type, use_crop_size=use_crop_size, crop_size=crop_size, crop_seed=crop_seed,
                          shuffle_seed=shuffle_seed, use_resize=use_resize, resize=resize,
                          use_padding_crop_size=use_padding_crop_size,
-                         padding_crop_size=padding_crop_size)
+                         padding_crop_size=padding_crop_size, cache_bytes=cache_bytes, use_uint8=use_uint8)
 
     def get_root_directory(self):
         return r'F:\Dataset\KITTI 2012 Data Augmentation'
@@ -705,6 +669,38 @@ class AerialImagery(Dataset):
         return 'AerialImagery'
 
 
+class TeacherCost(Dataset):
+    # cost volumes of a frozen cost volume model on fixed crops, written by build_teacher_cost in train_merge_net.py
+    # cost_left, cost_right: uint8 shards (disparity, height, width) quantized per pixel by utils.quantize_cost,
+    # cost_left_range, cost_right_range: float32 shards (2, height, width) of their offset and scale,
+    # disparity: float32 shards (height, width)
+    # X is returned as (2, disparity, height, width) float16, left and right stacked, Y as (1, height, width)
+    def __init__(self, root):
+        self.root = root
+        self.cost_left = PackedShards(root, 'cost_left')
+        self.cost_left_range = PackedShards(root, 'cost_left_range')
+        self.cost_right = PackedShards(root, 'cost_right')
+        self.cost_right_range = PackedShards(root, 'cost_right_range')
+        self.disparity = PackedShards(root, 'disparity')
+        self.pass_info = {}
+
+    def __getitem__(self, index):
+        X = torch.stack([
+            utils.dequantize_cost(torch.from_numpy(np.array(self.cost_left[index])),
+                                  torch.from_numpy(np.array(self.cost_left_range[index]))),
+            utils.dequantize_cost(torch.from_numpy(np.array(self.cost_right[index])),
+                                  torch.from_numpy(np.array(self.cost_right_range[index])))
+        ]).half()
+        Y = np.array(self.disparity[index])
+        return X, torch.from_numpy(Y).unsqueeze(0), self.pass_info
+
+    def __len__(self):
+        return len(self.disparity)
+
+    def __str__(self):
+        return 'TeacherCost'
+
+
 def random_subset(dataset, size, seed=None):
     assert size <= len(dataset), 'subset size cannot larger than dataset'
     np.random.seed(seed)
@@ -714,6 +710,24 @@ def random_subset(dataset, size, seed=None):
     return Subset(dataset, indexes)
 
 
+class RandomSubsetSampler(Sampler):
+    # random_subset for a persistent DataLoader, every epoch draws a new subset of size indexes
+    # so the loader and its workers are created once instead of once per epoch
+    def __init__(self, dataset, size, seed=None):
+        assert size <= len(dataset), 'subset size cannot larger than dataset'
+        self.length = len(dataset)
+        self.size = size
+        self.random = np.random.RandomState(seed)
+
+    def __iter__(self):
+        indexes = np.arange(self.length)
+        self.random.shuffle(indexes)
+        return iter(indexes[:self.size].tolist())
+
+    def __len__(self):
+        return self.size
+
+
 def random_split(dataset, train_ratio=0.8, seed=None):
     assert 0 <= train_ratio <= 1
     train_size = int(train_ratio * len(dataset))
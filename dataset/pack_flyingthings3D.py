@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import utils
+from dataset.dataset import FlyingThings3D
+
+# Pack the per sample pickles written by arrange_flyingthings3D.py into the shards read by
+# FlyingThings3D(use_packed=True), see dataset.PackedShards
+shard_size = 1000
+
+
+def pack(root, name, size):
+    save_path = os.path.join(root, 'packed')
+    os.makedirs(save_path, exist_ok=True)
+
+    first = utils.load(os.path.join(root, f'{name}/{0:05d}.np'))
+    index = np.zeros((size, 2), dtype=np.int64)
+
+    for shard_index, begin in enumerate(range(0, size, shard_size)):
+        count = min(shard_size, size - begin)
+        shard = np.lib.format.open_memmap(os.path.join(save_path, f'{name}-{shard_index:03d}.npy'), mode='w+',
+                                          dtype=first.dtype, shape=(count, *first.shape))
+        for slot in range(count):
+            data = utils.load(os.path.join(root, f'{name}/{begin + slot:05d}.np'))
+            assert data.shape == first.shape and data.dtype == first.dtype, \
+                f'{name}/{begin + slot:05d}.np does not match the fixed stride {first.shape} {first.dtype}'
+            shard[slot] = data
+            index[begin + slot] = shard_index, slot
+            print(f'process [{name}] {begin + slot + 1}/{size}')
+        shard.flush()
+        del shard
+
+    np.save(os.path.join(save_path, f'{name}-index.npy'), index)
+
+
+if __name__ == '__main__':
+    for data_type, size in [('TRAIN', 22390), ('TEST', 4370)]:
+        root = os.path.join(FlyingThings3D.ROOT, data_type)
+        for name in ['cleanpass', 'finalpass', 'left_disparity']:
+            pack(root, name, size)
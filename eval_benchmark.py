@@ -20,12 +20,14 @@ use_margin_prduce_disparity = False
 
 resize_height, resize_width = 352, 960  # KITTI, 2015 GTX 1660 Ti
 split_height, split_width = 352, 960  # KITTI, 2015 GTX 1660 Ti
+split_overlap = 32
+split_memory_budget = None  # bytes of CUDA memory for the tile batches, e.g. 4 * 2 ** 30, one tile at a time if None
 # split_height, split_width = 192, 1216  # KITTI 2015 GTX 1660 Ti
 margin_height, margin_width = 384, 1248  # KITTI 2015 GTX 1660 Ti
 
 assert use_split_prduce_disparity ^ use_margin_prduce_disparity ^ use_resize, 'Just can use one setting'
 
-used_profile = profile.GDNet_mdc6f()
+used_profile = profile.get_profile('GDNet_mdc6f')
 dataset = 'KITTI_2015_benchmark'
 
 model = used_profile.load_model(max_disparity, version)[1]
@@ -55,11 +57,9 @@ for batch_index, (X, Y, origin_height, origin_width) in enumerate(test_loader):
 
         if use_split_prduce_disparity:
             eval_dict = utils.split_prduce_disparity(used_profile, X, Y, dataset, max_disparity, split_height,
-                                                     split_width, merge_cost=merge_cost,
-                                                     lr_check=False,
-                                                     candidate=candidate,
-                                                     regression=True,
-                                                     penalize=False, slope=1, max_disparity_diff=1.5)
+                                                     split_width, overlap=split_overlap,
+                                                     memory_budget=split_memory_budget,
+                                                     merge_cost=merge_cost, regression=True)
         elif use_margin_prduce_disparity:
             eval_dict = used_profile.eval_cpu(X, Y, dataset, margin_height, margin_width, margin_full=0xff,
                                               merge_cost=merge_cost)
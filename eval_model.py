@@ -5,6 +5,7 @@ from profile import *
 from colorama import Style
 import profile
 import utils.cost_volume as cv
+from GDNet.module import CostVolume
 
 def main():
     # GTX 1660 TiTi
@@ -13,6 +14,11 @@ def main():
     version = 1200
     seed = 0
     merge_cost = True
+    dual_direction = True  # merge_cost: run both directions as one batch (about twice the memory)
+    sparse_regression = False  # regression on a window of k disparities around the argmax instead of all of them
+    lazy_cost_volume = False  # conv_start reads the cost volume a few disparities at a time instead of building all of it
+    use_amp = False  # float16 autocast on CUDA, bfloat16 on CPU, see test/compare_precision.py for the accuracy
+    sync_interval = 1  # batches between reads of the metrics on the host (one printed line each)
     use_crop_size = False
     use_resize = False
     use_padding_crop_size = True
@@ -31,10 +37,14 @@ def main():
     dataset_name = ['flyingthings3D', 'KITTI_2015', 'KITTI_2015_Augmentation', 'KITTI_2012_Augmentation',
                     'KITTI_2015_benchmark', 'AerialImagery'][2]
 
-    used_profile = profile.GDNet_sdc6f()
+    used_profile = profile.get_profile('GDNet_sdc6f')
     dataloader_kwargs = {'num_workers': 8, 'pin_memory': True, 'drop_last': True}
 
     model = used_profile.load_model(max_disparity, version)[1]
+    device = next(model.parameters()).device
+    for module in model.modules():
+        if isinstance(module, CostVolume):
+            module.lazy = lazy_cost_volume
     version, loss_history = used_profile.load_history(version)
     # torch.backends.cudnn.benchmark = True
 
@@ -46,11 +56,10 @@ def main():
     print('Using use crop size mode:', use_crop_size)
     print('Using use resize mode:', use_resize)
     print('Using use use padding crop size:', use_padding_crop_size)
+    print('Using mixed precision:', use_amp)
+    print('Using lazy cost volume:', lazy_cost_volume)
 
-    losses = []
-    error = []
-    confidence_error = []
-    total_eval = []
+    metrics = utils.MetricAccumulator(sync_interval)
     show_index_count = 0
     is_show = False
 
@@ -70,20 +79,22 @@ def main():
 
         if dataset_name == 'flyingthings3D':
             use_dataset = FlyingThings3D(max_disparity, type='test', use_crop_size=True, crop_size=(height, width),
-                                         crop_seed=0, image='finalpass')
+                                         crop_seed=0, image='finalpass', use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2015':
             use_dataset = KITTI_2015(type='train', use_crop_size=True, crop_size=(height, width), crop_seed=0,
-                                     untexture_rate=0)
+                                     untexture_rate=0, use_uint8=True)
             train_dataset, test_dataset = random_split(use_dataset, train_ratio=0.8, seed=seed)
 
         elif dataset_name == 'KITTI_2015_Augmentation':
-            use_dataset = KITTI_2015_Augmentation(type='test', use_crop_size=True, crop_size=(height, width), seed=0)
+            use_dataset = KITTI_2015_Augmentation(type='test', use_crop_size=True, crop_size=(height, width), seed=0,
+                                                  use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2012_Augmentation':
-            use_dataset = KITTI_2012_Augmentation(type='test', use_crop_size=True, crop_size=(height, width), seed=0)
+            use_dataset = KITTI_2012_Augmentation(type='test', use_crop_size=True, crop_size=(height, width), seed=0,
+                                                  use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'AerialImagery':
@@ -107,19 +118,22 @@ def main():
 
         if dataset_name == 'flyingthings3D':
             use_dataset = FlyingThings3D(max_disparity, type='test', use_resize=True,
-                                         resize=(height, width), image='finalpass')
+                                         resize=(height, width), image='finalpass', use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2015':
-            use_dataset = KITTI_2015(type='train', untexture_rate=0, use_resize=True, resize=(height, width))
+            use_dataset = KITTI_2015(type='train', untexture_rate=0, use_resize=True, resize=(height, width),
+                                     use_uint8=True)
             train_dataset, test_dataset = random_split(use_dataset, train_ratio=0.8, seed=seed)
 
         elif dataset_name == 'KITTI_2015_Augmentation':
-            use_dataset = KITTI_2015_Augmentation(type='test', use_resize=True, resize=(height, width), seed=0)
+            use_dataset = KITTI_2015_Augmentation(type='test', use_resize=True, resize=(height, width), seed=0,
+                                                  use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2012_Augmentation':
-            use_dataset = KITTI_2012_Augmentation(type='test', use_resize=True, resize=(height, width), seed=0)
+            use_dataset = KITTI_2012_Augmentation(type='test', use_resize=True, resize=(height, width), seed=0,
+                                                  use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         else:
@@ -139,26 +153,27 @@ def main():
 
         if dataset_name == 'flyingthings3D':
             use_dataset = FlyingThings3D(max_disparity, type='test', use_padding_crop_size=True,
-                                         padding_crop_size=(height, width), image='finalpass')
+                                         padding_crop_size=(height, width), image='finalpass', use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2015':
             use_dataset = KITTI_2015(type='train', untexture_rate=0, use_padding_crop_size=True,
-                                     padding_crop_size=(height, width))
+                                     padding_crop_size=(height, width), use_uint8=True)
             train_dataset, test_dataset = random_split(use_dataset, train_ratio=0.8, seed=seed)
 
         elif dataset_name == 'KITTI_2015_Augmentation':
             use_dataset = KITTI_2015_Augmentation(type='test', use_padding_crop_size=True,
-                                                  padding_crop_size=(height, width), shuffle_seed=0)
+                                                  padding_crop_size=(height, width), shuffle_seed=0, use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2012_Augmentation':
             use_dataset = KITTI_2012_Augmentation(type='test', use_padding_crop_size=True,
-                                                  padding_crop_size=(height, width), shuffle_seed=0)
+                                                  padding_crop_size=(height, width), shuffle_seed=0, use_uint8=True)
             test_dataset = random_subset(use_dataset, 30, seed=seed)
 
         elif dataset_name == 'KITTI_2015_benchmark':
-            use_dataset = KITTI_2015_benchmark(use_padding_crop_size=True, padding_crop_size=(height, width))
+            use_dataset = KITTI_2015_benchmark(use_padding_crop_size=True, padding_crop_size=(height, width),
+                                               use_uint8=True)
             test_dataset = use_dataset
 
         else:
@@ -172,8 +187,9 @@ def main():
         assert 1 <= show_index <= len(test_dataset)
 
     model.eval()
+    utils.tic()
     for batch_index, (X, Y, pass_info) in enumerate(test_loader):
-        X, Y = X.cuda(), Y.cuda()
+        X, Y = utils.to_device(X, Y, device)
         show_index_count += 1
 
         if plot_and_show_image and show_index is not None and show_index_count < show_index:
@@ -184,37 +200,36 @@ def main():
         if plot_and_save_image and is_show:
             exit()
 
-        with torch.no_grad():
-            utils.tic()
-
+        with torch.no_grad(), utils.autocast(device.type, use_amp):
             if isinstance(used_profile, profile.GDNet_class_regression_basic):
                 eval_dict = used_profile.eval(X, Y, pass_info, dataset_name, use_resize=use_resize,
                                               use_padding_crop_size=use_padding_crop_size,
-                                              merge_cost=merge_cost, regression=True,
+                                              merge_cost=merge_cost, dual_direction=dual_direction, regression=True,
                                               use_confidence_error_cost=use_confidence_error_cost,
-                                              use_candidate_error=use_candidate_error)
+                                              use_candidate_error=use_candidate_error,
+                                              sparse_regression=sparse_regression)
 
             elif isinstance(used_profile, profile.GDNet_disparity_regression_basic):
                 eval_dict = used_profile.eval(X, Y, pass_info, dataset_name, use_resize=use_resize,
                                               use_padding_crop_size=use_padding_crop_size)
 
-            time = utils.timespan_str(utils.toc(True))
-            loss_str = f'loss = {utils.threshold_color(eval_dict["epe_loss"])}{eval_dict["epe_loss"]:.3f}{Style.RESET_ALL}'
-            error_rate_str = f'{eval_dict["error_sum"] / eval_dict["total_eval"]:.2%}'
-            print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, error rate = {error_rate_str}')
-
-            losses.append(float(eval_dict["epe_loss"]))
-            error.append(float(eval_dict["error_sum"]))
-            total_eval.append(float(eval_dict["total_eval"]))
+            metrics.add(epe_loss=eval_dict['epe_loss'], error_sum=eval_dict['error_sum'],
+                        total_eval=eval_dict['total_eval'], CE_avg=eval_dict.get('CE_avg'))
 
-            if isinstance(used_profile, profile.GDNet_class_regression_basic):
-                confidence_error.append(float(eval_dict["CE_avg"]))
+            if metrics.ready(last=batch_index + 1 == len(test_loader)):
+                window = metrics.synchronize()
+                time = utils.timespan_str(utils.toc(True))
+                loss_str = f'loss = {utils.threshold_color(window["epe_loss"])}{window["epe_loss"]:.3f}{Style.RESET_ALL}'
+                error_rate_str = f'{window["error_sum"] / window["total_eval"]:.2%}'
+                print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, error rate = {error_rate_str}')
+                utils.tic()
 
-            if torch.isnan(eval_dict["epe_loss"]):
-                print('detect loss nan in testing')
-                exit(1)
+                if np.isnan(window['epe_loss']):
+                    print('detect loss nan in testing')
+                    exit(1)
 
             if plot_and_save_image:
+                error_rate_str = f'{eval_dict["error_sum"] / eval_dict["total_eval"]:.2%}'
                 plotter = utils.CostPlotter()
                 plotter.plot_image_disparity(X[0], Y[0, 0], dataset_name, eval_dict,
                                              max_disparity=max_disparity, use_resize=use_resize,
@@ -249,19 +264,20 @@ def main():
             # exit(0)
             # os.system('nvidia-smi')
 
-    print(f'avg loss = {np.array(losses).mean():.3f}')
-    print(f'std loss = {np.array(losses).std():.3f}')
-    print(f'avg error rates = {np.array(error).sum() / np.array(total_eval).sum():.2%}')
+    print(f'avg loss = {metrics.mean("epe_loss"):.3f}')
+    print(f'std loss = {metrics.std("epe_loss"):.3f}')
+    print(f'avg error rates = {metrics.rate():.2%}')
+    confidence_error = metrics.mean('CE_avg') if 'CE_avg' in metrics.sums else float('nan')
     if isinstance(used_profile, profile.GDNet_class_regression_basic):
-        print(f'avg confidence error = {np.array(confidence_error).mean():.3f}')
-    print('Number of test case:', len(losses))
+        print(f'avg confidence error = {confidence_error:.3f}')
+    print('Number of test case:', metrics.count)
     print('Excel format:')
     # print(f'v{version - 1}'
     #       f'{used_profile}\t{np.array(losses).mean():.3f}\t{np.array(losses).std():.3f}\t'
     #       f'{np.array(error).sum() / np.array(total_eval).sum():.2%}\t{np.array(confidence_error).mean():.3f}')
 
-    print(f'v{version - 1}\t{np.array(losses).mean():.3f}\t{np.array(losses).std():.3f}\t'
-          f'{np.array(error).sum() / np.array(total_eval).sum():.2%}\t{np.array(confidence_error).mean():.3f}')
+    print(f'v{version - 1}\t{metrics.mean("epe_loss"):.3f}\t{metrics.std("epe_loss"):.3f}\t'
+          f'{metrics.rate():.2%}\t{confidence_error:.3f}')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
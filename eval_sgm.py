@@ -5,6 +5,7 @@ import numpy as np
 import cv2
 import utils.cost_volume as cv
 from colorama import Style
+import os
 
 max_disparity = 192
 seed = 0
@@ -14,6 +15,7 @@ method = ['OpenCV', 'SAD', 'CENSUS_AVG', 'CENSUS_FIX', 'NCC']
 image = ['cleanpass', 'finalpass']
 lr_check = True
 max_disparity_diff = 1.5
+sgm_workers = os.cpu_count()  # OpenCV only, images of a batch are processed in parallel
 
 dataset = dataset[2]
 method = method[4]
@@ -45,54 +47,63 @@ elif dataset == 'AerialImagery':
 else:
     raise Exception('Cannot find dataset: ' + dataset)
 
-test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
+batch_size = sgm_workers if method == 'OpenCV' else 1
+test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
 losses = []
 error = []
 total_eval = []
 
 if method == 'OpenCV':
-    # sgm = utils.SGM(max_disparity=max_disparity, mode=cv2.STEREO_SGBM_MODE_SGBM)
-    sgm = utils.SGM(kernel_size, max_disparity=max_disparity, mode=cv2.STEREO_SGBM_MODE_HH)
+    # sgm = utils.SGM(max_disparity=max_disparity, mode=cv2.STEREO_SGBM_MODE_SGBM, num_workers=sgm_workers)
+    sgm = utils.SGM(kernel_size, max_disparity=max_disparity, mode=cv2.STEREO_SGBM_MODE_HH, num_workers=sgm_workers)
 else:
     sgm = cv.SGM(method, kernel_size, max_disparity, max_disparity_diff)
 
-for batch_index, (X, Y) in enumerate(test_loader):
-    plotter = utils.CostPlotter()
-    plotter.cost_volume_data = []
-
+for batch_index, (X_batch, Y_batch) in enumerate(test_loader):
     if method == 'OpenCV':
-        disp = sgm.process(X)
-        cost = None
+        disp_batch = sgm.process(X_batch, max_disparity_diff, lr_check=lr_check, device='cpu')
+        cost_batch = None
     else:
-        cost, disp = sgm.process(X, lr_check=lr_check)
-        plotter.cost_volume_data.append(cv.CostVolumeData('cost-' + method, cost, disp))
-
-    Y = Y[:, 0, :, :]
-    mask = utils.y_mask(Y, max_disparity, dataset)
-    mask = mask & (disp != -1)
-    loss = utils.EPE_loss(disp[mask], Y[mask])
-    error_sum = utils.error_rate(disp[mask], Y[mask], dataset)
-
-    error.append(float(error_sum))
-    total_eval.append(float(mask.float().sum()))
-
-    eval_dict = {
-        'disp': disp,
-        'epe_loss': loss,
-        'confidence_error': None,
-        'cost_left': cost,
-    }
-    error_rate_str = f'{error[-1] / total_eval[-1]:.2%}'
-
-    print(f'[{batch_index + 1}/{len(test_loader)}] loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}, error rate = {error_rate_str}')
-    losses.append(float(loss))
-
-    plotter.plot_image_disparity(X[0], Y[0], dataset, eval_dict,
-                                 max_disparity=max_disparity,
-                                 save_result_file=(f'SGM/{dataset}/{method}', batch_index, False,
-                                                   error_rate_str))
-    # exit(0)
+        cost_batch, disp_batch = sgm.process(X_batch, lr_check=lr_check)
+
+    for i in range(X_batch.size(0)):
+        X, Y, disp = X_batch[i:i + 1], Y_batch[i:i + 1], disp_batch[i:i + 1]
+        cost = cost_batch[i:i + 1] if cost_batch is not None else None
+        image_index = batch_index * batch_size + i
+        plotter = utils.CostPlotter()
+        plotter.cost_volume_data = []
+        if cost is not None:
+            plotter.cost_volume_data.append(cv.CostVolumeData('cost-' + method, cost, disp))
+
+        Y = Y[:, 0, :, :].to(disp.device)
+        mask = utils.y_mask(Y, max_disparity, dataset)
+        mask = mask & (disp != -1)
+        loss = utils.EPE_loss(disp[mask], Y[mask])
+        error_sum = utils.error_rate(disp[mask], Y[mask], dataset)
+
+        error.append(float(error_sum))
+        total_eval.append(float(mask.float().sum()))
+
+        eval_dict = {
+            'disp': disp,
+            'epe_loss': loss,
+            'confidence_error': None,
+            'cost_left': cost,
+        }
+        error_rate_str = f'{error[-1] / total_eval[-1]:.2%}'
+
+        print(f'[{image_index + 1}/{len(test_dataset)}] loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}, error rate = {error_rate_str}')
+        losses.append(float(loss))
+
+        plotter.plot_image_disparity(X[0], Y[0], dataset, eval_dict,
+                                     max_disparity=max_disparity,
+                                     save_result_file=(f'SGM/{dataset}/{method}', image_index, False,
+                                                       error_rate_str))
+        # exit(0)
+
+if method == 'OpenCV':
+    sgm.close()
 
 print(f'Method: {method}')
 print(f'Dataset: {dataset} {len(losses)} images')
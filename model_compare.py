@@ -12,7 +12,7 @@ seed = 0
 dataset = ['flyingthings3D', 'KITTI_2015']
 image = ['cleanpass', 'finalpass']
 
-used_profile = profile.GDNet_mdc6()
+used_profile = profile.get_profile('GDNet_mdc6')
 dataset = dataset[0]
 image = image[1]
 
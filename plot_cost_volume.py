@@ -21,7 +21,7 @@ method = ['SAD', 'CENSUS_AVG', 'CENSUS_FIX', 'NCC']
 image = ['cleanpass', 'finalpass']
 pixel = [(217, 756), (56, 1037), (189, 279)]
 
-used_profile = profile.GDNet_mdc6()
+used_profile = profile.get_profile('GDNet_mdc6')
 dataset = dataset[1]
 image = image[1]
 pixel = pixel[2]
@@ -26,15 +26,17 @@ trend_kernel = 1  # version (plot) + trend kernel = real model version, trend_ke
 trend_regression_size = 1  # to see the loss is decent or not, trend_regression_size = [1, n]
 trend_method = ['corr', 'regression'][1]
 epe = EPE_Loss()
-used_profile = profile.GDNet_sdc6f()
+used_profile = profile.get_profile('GDNet_sdc6f')
 start_version = 850  # start_version = [1, n]
 
-version, loss_history = used_profile.load_history(version)
-print('Number of epochs:', len(loss_history['test']))
+history = used_profile.read_history()
+if version is not None:
+    history = history[history['version'] <= version]
+print('Number of epochs:', len(history))
 print('Trend kernel size:', trend_kernel)
 print('Trend regression size:', trend_regression_size)
 
-if len(loss_history['test']) == 1:
+if len(history) == 1:
     marker = 'o'
 else:
     marker = 'o'
@@ -45,8 +47,9 @@ plt.xlabel('Epoch')
 plt.ylabel('EPE Loss')
 
 assert start_version >= 1 and isinstance(start_version, int)
-train_loss_history = loss_history['train'][start_version - 1:]
-test_loss_history = loss_history['test'][start_version - 1:]
+history = history[history['version'] >= start_version]
+train_loss_history = history['train_epe']
+test_loss_history = history['test_epe']
 print('Size of loss history:', len(train_loss_history))
 
 p_train = plt.plot(train_loss_history[(trend_kernel - 1):], label='Train', marker=marker)
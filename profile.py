@@ -1,42 +1,60 @@
-import GANet.GANet_small_deep as ganet_small_deep
-import GANet.GANet_small as ganet_small
-import GANet.GANet_deep as ganet_deep
-import GANet.GANet_md
-import GDNet.GDNet_mdc4
-import GDNet.GDNet_md6
-import GDNet.GDNet_mdc6
-import GDNet.GDNet_mdc6f
-import GDNet.GDNet_dc6
-import GDNet.GDNet_dc6f
-import GDNet.GDNet_sdc6
-import GDNet.GDNet_sdc6f
-import GDNet.GDNet_sd9c6
-import GDNet.GDNet_sd9d6
-import GDNet.GDNet_sd9c6f
-import GDNet.GDNet_fdc6
-import GDNet.GDNet_fdc6f
-import LEAStereo.LEAStereo
-import LEAStereo.LEAStereo_flip
-import MergeNet.MergeNet_d
 import os
+import importlib
 import cv2
 import utils
 import torch
 import torch.nn.functional as F
-import GDNet.module
-import GDNet.function
-import gdnet_lib
+
+
+class LazyModule:
+    # imported on the first attribute access, so a script only loads the model modules (and gdnet_lib)
+    # of the profile it uses, when its get_model runs
+    def __init__(self, name):
+        # underscores, GDNet.module has to reach __getattr__
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        if not hasattr(self._module, attr):
+            # sub module of a package, e.g. GDNet.GDNet_sdc6
+            importlib.import_module(f'{self._name}.{attr}')
+        return getattr(self._module, attr)
+
+
+GANet = LazyModule('GANet')
+GDNet = LazyModule('GDNet')
+LEAStereo = LazyModule('LEAStereo')
+MergeNet = LazyModule('MergeNet')
+ganet_small_deep = LazyModule('GANet.GANet_small_deep')
+ganet_small = LazyModule('GANet.GANet_small')
+ganet_deep = LazyModule('GANet.GANet_deep')
+gdnet_lib = LazyModule('gdnet_lib')
+
+
+def get_profile(name):
+    if name not in Profile.profiles:
+        raise Exception('Unknown profile: ' + name)
+    return Profile.profiles[name]()
 
 
 class Profile:
+    profiles = {}  # name: profile class, see get_profile
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Profile.profiles[cls.__name__] = cls
+
     def __init__(self):
         os.makedirs(self.version_file_path(), exist_ok=True)
         self.cost_count = None
+        self.checkpoint_writer = None  # utils.CheckpointWriter, save_version writes in the background
         assert '-' not in str(self)
 
     def load_model(self, max_disparity, version=None):
         # self.model = torch.nn.DataParallel(self.get_model(max_disparity)).cuda()
-        self.model = self.get_model(max_disparity).cuda()
+        self.model = self.get_model(max_disparity).to('cuda' if torch.cuda.is_available() else 'cpu')
         self.max_disparity = max_disparity
 
         if version is None:
@@ -52,7 +70,7 @@ class Profile:
 
             if os.path.exists(nn_file):
                 print('Load version model:', nn_file)
-                self.model.load_state_dict(torch.load(nn_file))
+                self.model.load_state_dict(torch.load(nn_file, map_location=next(self.model.parameters()).device))
             else:
                 raise Exception(f'Cannot find neural network file: {nn_file}')
 
@@ -75,21 +93,46 @@ class Profile:
             version = 1
         else:
             print('Using version:', version)
-            ht_file = self.history_file_name(version)
+            history = self.read_history()
+            if version not in history['version']:
+                ht_file = self.history_file_name(version)
+                if os.path.exists(ht_file):
+                    print('Import version history:', ht_file)
+                    self.history_log().import_ht(ht_file)
+                    history = self.read_history()
+                else:
+                    raise Exception(f'Cannot find version {version} in history file: {self.history_log().filename}')
 
-            if os.path.exists(ht_file):
-                print('Load version history:', ht_file)
-                loss_history = utils.load(ht_file)
-            else:
-                raise Exception(f'Cannot find history file: {ht_file}')
+            history = history[history['version'] <= version]
+            loss_history['train'] = history['train_epe'].tolist()
+            loss_history['test'] = history['test_epe'].tolist()
 
             version += 1
 
         return version, loss_history
 
-    def save_version(self, model, history, version):
-        torch.save(model.state_dict(), self.model_file_name(version))
-        utils.save(history, self.history_file_name(version))
+    def save_version(self, model, version, **history):
+        # history: the fields of utils.HistoryLog for this version
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(model, self.model_file_name(version), version, self.history_log(), **history)
+        else:
+            torch.save(model.state_dict(), self.model_file_name(version))
+            self.history_log().append(version, **history)
+
+    def history_log(self):
+        return utils.HistoryLog(os.path.join(self.version_file_path(), f'{self}.hist'))
+
+    def read_history(self):
+        # the .ht files of an old training run are imported the first time
+        history_log = self.history_log()
+        history = history_log.read()
+        if len(history) == 0:
+            version = utils.get_latest_version(self.version_file_path())
+            if version is not None and os.path.exists(self.history_file_name(version)):
+                print('Import version history:', self.history_file_name(version))
+                history_log.import_ht(self.history_file_name(version))
+                history = history_log.read()
+        return history
 
     def model_file_name(self, version):
         return os.path.join(self.version_file_path(), f'{self}-{version}.nn')
@@ -140,14 +183,8 @@ class GANet_small_deep(Profile):
         if lr_check:
             cost0, cost1, disp_left = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
 
-            flip_x = X[:, 0:3, :, :].data.cpu().numpy()
-            flip_y = X[:, 3:6, :, :].data.cpu().numpy()
-            flip_x = torch.tensor(flip_x[..., ::-1].copy()).cuda()
-            flip_y = torch.tensor(flip_y[..., ::-1].copy()).cuda()
-
-            disp_right = self.model(flip_y, flip_x)[2]
-            disp_right = disp_right.data.cpu().numpy()
-            disp_right = - torch.tensor(disp_right[..., ::-1].copy()).cuda()
+            disp_right = self.model(*GDNet.function.flip_stereo(X[:, 0:3, :, :], X[:, 3:6, :, :]))[2]
+            disp_right = - torch.flip(disp_right, dims=[-1])
 
             gdnet_lib.cuda_left_right_consistency_check(disp_left, disp_right, 1, max_disparity_diff)
 
@@ -221,6 +258,8 @@ class GDNet_class_regression(Profile):
         self.disparity = GDNet.module.DisparityRegression(max_disparity)
         self.squeeze_cost = GDNet.module.SqueezeCost()
         self.squeeze_cost_grad = GDNet.module.SqueezeCostByGradient()
+        self.squeeze_disparity = GDNet.module.SqueezeDisparityRegression()
+        self.sparse_disparity = GDNet.module.SparseDisparityRegression()
 
     def train(self, X, Y, dataset_name):
         Y = Y[:, 0, :, :]
@@ -262,9 +301,7 @@ class GDNet_class_regression(Profile):
         cost = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
 
         disp = torch.argmax(cost, dim=1)
-        cost = F.softmax(cost, dim=1)
-        squeeze_mask, cost = self.squeeze_cost_grad(cost, disp.float())
-        disp = self.disparity(cost)
+        disp, confidence = self.squeeze_disparity(cost, disp)
 
         mask = utils.y_mask(Y, self.max_disparity, dataset_name)
         epe_loss = utils.EPE_loss(disp[mask], Y[mask])
@@ -274,7 +311,8 @@ class GDNet_class_regression(Profile):
             'error_sum': error_sum,
             'total_eval': mask.float().sum(),
             'epe_loss': epe_loss,
-            'cost': cost,
+            'cost': None,
+            'confidence': confidence,
             'disp': disp.float(),
         }
 
@@ -430,18 +468,28 @@ class GDNet_class_regression_basic(GDNet_class_regression):
 
     def eval(self, X, Y, pass_info, dataset_name, merge_cost=True, regression=True, use_candidate_error=False,
              use_candidate_adjustment=False, use_confidence_error_cost=False, deleting_candidate_error_region=False,
-             use_resize=False, use_padding_crop_size=False):
+             use_resize=False, use_padding_crop_size=False, dual_direction=False, sparse_regression=False):
         assert not self.model.training
         Y = Y[:, 0, :, :]
 
         # Calculate cost
         self.model.flip = False
-        cost_left = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
+        if merge_cost and dual_direction:
+            # the flipped pass (left = flipped right image, right = flipped left image) is stacked on the batch
+            # axis, so every trunk and the aggregation run once for both directions
+            batch = X.size(0)
+            left, right = X[:, 0:3, :, :], X[:, 3:6, :, :]
+            flip_left, flip_right = GDNet.function.flip_stereo(left, right)
+            cost = self.model(torch.cat([left, flip_left]), torch.cat([right, flip_right]))
+            cost_left, cost_right = cost[:batch], cost[batch:]
+        else:
+            cost_left = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
 
         cost_process_left = cost_left
         if merge_cost:
-            self.model.flip = True
-            cost_right = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
+            if not dual_direction:
+                self.model.flip = True
+                cost_right = self.model(X[:, 0:3, :, :], X[:, 3:6, :, :])
             cost_process_right = cost_right
 
         # Merge cost & Argmax disparity
@@ -467,13 +515,19 @@ class GDNet_class_regression_basic(GDNet_class_regression):
             disp_max_left = torch.argmax(cost_process_left, dim=1).float()
 
         # Suppress Regression
-        if regression:
+        squeeze_mask = None
+        if regression and use_candidate_error:
+            # the candidate error needs the squeeze mask itself
             if merge_cost:
                 cost = F.softmax(cost_merge, dim=1)
             else:
                 cost = F.softmax(cost_left, dim=1)
             squeeze_mask, cost = self.squeeze_cost_grad(cost, disp_max_left)
             disp_left = self.disparity(cost)
+        elif regression and sparse_regression:
+            disp_left = self.sparse_disparity(cost_merge if merge_cost else cost_left, disp_max_left)
+        elif regression:
+            disp_left = self.squeeze_disparity(cost_merge if merge_cost else cost_left, disp_max_left)[0]
         else:
             disp_left = disp_max_left
 
@@ -488,9 +542,7 @@ class GDNet_class_regression_basic(GDNet_class_regression):
                 disp_max_left = torch.argmax(cost_merge, dim=1).float()
                 disp_max_left_2 = torch.argmax(cost_merge * (squeeze_mask == 0), dim=1).float()
                 disp_max_left[mask] = disp_max_left_2[mask]
-                cost = F.softmax(cost_merge, dim=1)
-                cost = self.squeeze_cost_grad(cost, disp_max_left.float())[1]
-                disp_left = self.disparity(cost)
+                disp_left = self.squeeze_disparity(cost_merge, disp_max_left)[0]
 
             if deleting_candidate_error_region:
                 disp_left[(candidate_error > 0.4) | (confidence_error > 0.3)] = 0
@@ -504,12 +556,12 @@ class GDNet_class_regression_basic(GDNet_class_regression):
             assert disp_left.size(0) == 1
             disp_left = disp_left[0].data.cpu().numpy()
             disp_left = cv2.resize(disp_left, (pass_info['original_width'], pass_info['original_height']))
-            disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+            disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
         elif use_padding_crop_size:
             assert disp_left.size(0) == 1
             disp_left = disp_left[0].data.cpu().numpy()[:pass_info['original_height'], :pass_info['original_width']]
-            disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+            disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
         epe_loss = utils.EPE_loss(disp_left[mask], Y[mask])
         error_sum = utils.error_rate(disp_left[mask], Y[mask], dataset_name)
@@ -577,17 +629,18 @@ class GDNet_class_regression_basic(GDNet_class_regression):
 
         # Suppress Regression
         if regression:
-            if merge_cost:
-                cost = F.softmax(cost_merge, dim=1)
+            if candidate:
+                if merge_cost:
+                    cost = F.softmax(cost_merge, dim=1)
+                else:
+                    cost = F.softmax(cost_left, dim=1)
+                squeeze_mask, cost = self.squeeze_cost_grad(cost, disp_max_left)
+                disp_left = self.disparity(cost)
             else:
-                cost = F.softmax(cost_left, dim=1)
-            squeeze_mask, cost = self.squeeze_cost_grad(cost, disp_max_left)
-            disp_left = self.disparity(cost)
+                disp_left = self.squeeze_disparity(cost_merge if merge_cost else cost_left, disp_max_left)[0]
 
             if lr_check:
-                cost = F.softmax(cost_right, dim=1)
-                cost = self.squeeze_cost_grad(cost, disp_max_right)[1]
-                disp_right = self.disparity(cost)
+                disp_right = self.squeeze_disparity(cost_right, disp_max_right)[0]
 
         else:
             disp_left = disp_max_left
@@ -599,8 +652,7 @@ class GDNet_class_regression_basic(GDNet_class_regression):
 
         # Left-Right consistency check
         if lr_check:
-            disp_right = disp_right.data.cpu().numpy()
-            disp_right = - torch.tensor(disp_right[..., ::-1].copy()).cuda()
+            disp_right = - torch.flip(disp_right, dims=[-1])
             gdnet_lib.cuda_left_right_consistency_check(disp_left, disp_right, max_disparity_diff)
 
         # Evaluation
@@ -615,13 +667,7 @@ class GDNet_class_regression_basic(GDNet_class_regression):
                 disp_max = torch.argmax(cost_process_left * (squeeze_mask == 0), dim=1)
 
             if regression:
-                if merge_cost:
-                    cost = F.softmax(cost_merge, dim=1)
-                else:
-                    cost = F.softmax(cost_left, dim=1)
-
-                cost = self.squeeze_cost_grad(cost, disp_max.float())[1]
-                disp_left_2 = self.disparity(cost)
+                disp_left_2 = self.squeeze_disparity(cost_merge if merge_cost else cost_left, disp_max)[0]
             else:
                 disp_left_2 = disp_max
 
@@ -635,11 +681,11 @@ class GDNet_class_regression_basic(GDNet_class_regression):
             if use_resize:
                 disp_left = disp_left[0].data.cpu().numpy()
                 disp_left = cv2.resize(disp_left, (use_dataset.original_width, use_dataset.original_height))
-                disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+                disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
             elif use_padding_crop_size:
                 disp_left = disp_left[0].data.cpu().numpy()[:use_dataset.original_height, :use_dataset.original_width]
-                disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+                disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
             epe_loss = utils.EPE_loss(disp_left[mask], Y[mask])
             error_sum = utils.error_rate(disp_left[mask], Y[mask], dataset)
@@ -682,9 +728,7 @@ class GDNet_class_regression_basic(GDNet_class_regression):
             disp_max_left = torch.argmax(cost_merge, dim=1).float()
 
             # Suppress Regression
-            cost = F.softmax(cost_merge, dim=1)
-            squeeze_mask, cost = self.squeeze_cost_grad(cost, disp_max_left)
-            disp_left = self.disparity(cost)
+            disp_left = self.squeeze_disparity(cost_merge, disp_max_left)[0]
 
         # Evaluation
         mask = utils.y_mask(Y, self.max_disparity, dataset)
@@ -722,11 +766,11 @@ class GDNet_disparity_regression_basic(GDNet_disparity_regression):
         if use_resize:
             disp_left = disp_left[0].data.cpu().numpy()
             disp_left = cv2.resize(disp_left, (pass_info['original_width'], pass_info['original_height']))
-            disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+            disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
         elif use_padding_crop_size:
             disp_left = disp_left[0].data.cpu().numpy()[:pass_info['original_height'], :pass_info['original_width']]
-            disp_left = torch.from_numpy(disp_left).unsqueeze(0).cuda()
+            disp_left = torch.from_numpy(disp_left).unsqueeze(0).to(Y.device)
 
         epe_loss = utils.EPE_loss(disp_left[mask], Y[mask])
         error_sum = utils.error_rate(disp_left[mask], Y[mask], dataset_name)
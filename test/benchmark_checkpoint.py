@@ -0,0 +1,57 @@
+import time
+import torch
+import GDNet.GDNet_sdc6f
+from GDNet.function import set_checkpoint
+
+# one training step of GDNet_sdc6f with and without checkpointing of the cost aggregation blocks
+# saved: bytes held for backward (unique storages), peak: torch.cuda.max_memory_allocated on CUDA
+repeat = 3
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+if device.type == 'cuda':
+    height, width, max_disparity = 192, 576, 192  # train_model.py crop
+else:
+    height, width, max_disparity = 128, 256, 96
+
+
+def saved_bytes(model, X, Y):
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        outputs = model(X, Y)
+    del outputs
+    return sum(storages.values())
+
+
+def benchmark(name, model, X, Y):
+    saved = saved_bytes(model, X, Y)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.time()
+    for _ in range(repeat):
+        model.zero_grad()
+        outputs = model(X, Y)
+        sum(o.mean() for o in outputs).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = f', peak {torch.cuda.max_memory_allocated() / 2 ** 20:8.1f} MB'
+    else:
+        peak = ''
+    print(f'{name:<12} step {(time.time() - start) / repeat * 1000:10.1f} ms, saved {saved / 2 ** 20:8.1f} MB{peak}')
+
+
+if __name__ == '__main__':
+    model = GDNet.GDNet_sdc6f.GDNet_sdc6f(max_disparity).to(device).train()
+    X = torch.rand((1, 3, height, width), device=device)
+    Y = torch.rand((1, 3, height, width), device=device)
+
+    print(f'device: {device}, image size: {(height, width)}, max disparity: {max_disparity}')
+    benchmark('default', model, X, Y)
+    set_checkpoint(model)
+    benchmark('checkpoint', model, X, Y)
@@ -0,0 +1,63 @@
+import time
+import torch
+from GDNet.module import build_cost_volume, CostVolume, BasicConv
+
+# KITTI crop 384x1280, features at 1/4 resolution, max_disparity 192/4 = 48
+batch = 1
+feature = 32
+height = 384 // 4
+width = 1280 // 4
+max_disparity = 192 // 4
+repeat = 20
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def loop_cost_volume(x, y, D):
+    B, F, H, W = x.size()
+    cost = torch.zeros((B, F * 2, D, H, W)).to(x.device)
+    for i in range(D):
+        if i > 0:
+            cost[:, :F, i, :, i:] = x[:, :, :, i:]
+            cost[:, F:, i, :, i:] = y[:, :, :, :-i]
+        else:
+            cost[:, :F, i, :, :] = x
+            cost[:, F:, i, :, :] = y
+    return cost
+
+
+def benchmark(name, build):
+    build()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        build()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    message = f'{name:<20} {(time.time() - start) / repeat * 1000:8.2f} ms'
+    if device.type == 'cuda':
+        message += f', peak {torch.cuda.max_memory_allocated() / 2 ** 20:8.1f} MB'
+        torch.cuda.reset_peak_memory_stats()
+    print(message)
+
+
+x = torch.randn((batch, feature, height, width), device=device)
+y = torch.randn((batch, feature, height, width), device=device)
+out = build_cost_volume(x, y, max_disparity)
+
+assert torch.equal(loop_cost_volume(x, y, max_disparity), out)
+
+print(f'device: {device}, volume: {tuple(out.size())}')
+benchmark('loop', lambda: loop_cost_volume(x, y, max_disparity))
+benchmark('build', lambda: build_cost_volume(x, y, max_disparity))
+benchmark('build (reuse out)', lambda: build_cost_volume(x, y, max_disparity, out))
+
+# concat + conv_start, full volume against the lazy volume built in disparity chunks (checked in module_test.py)
+conv_start = BasicConv(feature * 2, feature, is_3d=True, kernel_size=3, padding=1, relu=False).to(device).eval()
+cost_volume = CostVolume(max_disparity)
+lazy_cost_volume = CostVolume(max_disparity, lazy=True, chunk_size=8)
+del out
+with torch.no_grad():
+    benchmark('conv_start', lambda: conv_start(cost_volume(x, y)))
+    benchmark('conv_start (lazy)', lambda: conv_start(lazy_cost_volume(x, y)))
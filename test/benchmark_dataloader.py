@@ -0,0 +1,49 @@
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from dataset.dataset import random_subset, RandomSubsetSampler
+
+# one DataLoader per epoch (random_subset) against one persistent loader (RandomSubsetSampler)
+# the samples are cheap, so the epoch time is mostly the worker startup
+# use context = 'spawn' to see the Windows cost, where every worker imports torch, cv2 and the dataset again
+num_workers = 8
+context = 'fork'
+epochs = 5
+train_size = 192
+
+
+class RandomCrop(Dataset):
+    def __len__(self):
+        return 3840
+
+    def __getitem__(self, index):
+        X = torch.from_numpy(np.random.randint(0, 256, (6, 192, 576), dtype=np.uint8))
+        Y = torch.zeros((1, 192, 576), dtype=torch.uint8)
+        return X, Y
+
+
+def run(name, make_loader):
+    times = []
+    first = []
+    loader = None
+    for epoch in range(epochs):
+        start = time.time()
+        loader = make_loader(loader)
+        for batch_index, (X, Y) in enumerate(loader):
+            if batch_index == 0:
+                first.append(time.time() - start)
+        times.append(time.time() - start)
+    print(f'{name:<12} epoch {np.mean(times[1:]) * 1000:8.1f} ms, '
+          f'first batch {np.mean(first[1:]) * 1000:8.1f} ms (after the first epoch)')
+    return np.mean(times[1:])
+
+
+if __name__ == '__main__':
+    dataset = RandomCrop()
+    kwargs = {'batch_size': 1, 'num_workers': num_workers, 'drop_last': True, 'multiprocessing_context': context}
+
+    fresh = run('fresh', lambda loader: DataLoader(random_subset(dataset, train_size), **kwargs))
+    persistent = run('persistent', lambda loader: loader or DataLoader(
+        dataset, sampler=RandomSubsetSampler(dataset, train_size), persistent_workers=True, **kwargs))
+    print(f'saved {(fresh - persistent) * 1000:.1f} ms per epoch and loader')
@@ -0,0 +1,37 @@
+import time
+import torch
+from MergeNet.MergeNet_d import MergeNet_d
+
+# direct Conv1d stack against the GEMM path of MergeNet_d, eval on a block of pixels
+max_disparity = 192
+height, width = 32, 128
+repeat = 5
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def benchmark(name, model, cost1, cost2):
+    with torch.no_grad():
+        model(cost1, cost2)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            disp = model(cost1, cost2)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    print(f'{name:<8} {(time.time() - start) / repeat * 1000:10.2f} ms')
+    return disp
+
+
+direct = MergeNet_d(max_disparity, use_gemm=False).to(device).eval()
+gemm = MergeNet_d(max_disparity, use_gemm=True).to(device).eval()
+gemm.load_state_dict(direct.state_dict())
+
+cost1 = torch.randn((1, 1, max_disparity, height, width), device=device)
+cost2 = torch.randn((1, 1, max_disparity, height, width), device=device)
+
+print(f'device: {device}, pixels: {height * width}')
+disp = benchmark('direct', direct, cost1, cost2)
+gemm_disp = benchmark('gemm', gemm, cost1, cost2)
+print(f'max difference: {(disp - gemm_disp).abs().max().item():.3e}')
@@ -0,0 +1,63 @@
+import copy
+import unittest
+import torch
+from GDNet.basic import Conv2x
+from GDNet.module import GD6_Block
+from GDNet.function import set_checkpoint, checkpoint_module
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def check(self, model, *inputs):
+        checkpoint_model = copy.deepcopy(model)
+        set_checkpoint(checkpoint_model)
+
+        results = []
+        for m in [model, checkpoint_model]:
+            args = [x.clone().requires_grad_() for x in inputs]
+            m(*args).sum().backward()
+            results.append(([x.grad for x in args], [p.grad for p in m.parameters()], list(m.buffers())))
+
+        for a, b in zip(*results):
+            for x, y in zip(a, b):
+                self.assertTrue(torch.allclose(x.float(), y.float(), atol=1e-5))
+
+    def test_gd6_block(self):
+        torch.manual_seed(0)
+        model = GD6_Block(4, 3).train()
+        x = torch.randn((2, 4, 3, 5, 6))
+        g = torch.rand((2, 4 * 6 * 10, 5, 6))
+        self.check(model, x, g)
+
+    def test_conv2x(self):
+        torch.manual_seed(1)
+        model = Conv2x(4, 2, deconv=True, is_3d=True).train()
+        self.check(model, torch.randn((2, 4, 2, 3, 4)), torch.randn((2, 2, 4, 6, 8)))
+
+    def test_autocast(self):
+        # the recompute in backward runs outside the autocast block, like the .backward() of train_model.py
+        torch.manual_seed(2)
+        model = torch.nn.Sequential(torch.nn.Conv3d(4, 4, 3, padding=1), torch.nn.ReLU(),
+                                    torch.nn.Conv3d(4, 2, 3, padding=1))
+        x = torch.randn((2, 4, 3, 5, 6))
+
+        grads = []
+        for checkpoint in [False, True]:
+            model.zero_grad()
+            args = x.clone().requires_grad_()
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                y = checkpoint_module(model, model, args) if checkpoint else model(args)
+            self.assertEqual(y.dtype, torch.bfloat16)
+            (y.float() * torch.linspace(-1, 1, y.numel()).view(y.size())).sum().backward()
+            grads.append([args.grad] + [p.grad.clone() for p in model.parameters()])
+
+        for a, b in zip(*grads):
+            self.assertTrue(torch.equal(a, b))
+
+    def test_set_checkpoint(self):
+        model = torch.nn.ModuleList([GD6_Block(4, 3), Conv2x(4, 2, is_3d=True), Conv2x(4, 2)])
+        set_checkpoint(model)
+        self.assertEqual([m.checkpoint for m in model], [True, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
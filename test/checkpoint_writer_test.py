@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+import torch
+import utils
+
+
+class CheckpointWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.history_log = utils.HistoryLog(os.path.join(self.dir.name, 'model.hist'))
+        self.model = torch.nn.Linear(3, 2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def filename(self, version):
+        return os.path.join(self.dir.name, f'model-{version}.nn')
+
+    def test_snapshot(self):
+        writer = utils.CheckpointWriter(max_pending=1)
+        weight = self.model.weight.detach().clone()
+        writer.save(self.model, self.filename(1), 1, self.history_log, test_epe=1.0)
+        with torch.no_grad():
+            self.model.weight.add_(1)  # the next version trains while the file is written
+        writer.close()
+
+        self.assertTrue(torch.equal(torch.load(self.filename(1))['weight'], weight))
+        self.assertEqual(self.history_log.read()['version'].tolist(), [1])
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ['model-1.nn', 'model.hist'])
+
+    def test_keep_every(self):
+        writer = utils.CheckpointWriter(keep_every=3)
+        test_epe = [5, 4, 1, 3, 3, 3, 2, 2]
+        for version, epe in enumerate(test_epe, 1):
+            writer.save(self.model, self.filename(version), version, self.history_log, test_epe=epe)
+        writer.flush()
+        kept = [v for v in range(1, 9) if os.path.exists(self.filename(v))]
+        self.assertEqual(kept, [3, 6, 8])  # best, every 3rd, latest
+        self.assertEqual(len(self.history_log), 8)
+        writer.close()
+
+    def test_error(self):
+        writer = utils.CheckpointWriter()
+        writer.save(self.model, os.path.join(self.dir.name, 'missing', 'model-1.nn'), 1, self.history_log)
+        with self.assertRaises(Exception):
+            writer.flush()
+        self.assertEqual(len(self.history_log), 0)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
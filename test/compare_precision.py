@@ -0,0 +1,67 @@
+import time
+import numpy as np
+import torch
+import utils
+import profile
+from dataset.dataset import KITTI_2015_Augmentation, random_subset
+
+# float32 against autocast (float16 on CUDA, bfloat16 on CPU) on a fixed KITTI subset
+# every run uses the same 10 crops (seed 0), the model is a trained GDNet_sdc6f version from ./model
+# the whole eval_model.py path (profile eval: merged cost, squeezed regression) runs under autocast
+# no trained version was available so far, the only numbers come from a smoke test on random weights and inputs
+max_disparity = 192
+version = 1200
+seed = 0
+size = 10
+dataset_name = 'KITTI_2015_Augmentation'
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+if device.type == 'cuda':
+    height, width = 320, 1216  # eval_model.py crop of GDNet_sdc6f
+else:
+    height, width = 192, 576  # train_model.py crop, the full crop does not fit most CPU machines
+
+
+def evaluate(used_profile, X, Y, pass_info, amp):
+    # eval_model.py defaults: merge_cost, dual_direction, squeezed regression
+    start = time.time()
+    with torch.no_grad(), utils.autocast(device.type, amp):
+        eval_dict = used_profile.eval(X, Y, pass_info, dataset_name, merge_cost=True, dual_direction=True,
+                                      regression=True)
+    return {
+        'disp': eval_dict['disp'],
+        'argmax': torch.argmax(eval_dict['cost_merge'], dim=1),
+        'epe_loss': float(eval_dict['epe_loss']),
+        'error_sum': float(eval_dict['error_sum']),
+        'total_eval': float(eval_dict['total_eval']),
+        'time': time.time() - start,
+    }
+
+
+if __name__ == '__main__':
+    used_profile = profile.get_profile('GDNet_sdc6f')
+    used_profile.load_model(max_disparity, version)[1].eval()
+
+    use_dataset = KITTI_2015_Augmentation(type='test', use_crop_size=True, crop_size=(height, width), seed=0,
+                                          use_uint8=True)
+    test_dataset = random_subset(use_dataset, size, seed=seed)
+
+    print(f'device: {device}, autocast: {amp_dtype}, image size: {(height, width)}, version: {version}')
+    results = {False: [], True: []}
+    for index in range(len(test_dataset)):
+        X, Y, pass_info = test_dataset[index]
+        X, Y = utils.to_device(X.unsqueeze(0), Y.unsqueeze(0), device)
+
+        for amp in [False, True]:
+            results[amp].append(evaluate(used_profile, X, Y, pass_info, amp))
+        full, half = results[False][-1], results[True][-1]
+        print(f'[{index + 1}/{len(test_dataset)}] epe {full["epe_loss"]:.3f} / {half["epe_loss"]:.3f}, '
+              f'max disparity difference {(full["disp"] - half["disp"]).abs().max():.3f}, '
+              f'argmax changed {(full["argmax"] != half["argmax"]).float().mean():.2%}')
+
+    for amp, name in [(False, 'float32'), (True, str(amp_dtype).replace('torch.', ''))]:
+        epe_loss = np.mean([r['epe_loss'] for r in results[amp]])
+        error_rate = np.sum([r['error_sum'] for r in results[amp]]) / np.sum([r['total_eval'] for r in results[amp]])
+        time_span = np.mean([r['time'] for r in results[amp]])
+        print(f'{name:<10} epe loss = {epe_loss:.3f}, error rate = {error_rate:.2%}, {time_span * 1000:.1f} ms')
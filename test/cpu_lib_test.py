@@ -0,0 +1,354 @@
+import unittest
+import torch
+from GDNet import cpu_lib
+from GDNet.function import SgaFunction, LgaFunction, GD4_Function, GD6_Function
+
+# Slow per-pixel ports of the CUDA kernels in GDNet/extensions/cuda_kernel.cu
+
+# direction: (row_offset, col_offset)
+SGA_OFFSETS = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+
+
+def sga_scanlines(direction, height, width):
+    row_offset, col_offset = SGA_OFFSETS[direction]
+    if row_offset == 0:
+        cols = list(range(width)) if col_offset > 0 else list(range(width - 1, -1, -1))
+        return [[(r, c) for c in cols] for r in range(height)]
+    else:
+        rows = list(range(height)) if row_offset > 0 else list(range(height - 1, -1, -1))
+        return [[(r, c) for r in rows] for c in range(width)]
+
+
+def reference_sga_forward(cost, weight):
+    batch, channels, max_disparity, height, width = cost.size()
+    agg = torch.zeros((batch, channels, 4, max_disparity, height, width), dtype=cost.dtype)
+    max_index = torch.zeros((batch, channels, 4, height, width), dtype=torch.long)
+    for b in range(batch):
+        for ch in range(channels):
+            for dr in range(4):
+                for line in sga_scanlines(dr, height, width):
+                    for i, (r, c) in enumerate(line):
+                        w = weight[b, ch, dr, :, r, c]
+                        for d in range(max_disparity):
+                            s = cost[b, ch, d, r, c] * w[0]
+                            if i > 0:
+                                pr, pc = line[i - 1]
+                                pre = agg[b, ch, dr, :, pr, pc]
+                                s = s + pre[d] * w[1] + pre[max_index[b, ch, dr, pr, pc]] * w[4]
+                                if d > 0:
+                                    s = s + pre[d - 1] * w[2]
+                                if d < max_disparity - 1:
+                                    s = s + pre[d + 1] * w[3]
+                            agg[b, ch, dr, d, r, c] = s
+                        values = agg[b, ch, dr, :, r, c].tolist()
+                        max_index[b, ch, dr, r, c] = values.index(max(values))
+    return agg, max_index
+
+
+def reference_sga_backward(cost, agg, weight, max_index, grad_output):
+    batch, channels, max_disparity, height, width = cost.size()
+    cost_grad = torch.zeros_like(cost)
+    weight_grad = torch.zeros_like(weight)
+    for b in range(batch):
+        for ch in range(channels):
+            for dr in range(4):
+                grad_agg = torch.zeros((max_disparity, height, width), dtype=cost.dtype)
+                for line in sga_scanlines(dr, height, width):
+                    for i in range(len(line) - 1, -1, -1):
+                        r, c = line[i]
+                        w = weight[b, ch, dr, :, r, c]
+                        for d in range(max_disparity):
+                            total = grad_output[b, ch, dr, d, r, c] + grad_agg[d, r, c]
+                            cost_grad[b, ch, d, r, c] += total * w[0]
+                            weight_grad[b, ch, dr, 0, r, c] += total * cost[b, ch, d, r, c]
+                            if i == 0:
+                                continue
+                            pr, pc = line[i - 1]
+                            m = max_index[b, ch, dr, pr, pc]
+                            pre = agg[b, ch, dr, :, pr, pc]
+                            grad_agg[d, pr, pc] += total * w[1]
+                            weight_grad[b, ch, dr, 1, r, c] += total * pre[d]
+                            if d > 0:
+                                grad_agg[d - 1, pr, pc] += total * w[2]
+                                weight_grad[b, ch, dr, 2, r, c] += total * pre[d - 1]
+                            if d < max_disparity - 1:
+                                grad_agg[d + 1, pr, pc] += total * w[3]
+                                weight_grad[b, ch, dr, 3, r, c] += total * pre[d + 1]
+                            grad_agg[m, pr, pc] += total * w[4]
+                            weight_grad[b, ch, dr, 4, r, c] += total * pre[m]
+    return cost_grad, weight_grad
+
+
+def reference_lga(cost, weight, grad_output):
+    batch, max_disparity, height, width = cost.size()
+    kernel_size = weight.size(2)
+    mid = kernel_size // 2
+    output = torch.zeros_like(cost)
+    cost_grad = torch.zeros_like(cost)
+    weight_grad = torch.zeros_like(weight)
+    for b in range(batch):
+        for d in range(max_disparity):
+            for r in range(height):
+                for c in range(width):
+                    g = grad_output[b, d, r, c]
+                    for kr in range(kernel_size):
+                        for kc in range(kernel_size):
+                            cr, cc = r + kr - mid, c + kc - mid
+                            if not (0 <= cr < height and 0 <= cc < width):
+                                continue
+                            for k, dd in enumerate([d, d - 1, d + 1]):
+                                if 0 <= dd < max_disparity:
+                                    output[b, d, r, c] += weight[b, k, kr, kc, r, c] * cost[b, dd, cr, cc]
+                                    weight_grad[b, k, kr, kc, r, c] += g * cost[b, dd, cr, cc]
+                                    cost_grad[b, dd, cr, cc] += g * weight[b, k, kr, kc, r, c]
+    return output, cost_grad, weight_grad
+
+
+def gd_voxel(direction, shift, d, r, c, max_disparity, height, width):
+    # position of the voxel swept at shift, its predecessor and the axes covered by k1, k2
+    if direction == 0:
+        return (d, r, shift), (d, r, shift - 1), (0, 1)
+    elif direction == 1:
+        return (d, r, width - 1 - shift), (d, r, width - shift), (0, 1)
+    elif direction == 2:
+        return (d, shift, c), (d, shift - 1, c), (0, 2)
+    elif direction == 3:
+        return (d, height - 1 - shift, c), (d, height - shift, c), (0, 2)
+    elif direction == 4:
+        return (max_disparity - 1 - shift, r, c), (max_disparity - shift, r, c), (1, 2)
+    else:
+        return (shift, r, c), (shift - 1, r, c), (1, 2)
+
+
+def gd_slices(direction, max_disparity, height, width):
+    # for every shift, the voxels (current, previous, k axes) swept at that shift
+    shape = (max_disparity, height, width)
+    limit = [width, width, height, height, max_disparity, max_disparity][direction]
+    slices = []
+    for shift in range(limit):
+        voxels = set()
+        for d in range(max_disparity):
+            for r in range(height):
+                for c in range(width):
+                    voxels.add(gd_voxel(direction, shift, d, r, c, *shape))
+        slices.append(sorted(voxels))
+    return slices
+
+
+def gd_neighbours(pre, axes, kernel_size, shape):
+    mid = kernel_size // 2
+    for k1 in range(kernel_size):
+        for k2 in range(kernel_size):
+            n = list(pre)
+            n[axes[0]] += k1 - mid
+            n[axes[1]] += k2 - mid
+            if all(0 <= n[i] < shape[i] for i in range(3)):
+                yield k1, k2, tuple(n)
+
+
+def reference_gd(cost, g0, filter, grad_output):
+    batch, channels, max_disparity, height, width = cost.size()
+    shape = (max_disparity, height, width)
+    directions = g0.size(2)
+    kernel_size = filter.size(3)
+    agg = torch.zeros((batch, channels, directions) + shape, dtype=cost.dtype)
+    cost_grad = torch.zeros_like(cost)
+    g0_grad = torch.zeros_like(g0)
+    filter_grad = torch.zeros_like(filter)
+    for b in range(batch):
+        for ch in range(channels):
+            for dr in range(directions):
+                slices = gd_slices(dr, *shape)
+                for shift, voxels in enumerate(slices):
+                    for (d, r, c), pre, axes in voxels:
+                        s = cost[b, ch, d, r, c] * g0[b, ch, dr, r, c]
+                        if shift > 0:
+                            for k1, k2, n in gd_neighbours(pre, axes, kernel_size, shape):
+                                s = s + agg[(b, ch, dr) + n] * filter[b, ch, dr, k1, k2, r, c]
+                        agg[b, ch, dr, d, r, c] = s
+
+                grad_agg = torch.zeros(shape, dtype=cost.dtype)
+                for shift in range(len(slices) - 1, -1, -1):
+                    for (d, r, c), pre, axes in slices[shift]:
+                        total = grad_output[b, ch, dr, d, r, c] + grad_agg[d, r, c]
+                        cost_grad[b, ch, d, r, c] += total * g0[b, ch, dr, r, c]
+                        g0_grad[b, ch, dr, r, c] += total * cost[b, ch, d, r, c]
+                        if shift > 0:
+                            for k1, k2, n in gd_neighbours(pre, axes, kernel_size, shape):
+                                grad_agg[n] += total * filter[b, ch, dr, k1, k2, r, c]
+                                filter_grad[b, ch, dr, k1, k2, r, c] += total * agg[(b, ch, dr) + n]
+    return agg, cost_grad, g0_grad, filter_grad
+
+
+def reference_calc_cost(left, right, kernel_size, min_disparity, max_disparity, cost_type):
+    batch, channels, height, width = left.size()
+    mid = kernel_size // 2
+    cost = torch.zeros((batch, max_disparity, height, width), dtype=torch.float64)
+    for b in range(batch):
+        for i in range(max_disparity):
+            d = i + min_disparity
+            for r in range(height):
+                for c in range(width):
+                    if c - d < 0 or c - d >= width:
+                        continue
+                    window = [(r + y, c + x) for y in range(-mid, mid + 1) for x in range(-mid, mid + 1)
+                              if 0 <= r + y < height and 0 <= c + x < width and 0 <= c + x - d < width]
+                    lw = torch.stack([left[b, :, y, x] for y, x in window], dim=1).double()
+                    rw = torch.stack([right[b, :, y, x - d] for y, x in window], dim=1).double()
+
+                    if cost_type == cpu_lib.COST_SAD:
+                        cost[b, i, r, c] = (lw - rw).abs().sum()
+                    elif cost_type == cpu_lib.COST_CENSUS_AVG:
+                        bl = lw > lw.mean(1, keepdim=True)
+                        br = rw > rw.mean(1, keepdim=True)
+                        cost[b, i, r, c] = (bl != br).sum()
+                    elif cost_type == cpu_lib.COST_CENSUS_FIX:
+                        bl = lw > left[b, :, r, c].unsqueeze(1)
+                        br = rw > right[b, :, r, c - d].unsqueeze(1)
+                        cost[b, i, r, c] = (bl != br).sum()
+                    else:
+                        dx = lw - lw.mean(1, keepdim=True)
+                        dy = rw - rw.mean(1, keepdim=True)
+                        std = (dx * dx).sum(1).sqrt() * (dy * dy).sum(1).sqrt()
+                        corr = torch.where(std != 0, (dx * dy).sum(1) / std, torch.zeros_like(std))
+                        cost[b, i, r, c] = -corr.mean()
+    return cost
+
+
+def reference_sgm(cost, p1, p2):
+    batch, max_disparity, height, width = cost.size()
+    agg = torch.zeros((batch, 8, max_disparity, height, width), dtype=cost.dtype)
+    for direction, (row_offset, col_offset) in enumerate(cpu_lib.SGM_DIRECTIONS):
+        # the predecessor (r - row_offset, c - col_offset) is visited first
+        rows = range(height - 1, -1, -1) if row_offset < 0 else range(height)
+        cols = range(width - 1, -1, -1) if col_offset < 0 else range(width)
+        for b in range(batch):
+            for r in rows:
+                for c in cols:
+                    pr, pc = r - row_offset, c - col_offset
+                    if not (0 <= pr < height and 0 <= pc < width):
+                        agg[b, direction, :, r, c] = cost[b, :, r, c]
+                        continue
+                    pre = agg[b, direction, :, pr, pc]
+                    for d in range(max_disparity):
+                        candidates = [pre[d], pre.min() + p2]
+                        if d > 0:
+                            candidates.append(pre[d - 1] + p1)
+                        if d < max_disparity - 1:
+                            candidates.append(pre[d + 1] + p1)
+                        agg[b, direction, d, r, c] = cost[b, d, r, c] + min(candidates) - pre.min()
+    return agg
+
+
+class CpuLibTestCase(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.batch = 2
+        self.channels = 2
+        self.max_disparity = 5
+        self.height = 4
+        self.width = 6
+
+    def test_sga(self):
+        cost = torch.randn((self.batch, self.channels, self.max_disparity, self.height, self.width), dtype=torch.float64)
+        weight = torch.randn((self.batch, self.channels, 4, 5, self.height, self.width), dtype=torch.float64)
+        weight = weight / weight.abs().sum(dim=3, keepdim=True)
+        grad_output = torch.randn((self.batch, self.channels, 4, self.max_disparity, self.height, self.width), dtype=torch.float64)
+
+        cost.requires_grad = True
+        weight.requires_grad = True
+        agg = SgaFunction.apply(cost, weight)
+        agg.backward(grad_output)
+
+        ref_agg, ref_max_index = reference_sga_forward(cost.detach(), weight.detach())
+        ref_cost_grad, ref_weight_grad = reference_sga_backward(cost.detach(), ref_agg, weight.detach(),
+                                                                ref_max_index, grad_output)
+        self.assertTrue(torch.allclose(agg, ref_agg))
+        self.assertTrue(torch.allclose(cost.grad, ref_cost_grad))
+        self.assertTrue(torch.allclose(weight.grad, ref_weight_grad))
+
+    def test_sga_max_index(self):
+        cost = torch.randn((self.batch, self.channels, self.max_disparity, self.height, self.width))
+        weight = torch.rand((self.batch, self.channels, 4, 5, self.height, self.width))
+        agg = torch.zeros((self.batch, self.channels, 4, self.max_disparity, self.height, self.width))
+        max_index = torch.zeros((self.batch, self.channels, 4, self.height, self.width), dtype=torch.uint8)
+        cpu_lib.cpu_sga_forward(cost, agg, weight, max_index)
+        self.assertTrue(torch.equal(max_index.long(), agg.argmax(dim=3)))
+
+    def test_lga(self):
+        cost = torch.randn((self.batch, self.max_disparity, self.height, self.width), dtype=torch.float64)
+        weight = torch.randn((self.batch, 3, 5, 5, self.height, self.width), dtype=torch.float64)
+        grad_output = torch.randn((self.batch, self.max_disparity, self.height, self.width), dtype=torch.float64)
+
+        cost.requires_grad = True
+        weight.requires_grad = True
+        output = LgaFunction.apply(cost, weight)
+        output.backward(grad_output)
+
+        ref_output, ref_cost_grad, ref_weight_grad = reference_lga(cost.detach(), weight.detach(), grad_output)
+        self.assertTrue(torch.allclose(output, ref_output))
+        self.assertTrue(torch.allclose(cost.grad, ref_cost_grad))
+        self.assertTrue(torch.allclose(weight.grad, ref_weight_grad))
+
+
+    def check_gd(self, function, directions):
+        kernel_size = 3
+        cost = torch.randn((self.batch, self.channels, self.max_disparity, self.height, self.width), dtype=torch.float64)
+        g0 = torch.randn((self.batch, self.channels, directions, self.height, self.width), dtype=torch.float64)
+        filter = torch.randn((self.batch, self.channels, directions, kernel_size, kernel_size, self.height, self.width),
+                             dtype=torch.float64) / kernel_size ** 2
+        grad_output = torch.randn((self.batch, self.channels, directions, self.max_disparity, self.height, self.width),
+                                  dtype=torch.float64)
+
+        cost.requires_grad = True
+        g0.requires_grad = True
+        filter.requires_grad = True
+        agg = function.apply(cost, g0, filter)
+        agg.backward(grad_output)
+
+        ref_agg, ref_cost_grad, ref_g0_grad, ref_filter_grad = reference_gd(cost.detach(), g0.detach(),
+                                                                            filter.detach(), grad_output)
+        self.assertTrue(torch.allclose(agg, ref_agg))
+        self.assertTrue(torch.allclose(cost.grad, ref_cost_grad))
+        self.assertTrue(torch.allclose(g0.grad, ref_g0_grad))
+        self.assertTrue(torch.allclose(filter.grad, ref_filter_grad))
+
+    def test_gd4(self):
+        self.check_gd(GD4_Function, 4)
+
+    def test_gd6(self):
+        self.check_gd(GD6_Function, 6)
+
+    def test_calc_cost(self):
+        kernel_size = 3
+        left = torch.rand((2, 3, 5, 9))
+        right = torch.rand((2, 3, 5, 9))
+        for cost_type in range(4):
+            for min_disparity, max_disparity in [(0, 4), (-3, 4)]:
+                cost = torch.zeros((2, max_disparity, 5, 9))
+                cpu_lib.cpu_calc_cost(left, right, cost, kernel_size, min_disparity, cost_type)
+                ref_cost = reference_calc_cost(left, right, kernel_size, min_disparity, max_disparity, cost_type)
+                if cost_type == cpu_lib.COST_CENSUS_AVG:
+                    # the window average only agrees where the window is inside both images
+                    for i in range(max_disparity):
+                        d = i + min_disparity
+                        cost[:, i, :, :max(d, 0) + 1] = ref_cost[:, i, :, :max(d, 0) + 1]
+                        cost[:, i, :, 9 + min(d, 0) - 1:] = ref_cost[:, i, :, 9 + min(d, 0) - 1:]
+                self.assertTrue(torch.allclose(cost.double(), ref_cost, atol=1e-5), cost_type)
+
+    def test_sgm(self):
+        cost = torch.rand((2, 5, 6, 7), dtype=torch.float64)
+        agg = torch.zeros((2, 8, 5, 6, 7), dtype=torch.float64)
+        cpu_lib.cpu_sgm(cost, agg, 0.1, 0.5)
+        self.assertTrue(torch.allclose(agg, reference_sgm(cost, 0.1, 0.5)))
+
+    def test_left_right_consistency_check(self):
+        left = torch.tensor([[[-1, 0, 1, 1, 3, 2, 2]]], dtype=torch.float)
+        right = torch.tensor([[[0, 0, -3, -2, -1, -1, -1]]], dtype=torch.float)
+        cpu_lib.cpu_left_right_consistency_check(left, right, 1.5)
+        self.assertEqual(left.tolist(), [[[-1, 0, 1, -1, -1, 2, 2]]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+import utils
+from dataset.dataset import KITTI_2015, TeacherCost
+
+
+class SyntheticKITTI_2015(KITTI_2015):
+    # KITTI_2015 layout with random frames of the size of the untexture samples
+    def __init__(self, root, **kwargs):
+        self.synthetic_root = root
+        random = np.random.RandomState(0)
+        for folder in ['image_2', 'image_3', 'disp_occ_0']:
+            os.makedirs(os.path.join(root, 'training', folder), exist_ok=True)
+            for index in range(2):
+                image = random.randint(0, 256, (375, 1242, 3), dtype=np.uint8)
+                cv2.imwrite(os.path.join(root, 'training', folder, '{:06d}_10.png'.format(index)), image)
+        super(SyntheticKITTI_2015, self).__init__(**kwargs)
+
+    def get_root_directory(self):
+        return self.synthetic_root
+
+    def __len__(self):
+        return 2
+
+
+class DatasetTestCase(unittest.TestCase):
+    def test_untexture_collate(self):
+        with tempfile.TemporaryDirectory() as root:
+            for use_uint8 in [True, False]:
+                dataset = SyntheticKITTI_2015(root, use_crop_size=True, crop_size=(64, 128), use_uint8=use_uint8)
+                dataset.untexture_rate = 1
+                untexture = dataset[0]
+                dataset.untexture_rate = 0
+                sample = dataset[1]
+
+                self.assertEqual(untexture[1].dtype, torch.float32)
+                self.assertEqual(sample[1].dtype, torch.float32)
+                self.assertTrue(torch.all(untexture[1] == np.float32(0.001)))
+                X, Y, _ = default_collate([untexture, sample])
+                self.assertEqual(X.dtype, torch.uint8 if use_uint8 else torch.float32)
+                self.assertEqual(tuple(Y.size()), (2, 1, 64, 128))
+
+            # the shared memory path of the worker processes
+            dataset = SyntheticKITTI_2015(root, use_crop_size=True, crop_size=(64, 128), untexture_rate=0.5,
+                                          use_uint8=True)
+            for X, Y, _ in DataLoader(dataset, batch_size=2, num_workers=1):
+                self.assertEqual(Y.dtype, torch.float32)
+
+    def test_teacher_cost(self):
+        # the shards of build_teacher_cost in train_merge_net.py
+        torch.manual_seed(0)
+        cost = torch.randn((3, 2, 24, 5, 6)) * 10
+        cost[0, 0, :, 0, 0] = 1.5  # constant pixel
+        disparity = torch.rand((3, 5, 6)) * 24
+        with tempfile.TemporaryDirectory() as root:
+            data = {'cost_left': [], 'cost_left_range': [], 'cost_right': [], 'cost_right_range': []}
+            for c in cost:
+                for name, side in [('cost_left', c[0]), ('cost_right', c[1])]:
+                    q, offset_scale = utils.quantize_cost(side)
+                    data[name].append(q.numpy())
+                    data[name + '_range'].append(offset_scale.numpy())
+            data['disparity'] = disparity.numpy()
+            for name, d in data.items():
+                np.save(os.path.join(root, f'{name}-000.npy'), np.stack(d))
+                np.save(os.path.join(root, f'{name}-index.npy'), np.array([[0, i] for i in range(3)]))
+
+            dataset = TeacherCost(root)
+            self.assertEqual(len(dataset), 3)
+            for i in range(3):
+                X, Y, _ = dataset[i]
+                self.assertEqual(X.dtype, torch.float16)
+                self.assertTrue(torch.equal(Y, disparity[i].unsqueeze(0)))
+                # half a quantization step plus the float16 rounding
+                span = cost[i].amax(dim=1, keepdim=True) - cost[i].amin(dim=1, keepdim=True)
+                error = (X.float() - cost[i]).abs()
+                self.assertTrue(torch.all(error <= span / 510 + cost[i].abs() / 1024 + 1e-6))
+            self.assertTrue(torch.all(dataset[0][0][0, :, 0, 0] == 1.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
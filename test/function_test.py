@@ -0,0 +1,60 @@
+import unittest
+import torch
+import torch.nn.functional as F
+from GDNet.function import SgaFunction, GD4_Function, GD6_Function, set_storage
+from GDNet.module import GD6_Block
+
+
+class StorageTestCase(unittest.TestCase):
+    def run_function(self, function, inputs, storage):
+        inputs = [x.clone().requires_grad_() for x in inputs]
+        agg = function.apply(*inputs, storage)
+        (agg * torch.linspace(-1, 1, agg.numel()).view(agg.size())).sum().backward()
+        return [agg] + [x.grad for x in inputs]
+
+    def check(self, function, inputs):
+        full = self.run_function(function, inputs, 'full')
+        for storage, atol in [('cpu', 0), ('recompute', 0), ('half', 1e-2), ('bfloat16', 5e-2)]:
+            for a, b in zip(full, self.run_function(function, inputs, storage)):
+                self.assertTrue(torch.allclose(a, b, atol=atol), storage)
+
+    def gd_inputs(self, direction):
+        torch.manual_seed(0)
+        cost = torch.randn((1, 2, 4, 5, 6))
+        g = F.normalize(torch.rand((1, 2, direction, 10, 5, 6)), p=1, dim=3)
+        g0 = g[:, :, :, 0].contiguous()
+        filter = g[:, :, :, 1:].reshape(1, 2, direction, 3, 3, 5, 6).contiguous()
+        return cost, g0, filter
+
+    def test_sga_storage(self):
+        torch.manual_seed(0)
+        cost = torch.randn((1, 2, 4, 5, 6))
+        weight = F.normalize(torch.rand((1, 2, 4, 5, 5, 6)), p=1, dim=3)
+        self.check(SgaFunction, [cost, weight])
+
+    def test_gd4_storage(self):
+        self.check(GD4_Function, self.gd_inputs(4))
+
+    def test_gd6_storage(self):
+        self.check(GD6_Function, self.gd_inputs(6))
+
+    def test_half_inputs(self):
+        cost, g0, filter = self.gd_inputs(6)
+        for dtype in [torch.float16, torch.bfloat16]:
+            inputs = [x.to(dtype).requires_grad_() for x in [cost, g0, filter]]
+            agg = GD6_Function.apply(*inputs)
+            (agg * torch.rand_like(agg)).sum().backward()
+            self.assertEqual(agg.dtype, torch.float32)
+            self.assertEqual([x.grad.dtype for x in inputs], [dtype] * 3)
+            self.assertTrue(torch.allclose(agg, GD6_Function.apply(*[x.float() for x in inputs])))
+
+    def test_set_storage(self):
+        model = GD6_Block(2, 3)
+        set_storage(model, 'half')
+        self.assertEqual(model.gdf6.storage, 'half')
+        with self.assertRaises(Exception):
+            set_storage(model, 'float8')
+
+
+if __name__ == '__main__':
+    unittest.main()
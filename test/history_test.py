@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import utils
+
+
+class HistoryLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.history_log = utils.HistoryLog(os.path.join(self.dir.name, 'GDNet_sdc6f.hist'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_append(self):
+        self.assertEqual(len(self.history_log), 0)
+        self.history_log.append(1, train_epe=2.0, test_epe=3.0, test_error_rate=0.1)
+        self.history_log.append(2, train_epe=1.5, test_epe=2.5)
+        self.history_log.append(2, train_epe=1.0, test_epe=2.0)  # retried version
+        history = self.history_log.read()
+        self.assertEqual(history['version'].tolist(), [1, 2])
+        self.assertEqual(history['train_epe'].tolist(), [2.0, 1.0])
+        self.assertTrue(np.isnan(history['test_error_rate'][1]))
+        self.assertEqual(len(self.history_log.read(latest=False)), 3)
+        with self.assertRaises(Exception):
+            self.history_log.append(3, train_loss=1.0)
+
+    def test_partial_record(self):
+        self.history_log.append(1, train_epe=2.0)
+        with open(self.history_log.filename, 'ab') as file:
+            file.write(b'\0' * 10)
+        self.assertEqual(self.history_log.read()['version'].tolist(), [1])
+
+    def test_import_ht(self):
+        ht_file = os.path.join(self.dir.name, 'GDNet_sdc6f-3.ht')
+        utils.save({'train': [3.0, 2.0, 1.0], 'test': [4.0, 3.0, 2.0]}, ht_file)
+        self.history_log.append(2, train_epe=1.9, test_epe=2.9)
+        self.assertEqual(self.history_log.import_ht(ht_file), 2)
+        history = self.history_log.read()
+        self.assertEqual(history['version'].tolist(), [1, 2, 3])
+        self.assertEqual(history['test_epe'].tolist(), [4.0, 2.9, 2.0])
+        self.assertEqual(self.history_log.import_ht(ht_file), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import torch
+import utils.cost_volume as cv
+
+
+def is_in_range(p_list, x, pixel_range):
+    for p in p_list:
+        if abs(p[0] - x[0]) <= pixel_range or abs(p[1] - x[1]) <= pixel_range:
+            return True
+    return False
+
+
+def loop_sgm_better_location(model_disp, sgm_disp, target, pixel_range):
+    # the pixel loop the vectorized version replaced
+    valid_indices = (model_disp != 0) & (model_disp != -1) & (sgm_disp != -1) & (target != 0)
+    epe_diff = (model_disp - target).abs() - (sgm_disp - target).abs()
+    epe_list = [(r, c, float(epe_diff[r, c])) for r in range(target.shape[0]) for c in range(target.shape[1])
+                if valid_indices[r, c]]
+    epe_list.sort(key=lambda x: x[2], reverse=True)
+
+    results = []
+    for p_list in [epe_list, epe_list[::-1]]:
+        better = []
+        for p in p_list:
+            if not is_in_range(better, p, pixel_range):
+                better.append(p)
+            if len(better) >= 5:
+                break
+        results.append(better)
+    return results
+
+
+class LocationTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # rounded values, so there are ties
+        self.target = torch.randint(0, 8, (3, 30, 40)).float()
+        self.model_disp = torch.randint(-1, 8, (3, 30, 40)).float()
+        self.sgm_disp = torch.randint(-1, 8, (3, 30, 40)).float()
+
+    def test_diff_location(self):
+        for n in range(3):
+            input, target = self.model_disp[n], self.target[n]
+            valid_indices = (input != -1) & (target != 0)
+            epe_list = [(r, c, float((input[r, c] - target[r, c]).abs())) for r in range(30) for c in range(40)
+                        if valid_indices[r, c]]
+            epe_list.sort(key=lambda x: x[2], reverse=True)
+            self.assertEqual(cv.diff_location(input, target), epe_list)
+            self.assertEqual([p[2] for p in cv.diff_location(input, target, k=7)], [p[2] for p in epe_list[:7]])
+
+    def test_sgm_better_location(self):
+        for pixel_range in [0, 3, 10]:
+            sgm_better, model_better = cv.sgm_better_locations(self.model_disp, self.sgm_disp, self.target,
+                                                               pixel_range)
+            for n in range(3):
+                expected = loop_sgm_better_location(self.model_disp[n], self.sgm_disp[n], self.target[n], pixel_range)
+                self.assertEqual([sgm_better[n], model_better[n]], expected)
+                self.assertEqual(list(cv.sgm_better_location(self.model_disp[n], self.sgm_disp[n], self.target[n],
+                                                             pixel_range)), expected)
+
+    def test_few_valid(self):
+        target = torch.zeros((1, 30, 40))
+        target[0, 5, 5] = 3
+        sgm_better, model_better = cv.sgm_better_locations(self.model_disp[:1].abs() + 1, self.sgm_disp[:1].abs(),
+                                                           target)
+        self.assertEqual(len(sgm_better[0]), 1)
+        self.assertEqual(len(model_better[0]), 1)
+        self.assertEqual(cv.diff_locations(self.model_disp[:1], torch.zeros((1, 30, 40)), k=5), [[]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import torch
+from MergeNet.MergeNet_d import MergeNet_d
+
+
+class MergeNetTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.max_disparity = 48
+        self.cost1 = torch.randn((2, 1, self.max_disparity, 5, 7))
+        self.cost2 = torch.randn((2, 1, self.max_disparity, 5, 7))
+
+    def models(self):
+        direct = MergeNet_d(self.max_disparity, use_gemm=False).double()
+        gemm = MergeNet_d(self.max_disparity, use_gemm=True, chunk_size=16).double()
+        gemm.load_state_dict(direct.state_dict())
+        return direct, gemm
+
+    def test_gemm_train(self):
+        direct, gemm = self.models()
+        cost1 = self.cost1.double().requires_grad_()
+        cost2 = self.cost2.double().requires_grad_()
+
+        disp = direct(cost1, cost2)
+        disp.sum().backward()
+        grads = [cost1.grad.clone()] + [p.grad.clone() for p in direct.parameters()]
+        cost1.grad = None
+
+        gemm_disp = gemm(cost1, cost2)
+        gemm_disp.sum().backward()
+        gemm_grads = [cost1.grad] + [p.grad for p in gemm.parameters()]
+
+        self.assertTrue(torch.allclose(disp, gemm_disp))
+        for g, gemm_g in zip(grads, gemm_grads):
+            self.assertTrue(torch.allclose(g, gemm_g))
+
+    def test_gemm_eval_chunk(self):
+        direct, gemm = self.models()
+        direct.train()
+        direct(self.cost1.double(), self.cost2.double())  # move the batch norm running statistics
+        gemm.load_state_dict(direct.state_dict())
+        direct.eval()
+        gemm.eval()
+
+        with torch.no_grad():
+            disp = direct(self.cost1.double(), self.cost2.double())
+            gemm_disp = gemm(self.cost1.double(), self.cost2.double())
+        self.assertEqual(disp.size(), (2, 5, 7))
+        self.assertTrue(torch.allclose(disp, gemm_disp))
+
+
+if __name__ == '__main__':
+    unittest.main()
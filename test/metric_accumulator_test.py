@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+import torch
+import utils
+
+
+class MetricAccumulatorTestCase(unittest.TestCase):
+    def test_accumulate(self):
+        epe_loss = np.random.RandomState(0).rand(7)
+        metrics = utils.MetricAccumulator(sync_interval=3)
+        windows = []
+        for i, loss in enumerate(epe_loss):
+            metrics.add(epe_loss=torch.tensor(loss), error_sum=torch.tensor(float(i)), total_eval=10,
+                        CE_avg=None if i % 2 else torch.tensor(0.5))
+            if metrics.ready(last=i == len(epe_loss) - 1):
+                windows.append(metrics.synchronize())
+
+        self.assertEqual(len(windows), 3)
+        self.assertAlmostEqual(windows[0]['epe_loss'], epe_loss[:3].mean(), places=5)
+        self.assertAlmostEqual(windows[2]['epe_loss'], epe_loss[6], places=5)
+        self.assertAlmostEqual(metrics.mean('epe_loss'), epe_loss.mean(), places=5)
+        self.assertAlmostEqual(metrics.std('epe_loss'), epe_loss.std(), places=5)
+        self.assertAlmostEqual(metrics.rate(), 21 / 70)
+        self.assertAlmostEqual(metrics.mean('CE_avg'), 0.5)
+        self.assertEqual(metrics.count, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+import torch
+import torch.nn.functional as F
+from GDNet.module import DisparityRegression, SqueezeDisparityRegression, SparseDisparityRegression, CostVolume, BasicConv
+from GDNet.function import checkpoint_module
+
+
+def cost_mask(cost, disp):
+    # port of cost_mask_kernel in GDNet/extensions/guided_diffusion.h
+    batch, max_disparity, height, width = cost.size()
+    mask = torch.zeros(cost.size(), dtype=torch.uint8)
+    for b in range(batch):
+        for r in range(height):
+            for c in range(width):
+                d = int(disp[b, r, c])
+                while d >= 1:
+                    if cost[b, d, r, c] - cost[b, d - 1, r, c] > 0:
+                        mask[b, d, r, c] = 1
+                    else:
+                        break
+                    d -= 1
+
+                d = int(disp[b, r, c])
+                while d < max_disparity - 1:
+                    if cost[b, d + 1, r, c] - cost[b, d, r, c] < 0:
+                        mask[b, d, r, c] = 1
+                    else:
+                        break
+                    d += 1
+    return mask
+
+
+def squeeze_regression(cost, disp):
+    # profile.GDNet_class_regression.eval before the fused operator
+    cost = F.softmax(cost, dim=1)
+    mask = cost_mask(cost, disp)
+    squeeze = F.normalize(cost * mask, dim=1, p=1)
+    disparity = DisparityRegression(cost.size(1))(squeeze)
+    confidence = (cost * mask).sum(dim=1)
+    return disparity, confidence
+
+
+class ModuleTestCase(unittest.TestCase):
+    def check(self, cost, chunk_size):
+        disp = torch.argmax(cost, dim=1)
+        disparity, confidence = squeeze_regression(cost, disp)
+        fused_disparity, fused_confidence = SqueezeDisparityRegression(chunk_size)(cost, disp)
+        self.assertTrue(torch.allclose(disparity, fused_disparity, atol=1e-4))
+        self.assertTrue(torch.allclose(confidence, fused_confidence, atol=1e-5))
+
+    def test_squeeze_regression(self):
+        torch.manual_seed(0)
+        cost = torch.randn((2, 24, 5, 6)) * 3
+        # smooth costs give wide unimodal windows
+        smooth = F.avg_pool3d(torch.randn((2, 1, 30, 5, 6)), (7, 1, 1), stride=1)[:, 0] * 20
+        for chunk_size in [1, 5, 24]:
+            self.check(cost, chunk_size)
+            self.check(smooth, chunk_size)
+
+    def test_squeeze_regression_ties(self):
+        torch.manual_seed(1)
+        cost = torch.randint(0, 3, (2, 12, 4, 5)).float()
+        self.check(cost, 4)
+
+    def test_squeeze_regression_half(self):
+        # a float16 / bfloat16 cost (autocast) is accumulated in float32, the same as its float32 value
+        torch.manual_seed(5)
+        smooth = F.avg_pool3d(torch.randn((2, 1, 198, 6, 7)), (7, 1, 1), stride=1)[:, 0] * 60
+        for dtype in [torch.float16, torch.bfloat16]:
+            cost = smooth.to(dtype)
+            disparity, confidence = SqueezeDisparityRegression(16)(cost)
+            expected_disparity, expected_confidence = SqueezeDisparityRegression(16)(cost.float())
+            self.assertEqual(disparity.dtype, torch.float32)
+            self.assertTrue(torch.allclose(disparity, expected_disparity, atol=1e-4))
+            self.assertTrue(torch.allclose(confidence, expected_confidence, atol=1e-5))
+
+            sparse_disparity = SparseDisparityRegression(k=16, mode='topk')(cost)
+            expected_disparity = SparseDisparityRegression(k=16, mode='topk')(cost.float())
+            self.assertTrue(torch.allclose(sparse_disparity, expected_disparity, atol=1e-4))
+
+    def test_sparse_window_regression(self):
+        torch.manual_seed(2)
+        # peaks every 12 disparities: the unimodal mask fits in a window of 16 disparities
+        peak = torch.randint(0, 48, (2, 1, 5, 6))
+        cost = -((torch.arange(48).view(1, 48, 1, 1) - peak + 6) % 12 - 6).abs().float()
+        cost = cost + torch.rand((2, 48, 5, 6)) * 0.5
+        cost[:, :, 0, 0] = -(torch.arange(48) - 2).abs().float()  # window clamped to the first disparities
+        disp = torch.argmax(cost, dim=1)
+        disparity = squeeze_regression(cost, disp)[0]
+        sparse_disparity = SparseDisparityRegression(k=16, mode='window')(cost, disp)
+        self.assertTrue(torch.allclose(disparity, sparse_disparity, atol=1e-4))
+
+    def test_sparse_topk_regression(self):
+        torch.manual_seed(3)
+        cost = torch.randn((2, 24, 4, 5))
+        prob = F.softmax(cost, dim=1)
+        self.assertTrue(torch.allclose(SparseDisparityRegression(k=24, mode='topk')(cost),
+                                       DisparityRegression(24)(prob), atol=1e-5))
+
+        sparse_disparity = SparseDisparityRegression(k=4, mode='topk')(cost)
+        top = cost >= cost.topk(4, dim=1).values[:, -1:]
+        prob = F.normalize(torch.exp(cost) * top, dim=1, p=1)
+        self.assertTrue(torch.allclose(sparse_disparity, DisparityRegression(24)(prob), atol=1e-5))
+
+    def test_disparity_regression(self):
+        x = torch.rand((2, 10, 3, 4))
+        disp = torch.arange(10).view(1, 10, 1, 1).float().repeat(2, 1, 3, 4)
+        self.assertTrue(torch.allclose(DisparityRegression(10)(x), torch.sum(x * disp, dim=1)))
+
+    def check_lazy_cost_volume(self, conv_start, x, y, max_disparity, chunk_size):
+        cost_volume = CostVolume(max_disparity)
+        lazy_cost_volume = CostVolume(max_disparity, lazy=True, chunk_size=chunk_size)
+        grad = torch.randn_like(conv_start(cost_volume(x, y)))
+        results = []
+        for forward in [lambda: conv_start(cost_volume(x, y)),
+                        lambda: conv_start(lazy_cost_volume(x, y)),
+                        lambda: checkpoint_module(conv_start, lambda a, b: conv_start(lazy_cost_volume(a, b)), x, y)]:
+            out = forward()
+            conv_start.zero_grad()
+            x.grad = y.grad = None
+            out.backward(grad)
+            results.append([out.detach(), x.grad, y.grad] + [p.grad.clone() for p in conv_start.parameters()])
+
+        for lazy in results[1:]:
+            for expected, actual in zip(results[0], lazy):
+                self.assertTrue(torch.allclose(expected, actual, atol=1e-4))
+
+    def test_lazy_cost_volume(self):
+        torch.manual_seed(4)
+        conv_start = BasicConv(8, 4, is_3d=True, kernel_size=3, padding=1, relu=False)
+        x = torch.randn((2, 4, 5, 16), requires_grad=True)
+        y = torch.randn((2, 4, 5, 16), requires_grad=True)
+        # chunk sizes that leave a partial last chunk, and one larger than the volume
+        for chunk_size in [1, 5, 7, 12, 16]:
+            self.check_lazy_cost_volume(conv_start, x, y, 12, chunk_size)
+
+        with torch.no_grad():
+            cost_volume = CostVolume(12)
+            lazy_cost_volume = CostVolume(12, lazy=True, chunk_size=5)
+            self.assertTrue(torch.allclose(conv_start(cost_volume(x, y)), conv_start(lazy_cost_volume(x, y)), atol=1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
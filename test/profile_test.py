@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    # a fresh interpreter, where ./profile.py comes before the standard library module,
+    # in a temporary directory for the ./model folders the profiles create
+    code = f'import sys; sys.path.insert(0, {root!r}); ' + code
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(result.stderr)
+    return result.stdout.split()
+
+
+class ProfileTestCase(unittest.TestCase):
+    def test_lazy_import(self):
+        packages = "[m for m in sys.modules if m.split('.')[0] in ['GDNet', 'GANet', 'LEAStereo', 'MergeNet', 'gdnet_lib']]"
+        output = run(f"import sys, profile; print(len({packages})); print(profile.get_profile('MergeNet_d'))")
+        self.assertEqual(output, ['0', 'MergeNet_d'])
+
+    def test_get_model(self):
+        output = run("import sys, profile; p = profile.get_profile('MergeNet_d'); p.get_model(48); "
+                     "print('MergeNet.MergeNet_d' in sys.modules, 'GDNet.GDNet_sdc6f' in sys.modules)")
+        self.assertEqual(output, ['True', 'False'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(Exception):
+            run("import profile; profile.get_profile('GDNet_unknown')")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+import torch
+import cv2
+import utils
+
+
+class SGMTestCase(unittest.TestCase):
+    def setUp(self):
+        # right image is the left image shifted by 6 pixels, with a random texture
+        rng = np.random.RandomState(0)
+        left = torch.from_numpy(rng.rand(3, 3, 48, 96).astype(np.float32))
+        right = torch.roll(left, -6, dims=3)
+        self.X = torch.cat([left, right], dim=1)
+
+    def test_workers(self):
+        sgm = utils.SGM(5, max_disparity=16, mode=cv2.STEREO_SGBM_MODE_HH)
+        disp = sgm.process(self.X)
+        self.assertEqual(disp.size(), (3, 48, 96))
+        self.assertTrue((disp[:, 8:-8, 24:-8] == 6).float().mean() > 0.95)
+
+        with utils.SGM(5, max_disparity=16, mode=cv2.STEREO_SGBM_MODE_HH, num_workers=2) as parallel_sgm:
+            for lr_check in [False, True]:
+                disp = sgm.process(self.X, lr_check=lr_check)
+                self.assertTrue(torch.equal(parallel_sgm.process(self.X, lr_check=lr_check), disp))
+            self.assertTrue(torch.equal(parallel_sgm.process(self.X[:1], lr_check=True), disp[:1]))
+
+    def test_lr_check(self):
+        sgm = utils.SGM(5, max_disparity=16, mode=cv2.STEREO_SGBM_MODE_HH)
+        disp = sgm.process(self.X)
+        checked = sgm.process(self.X, lr_check=True, device='cpu')
+        self.assertTrue(torch.all((checked == disp) | (checked == -1)))
+        # the left border has no match in the right image
+        self.assertTrue(torch.all(checked[:, :, :6] == -1))
+
+
+if __name__ == '__main__':
+    unittest.main()
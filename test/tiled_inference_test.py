@@ -0,0 +1,55 @@
+import unittest
+import torch
+import utils
+
+
+class TiledInferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.max_disparity = 8
+        self.X = torch.rand((2, 6, 37, 70))
+        self.sizes = []
+
+    def shift_produce(self, X_tiles):
+        # disparity of every pixel from the left image and the right image max_disparity - 1 columns to the left,
+        # a tile without enough left context gives a wrong value
+        self.sizes.append(X_tiles.size())
+        right = torch.nn.functional.pad(X_tiles[:, 3], (self.max_disparity - 1, 0))[..., :X_tiles.size(3)]
+        return X_tiles[:, 0] + right
+
+    def test_tiled_disparity(self):
+        full = self.shift_produce(self.X)
+        for overlap, batch_size in [(4, 1), (0, 3), (6, 100)]:
+            self.sizes = []
+            disp = utils.tiled_disparity(self.shift_produce, self.X, self.max_disparity, 16, 24, overlap, batch_size)
+            self.assertEqual(disp.size(), (2, 37, 70))
+            self.assertTrue(torch.allclose(disp, full, atol=1e-5))
+            self.assertTrue(all(size[0] <= batch_size and size[2:] == (16, 24) for size in self.sizes))
+
+    def test_padding(self):
+        X = self.X[:, :, :10, :20]
+        disp = utils.tiled_disparity(self.shift_produce, X, self.max_disparity, 16, 24, 4)
+        self.assertEqual(disp.size(), (2, 10, 20))
+        self.assertTrue(torch.allclose(disp, self.shift_produce(X)))
+
+    def test_blend(self):
+        # tiles of constant disparity, the overlaps have to be between the two constants
+        X = torch.zeros((1, 6, 16, 70))
+        count = []
+
+        def produce(X_tiles):
+            count.append(1)
+            return torch.full(X_tiles[:, 0].size(), float(len(count)))
+
+        disp = utils.tiled_disparity(produce, X, self.max_disparity, 16, 24, overlap=6)
+        self.assertEqual(float(disp[0, 0, 0]), 1)
+        self.assertEqual(float(disp[0, 0, -1]), len(count))
+        self.assertTrue(torch.all(disp[0, 0, 1:] >= disp[0, 0, :-1]))
+
+    def test_small_tile(self):
+        with self.assertRaises(Exception):
+            utils.tiled_disparity(self.shift_produce, self.X, 20, 16, 24, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
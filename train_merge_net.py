@@ -1,16 +1,81 @@
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import torch.optim as optim
 from dataset.dataset import *
 from colorama import Style
 import profile
 import numpy as np
 import os
+import shutil
 import utils
 import traceback
 import datetime
 import torch.nn.functional as F
 
 
+def teacher_cost(cv_model, X):
+    # cost_left, cost_right: batch, 1, disparity, height, width
+    cv_model.flip = False
+    cost_left = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
+    cv_model.flip = True
+    cost_right = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
+    return cost_left, cost_right
+
+
+def build_teacher_cost(root, cv_model, dataset, size, seed, shard_size=100, num_workers=8):
+    # run the frozen cost volume model once per (sample, crop) and keep the costs as uint8 shards quantized per
+    # pixel (utils.quantize_cost) read by dataset.TeacherCost, samples are repeated with new random crops when
+    # size is larger than the dataset
+    if os.path.exists(os.path.join(root, 'disparity-index.npy')):
+        print('Using teacher cost:', root)
+        return TeacherCost(root)
+
+    print('Build teacher cost:', root)
+    os.makedirs(root, exist_ok=True)
+    random = np.random.RandomState(seed)
+    repeat = -(-size // len(dataset))
+    indexes = np.concatenate([random.permutation(len(dataset)) for _ in range(repeat)])[:size]
+    loader = DataLoader(Subset(dataset, indexes), batch_size=1, shuffle=False, num_workers=num_workers, pin_memory=True)
+
+    shards = {}
+    index = np.zeros((size, 2), dtype=np.int64)
+    cv_model.eval()
+    with torch.no_grad():
+        for i, (X, Y, pass_info) in enumerate(loader):
+            X, Y = utils.to_device(X, Y)
+            cost_left, cost_right = teacher_cost(cv_model, X)
+            shard_index, slot = divmod(i, shard_size)
+            data = {}
+            for name, cost in [('cost_left', cost_left), ('cost_right', cost_right)]:
+                q, offset_scale = utils.quantize_cost(cost[0, 0])
+                data[name], data[name + '_range'] = q.cpu().numpy(), offset_scale.cpu().numpy()
+            data['disparity'] = Y[0, 0].cpu().numpy()
+            if i == 0:
+                # 2 x D x H x W uint8 per crop, plus the offset, scale and disparity planes
+                entry_bytes = sum(d.nbytes for d in data.values())
+                free_bytes = shutil.disk_usage(root).free
+                print(f'Teacher cost: {entry_bytes / 2 ** 20:.1f} MiB per crop, '
+                      f'{entry_bytes * size / 2 ** 30:.1f} GiB for {size} crops, {free_bytes / 2 ** 30:.1f} GiB free')
+                if entry_bytes * size > free_bytes:
+                    raise Exception(f'Not enough disk space for the teacher cost: {root}')
+            for name, d in data.items():
+                if slot == 0:
+                    if name in shards:
+                        shards[name].flush()
+                    shards[name] = np.lib.format.open_memmap(
+                        os.path.join(root, f'{name}-{shard_index:03d}.npy'), mode='w+', dtype=d.dtype,
+                        shape=(min(shard_size, size - i), *d.shape))
+                shards[name][slot] = d
+            index[i] = shard_index, slot
+            print(f'[{i + 1}/{size}] teacher cost')
+
+    for name in shards:
+        shards[name].flush()
+    # disparity-index.npy is written last and marks a complete cache
+    for name in ['cost_left', 'cost_left_range', 'cost_right', 'cost_right_range', 'disparity']:
+        np.save(os.path.join(root, f'{name}-index.npy'), index)
+    return TeacherCost(root)
+
+
 def main():
     version = None
     cv_model = None
@@ -21,9 +86,19 @@ def main():
     is_debug = False
     dataset_name = ['flyingthings3D', 'KITTI_2015', 'KITTI_2015_Augmentation', 'KITTI_2012_Augmentation'][0]
     exception_count = 0
-    used_cv_profile = profile.GDNet_sdc6f()
-    used_disp_profile = profile.MergeNet_d()
-    dataloader_kwargs = {'num_workers': 8, 'pin_memory': True, 'drop_last': True}
+    used_cv_profile = profile.get_profile('GDNet_sdc6f')
+    used_disp_profile = profile.get_profile('MergeNet_d')
+    background_save = True  # the next version starts while the .nn file is written
+    keep_every_version = None  # e.g. 10 keeps every 10th .nn file of this run plus the best and the latest
+    dataloader_kwargs = {'num_workers': 8, 'pin_memory': True, 'drop_last': True, 'persistent_workers': True}
+    image_cache_bytes = 0  # shared LRU cache of decoded KITTI frames, e.g. 8 * 2 ** 30
+    use_teacher_cache = False  # run cv_model once per cached crop instead of twice per step, see the size below
+    teacher_cache_epochs = 5  # cached crops = train_size (test_size) * teacher_cache_epochs
+    # each cached crop takes 2 x D x H x W uint8 on disk (full resolution, quantized per pixel),
+    # 192 x 576 with max_disparity 192: 43 MiB per crop, 40 GiB for the 960 flyingthings3D training crops
+    # and 200 GiB for the 4800 KITTI training crops
+    teacher_num_workers = 8
+    sync_interval = 10  # batches between reads of the metrics on the host (one printed line each)
 
     # GTX 1660 Ti
     if isinstance(used_cv_profile, profile.GDNet_sdc6f):
@@ -54,9 +129,12 @@ def main():
         max_disparity = 160
 
 
-    cv_model = used_cv_profile.load_model(max_disparity, cv_model)[1]
+    cv_version, cv_model = used_cv_profile.load_model(max_disparity, cv_model)
+    cv_version -= 1  # load_model returns the next version
     disp_model = used_disp_profile.load_model(max_disparity, version)[1]
     version, loss_history = used_disp_profile.load_history(version)
+    if background_save:
+        used_disp_profile.checkpoint_writer = utils.CheckpointWriter(keep_every=keep_every_version)
     torch.backends.cudnn.benchmark = True
 
     print(f'CUDA abailable cores: {torch.cuda.device_count()}')
@@ -71,29 +149,30 @@ def main():
 
     if dataset_name == 'flyingthings3D':
         train_dataset = FlyingThings3D(max_disparity, type='train', use_crop_size=True, crop_size=(height, width),
-                                       crop_seed=None, image='finalpass')
+                                       crop_seed=None, image='finalpass', use_uint8=True)
         test_dataset = FlyingThings3D(max_disparity, type='test', use_crop_size=True, crop_size=(height, width),
-                                      crop_seed=None, image='finalpass')
+                                      crop_seed=None, image='finalpass', use_uint8=True)
 
     elif dataset_name == 'KITTI_2015':
         train_dataset, test_dataset = random_split(
-            KITTI_2015(use_crop_size=True, crop_size=(height, width), type='train', crop_seed=None), seed=seed)
+            KITTI_2015(use_crop_size=True, crop_size=(height, width), type='train', crop_seed=None,
+                       cache_bytes=image_cache_bytes, use_uint8=True), seed=seed)
 
     elif dataset_name == 'KITTI_2015_Augmentation':
         train_dataset = KITTI_2015_Augmentation(use_crop_size=True, crop_size=(height, width), type='train',
                                                 crop_seed=None,
-                                                shuffle_seed=0)
+                                                shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
         test_dataset = KITTI_2015_Augmentation(use_crop_size=True, crop_size=(height, width), type='test',
                                                crop_seed=None,
-                                               shuffle_seed=0)
+                                               shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
 
     elif dataset_name == 'KITTI_2012_Augmentation':
         train_dataset = KITTI_2012_Augmentation(use_crop_size=True, crop_size=(height, width), type='train',
                                                 crop_seed=None,
-                                                shuffle_seed=0)
+                                                shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
         test_dataset = KITTI_2012_Augmentation(use_crop_size=True, crop_size=(height, width), type='test',
                                                crop_seed=None,
-                                               shuffle_seed=0)
+                                               shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
 
     else:
         raise Exception('Cannot find dataset: ' + dataset_name)
@@ -101,53 +180,55 @@ def main():
     print('Number of training data:', len(train_dataset))
     print('Number of testing data:', len(test_dataset))
 
+    # the loaders are kept for every version, RandomSubsetSampler draws a new random subset each epoch
+    if dataset_name == 'flyingthings3D':
+        train_size, test_size = 192, 48  # 960, 240
+    elif dataset_name == 'KITTI_2015':
+        train_size, test_size = 160, 40
+    else:
+        train_size, test_size = 960, 240
+    train_loader = test_loader = None
+
+    if use_teacher_cache:
+        # cached costs are keyed by the cost volume model version and the crop
+        teacher_root = os.path.join('./teacher', f'{used_cv_profile}-{cv_version}',
+                                    f'{dataset_name}-{height}x{width}-{seed}-uint8')
+        train_dataset = build_teacher_cost(os.path.join(teacher_root, f'train-{train_size * teacher_cache_epochs}'),
+                                           cv_model, train_dataset, train_size * teacher_cache_epochs, seed,
+                                           num_workers=teacher_num_workers)
+        test_dataset = build_teacher_cost(os.path.join(teacher_root, f'test-{test_size * teacher_cache_epochs}'),
+                                          cv_model, test_dataset, test_size * teacher_cache_epochs, seed,
+                                          num_workers=teacher_num_workers)
+
     v = version
     while v < max_version + 1:
         try:
             epoch_start_time = datetime.datetime.now()
             print('Exception count:', exception_count)
-            if dataset_name == 'flyingthings3D':
-                # 960, 240
-                train_loader = DataLoader(random_subset(train_dataset, 192), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 48), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            elif dataset_name == 'KITTI_2015':
-                train_loader = DataLoader(random_subset(train_dataset, 160), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 40), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            elif dataset_name in ['KITTI_2015_Augmentation', 'KITTI_2012_Augmentation']:
-                train_loader = DataLoader(random_subset(train_dataset, 960), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 240), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            else:
-                raise Exception('Cannot find dataset: ' + dataset_name)
-
-            train_loss = []
-            test_loss = []
-            error = []
-            total_eval = []
+            if train_loader is None:
+                train_loader = DataLoader(train_dataset, batch_size=batch,
+                                          sampler=RandomSubsetSampler(train_dataset, train_size), **dataloader_kwargs)
+                test_loader = DataLoader(test_dataset, batch_size=batch,
+                                         sampler=RandomSubsetSampler(test_dataset, test_size), **dataloader_kwargs)
+
+            train_metrics = utils.MetricAccumulator(sync_interval)
+            test_metrics = utils.MetricAccumulator(sync_interval)
 
             print('Start training')
             cv_model.eval()
             disp_model.train()
+            utils.tic()
             for batch_index, (X, Y, pass_info) in enumerate(train_loader):
                 if torch.all(Y == 0):
                     print('Detect Y are all zero')
                     continue
-                X, Y = X.cuda(), Y.cuda()
+                X, Y = utils.to_device(X, Y)
 
-                utils.tic()
-                with torch.no_grad():
-                    cv_model.flip = False
-                    cost_left = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
-                    cv_model.flip = True
-                    cost_right = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
+                if use_teacher_cache:
+                    cost_left, cost_right = X[:, 0:1].float(), X[:, 1:2].float()
+                else:
+                    with torch.no_grad():
+                        cost_left, cost_right = teacher_cost(cv_model, X)
 
                 optimizer.zero_grad()
                 train_dict = used_disp_profile.train(cost_left, cost_right, Y, dataset_name)
@@ -156,69 +237,80 @@ def main():
                 epe_loss = train_dict['epe_loss']
                 optimizer.step()
 
-                train_loss.append(float(epe_loss))
+                train_metrics.add(loss=loss, epe_loss=epe_loss)
 
-                time = utils.timespan_str(utils.toc(True))
-                loss_str = f'loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}'
-                epe_loss_str = f'epe_loss = {utils.threshold_color(epe_loss)}{epe_loss:.3f}{Style.RESET_ALL}'
-                print(f'[{batch_index + 1}/{len(train_loader)} {time}] {loss_str}, {epe_loss_str}')
+                if train_metrics.ready(last=batch_index + 1 == len(train_loader)):
+                    metrics = train_metrics.synchronize()
+                    time = utils.timespan_str(utils.toc(True))
+                    loss, epe_loss = metrics['loss'], metrics['epe_loss']
+                    loss_str = f'loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}'
+                    epe_loss_str = f'epe_loss = {utils.threshold_color(epe_loss)}{epe_loss:.3f}{Style.RESET_ALL}'
+                    print(f'[{batch_index + 1}/{len(train_loader)} {time}] {loss_str}, {epe_loss_str}')
+                    utils.tic()
+
+                    if np.isnan(loss):
+                        raise Exception('detect loss nan in training')
 
-                if is_plot_image:
+                if is_plot_image and not use_teacher_cache:
                     plotter = utils.CostPlotter()
                     plotter.plot_image_disparity(X[0], Y[0, 0], dataset_name, train_dict,
                                                  max_disparity=max_disparity, use_resize=False,
                                                  use_padding_crop_size=False, pass_info=pass_info)
 
-                if torch.isnan(loss):
-                    raise Exception('detect loss nan in training')
-
-            train_loss = float(torch.tensor(train_loss).mean())
+            train_loss = train_metrics.mean('epe_loss')
+            if np.isnan(train_loss):
+                raise Exception('detect loss nan in training')
             print(f'Avg train loss = {utils.threshold_color(train_loss)}{train_loss:.3f}{Style.RESET_ALL}')
+            train_time = (datetime.datetime.now() - epoch_start_time).total_seconds()
 
             print('Start testing, version = {}'.format(v))
+            test_start_time = datetime.datetime.now()
             disp_model.eval()
+            utils.tic()
             for batch_index, (X, Y, pass_info) in enumerate(test_loader):
                 if torch.all(Y == 0):
                     print('Detect Y are all zero')
                     continue
-                X, Y = X.cuda(), Y.cuda()
+                X, Y = utils.to_device(X, Y)
 
-                utils.tic()
                 with torch.no_grad():
-                    cv_model.flip = False
-                    cost_left = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
-                    cv_model.flip = True
-                    cost_right = cv_model(X[:, 0:3, :, :], X[:, 3:6, :, :]).unsqueeze(1)
+                    if use_teacher_cache:
+                        cost_left, cost_right = X[:, 0:1].float(), X[:, 1:2].float()
+                    else:
+                        cost_left, cost_right = teacher_cost(cv_model, X)
                     eval_dict = used_disp_profile.eval(cost_left, cost_right, Y, pass_info, dataset_name)
-                    time = utils.timespan_str(utils.toc(True))
-                    loss_str = f'epe loss = {utils.threshold_color(eval_dict["epe_loss"])}{eval_dict["epe_loss"]:.3f}{Style.RESET_ALL}'
-                    error_rate_str = f'error rate = {eval_dict["error_sum"] / eval_dict["total_eval"]:.2%}'
-                    print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, {error_rate_str}')
+                    test_metrics.add(epe_loss=eval_dict['epe_loss'], error_sum=eval_dict['error_sum'],
+                                     total_eval=eval_dict['total_eval'])
 
-                    test_loss.append(float(eval_dict["epe_loss"]))
-                    error.append(float(eval_dict["error_sum"]))
-                    total_eval.append(float(eval_dict["total_eval"]))
+                    if test_metrics.ready(last=batch_index + 1 == len(test_loader)):
+                        metrics = test_metrics.synchronize()
+                        time = utils.timespan_str(utils.toc(True))
+                        loss_str = f'epe loss = {utils.threshold_color(metrics["epe_loss"])}{metrics["epe_loss"]:.3f}{Style.RESET_ALL}'
+                        error_rate_str = f'error rate = {metrics["error_sum"] / metrics["total_eval"]:.2%}'
+                        print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, {error_rate_str}')
+                        utils.tic()
 
-                    if is_plot_image:
+                        if np.isnan(metrics['epe_loss']):
+                            raise Exception('detect loss nan in testing')
+
+                    if is_plot_image and not use_teacher_cache:
                         plotter = utils.CostPlotter()
                         plotter.plot_image_disparity(X[0], Y[0, 0], dataset_name, eval_dict,
                                                      max_disparity=max_disparity, use_resize=False,
                                                      use_padding_crop_size=False, pass_info=pass_info)
 
-                    if torch.isnan(eval_dict["epe_loss"]):
-                        raise Exception('detect loss nan in testing')
-
-            test_loss = float(torch.tensor(test_loss).mean())
-            test_error_rate = np.array(error).sum() / np.array(total_eval).sum()
+            test_loss = test_metrics.mean('epe_loss')
+            test_error_rate = test_metrics.rate()
             loss_str = f'epe loss = {utils.threshold_color(test_loss)}{test_loss:.3f}{Style.RESET_ALL}'
             error_rate_str = f'error rate = {test_error_rate:.2%}'
             print(f'Avg {loss_str}, {error_rate_str}')
-
-            loss_history['train'].append(train_loss)
-            loss_history['test'].append(test_loss)
+            test_time = (datetime.datetime.now() - test_start_time).total_seconds()
 
             print('Start save model')
-            used_disp_profile.save_version(disp_model, loss_history, v)
+            used_disp_profile.save_version(disp_model, v, train_epe=train_loss, test_epe=test_loss,
+                                           test_error_rate=test_error_rate, train_time=train_time, test_time=test_time,
+                                           train_throughput=train_metrics.count * batch / train_time,
+                                           test_throughput=test_metrics.count * batch / test_time)
             epoch_end_time = datetime.datetime.now()
             print(f'[{utils.timespan_str(epoch_end_time - epoch_start_time)}] version = {v}')
             v += 1
@@ -227,11 +319,15 @@ def main():
             # traceback.format_exc()  # Traceback string
             traceback.print_exc()
             exception_count += 1
+            train_loader = test_loader = None  # respawn the workers in case one of them died
             # if exception_count >= 50:
             #     exit(-1)
             if is_debug:
                 exit(-1)
 
+    if used_disp_profile.checkpoint_writer is not None:
+        used_disp_profile.checkpoint_writer.close()
+
 
 if __name__ == '__main__':
     main()
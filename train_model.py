@@ -3,6 +3,7 @@ import torch.optim as optim
 from dataset.dataset import *
 from colorama import Style
 import profile
+from GDNet.function import set_checkpoint, set_storage
 import numpy as np
 import os
 import utils
@@ -20,8 +21,15 @@ def main():
     untexture_rate = 0
     dataset_name = ['flyingthings3D', 'KITTI_2015', 'KITTI_2015_Augmentation', 'KITTI_2012_Augmentation'][2]
     exception_count = 0
-    used_profile = profile.GDNet_sdc6f()
-    dataloader_kwargs = {'num_workers': 8, 'pin_memory': True, 'drop_last': True}
+    used_profile = profile.get_profile('GDNet_sdc6f')
+    dataloader_kwargs = {'num_workers': 8, 'pin_memory': True, 'drop_last': True, 'persistent_workers': True}
+    image_cache_bytes = 0  # shared LRU cache of decoded KITTI frames, e.g. 8 * 2 ** 30
+    use_checkpoint = False  # recompute the cost aggregation blocks in backward, for larger crops or batches
+    aggregation_storage = None  # saved aggregation of the GD/SGA layers: None (layer default), 'half', 'recompute', ...
+    use_amp = False  # float16 autocast with loss scaling on CUDA, bfloat16 on CPU, the GD/SGA/LGA kernels still run in float
+    sync_interval = 10  # batches between reads of the metrics on the host (one printed line each)
+    background_save = True  # the next version starts while the .nn file is written
+    keep_every_version = None  # e.g. 10 keeps every 10th .nn file of this run plus the best and the latest
 
     # GTX 1660 Ti
     if isinstance(used_profile, profile.GDNet_sdc6f):
@@ -53,7 +61,12 @@ def main():
         max_disparity = 160
 
     model = used_profile.load_model(max_disparity, version)[1]
+    set_checkpoint(model, use_checkpoint)
+    if aggregation_storage is not None:
+        set_storage(model, aggregation_storage)
     version, loss_history = used_profile.load_history(version)
+    if background_save:
+        used_profile.checkpoint_writer = utils.CheckpointWriter(keep_every=keep_every_version)
     torch.backends.cudnn.benchmark = True
 
     print(f'CUDA abailable cores: {torch.cuda.device_count()}')
@@ -62,42 +75,57 @@ def main():
     print('Using dataset:', dataset_name)
     print('Image size:', (height, width))
     print('Max disparity:', max_disparity)
+    print('Using checkpoint:', use_checkpoint)
+    print('Aggregation storage:', aggregation_storage)
+    print('Using mixed precision:', use_amp)
+    print(f'Background save: {background_save}, keep every version: {keep_every_version}')
     print('Number of parameters: {:,}'.format(sum(p.numel() for p in model.parameters())))
 
     optimizer = optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.999))
+    device = next(model.parameters()).device
+    scaler = torch.amp.GradScaler(device.type, enabled=use_amp and device.type == 'cuda')
 
     if dataset_name == 'flyingthings3D':
         train_dataset = FlyingThings3D(max_disparity, type='train', use_crop_size=True, crop_size=(height, width),
-                                       crop_seed=None, image='finalpass')
+                                       crop_seed=None, image='finalpass', use_uint8=True)
         test_dataset = FlyingThings3D(max_disparity, type='test', use_crop_size=True, crop_size=(height, width),
-                                      crop_seed=None, image='finalpass')
+                                      crop_seed=None, image='finalpass', use_uint8=True)
 
     elif dataset_name == 'KITTI_2015':
         train_dataset, test_dataset = random_split(
             KITTI_2015(use_crop_size=True, crop_size=(height, width), type='train', crop_seed=None,
-                       untexture_rate=untexture_rate), seed=seed)
+                       untexture_rate=untexture_rate, cache_bytes=image_cache_bytes, use_uint8=True), seed=seed)
 
     elif dataset_name == 'KITTI_2015_Augmentation':
         train_dataset = KITTI_2015_Augmentation(use_crop_size=True, crop_size=(height, width), type='train',
                                                 crop_seed=None,
-                                                shuffle_seed=0)
+                                                shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
         test_dataset = KITTI_2015_Augmentation(use_crop_size=True, crop_size=(height, width), type='test',
                                                crop_seed=None,
-                                               shuffle_seed=0)
+                                               shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
 
     elif dataset_name == 'KITTI_2012_Augmentation':
         train_dataset = KITTI_2012_Augmentation(use_crop_size=True, crop_size=(height, width), type='train',
                                                 crop_seed=None,
-                                                shuffle_seed=0)
+                                                shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
         test_dataset = KITTI_2012_Augmentation(use_crop_size=True, crop_size=(height, width), type='test',
                                                crop_seed=None,
-                                               shuffle_seed=0)
+                                               shuffle_seed=0, cache_bytes=image_cache_bytes, use_uint8=True)
 
     else:
         raise Exception('Cannot find dataset: ' + dataset_name)
 
     print('Number of training data:', len(train_dataset))
     print('Number of testing data:', len(test_dataset))
+
+    # the loaders are kept for every version, RandomSubsetSampler draws a new random subset each epoch
+    if dataset_name == 'flyingthings3D':
+        train_size, test_size = 192, 48
+    elif dataset_name == 'KITTI_2015':
+        train_size, test_size = 160, 40
+    else:
+        train_size, test_size = 192, 48
+    train_loader = test_loader = None
     # os.system('nvidia-smi')
 
     # 5235 MB
@@ -106,51 +134,38 @@ def main():
         try:
             epoch_start_time = datetime.datetime.now()
             print('Exception count:', exception_count)
-            if dataset_name == 'flyingthings3D':
-                train_loader = DataLoader(random_subset(train_dataset, 192), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 48), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            elif dataset_name == 'KITTI_2015':
-                train_loader = DataLoader(random_subset(train_dataset, 160), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 40), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            elif dataset_name in ['KITTI_2015_Augmentation', 'KITTI_2012_Augmentation']:
-                train_loader = DataLoader(random_subset(train_dataset, 192), batch_size=batch, shuffle=False,
-                                          **dataloader_kwargs)
-                test_loader = DataLoader(random_subset(test_dataset, 48), batch_size=batch, shuffle=False,
-                                         **dataloader_kwargs)
-
-            else:
-                raise Exception('Cannot find dataset: ' + dataset_name)
-
-            train_loss = []
-            test_loss = []
-            error = []
-            total_eval = []
+            if train_loader is None:
+                train_loader = DataLoader(train_dataset, batch_size=batch,
+                                          sampler=RandomSubsetSampler(train_dataset, train_size), **dataloader_kwargs)
+                test_loader = DataLoader(test_dataset, batch_size=batch,
+                                         sampler=RandomSubsetSampler(test_dataset, test_size), **dataloader_kwargs)
+
+            train_metrics = utils.MetricAccumulator(sync_interval)
+            test_metrics = utils.MetricAccumulator(sync_interval)
 
             print('Start training, version = {}'.format(v))
             model.train()
+            utils.tic()
             for batch_index, (X, Y, pass_info) in enumerate(train_loader):
                 if torch.all(Y == 0):
                     print('Detect Y are all zero')
                     continue
-                X, Y = X.cuda(), Y.cuda()
+                X, Y = utils.to_device(X, Y, device)
 
-                utils.tic()
                 if isinstance(used_profile, profile.GDNet_flip_training):
                     optimizer.zero_grad()
-                    train_dict0 = used_profile.train(X, Y, dataset_name, flip=False)
-                    train_dict0['loss'].backward()
-                    optimizer.step()
+                    with utils.autocast(device.type, use_amp):
+                        train_dict0 = used_profile.train(X, Y, dataset_name, flip=False)
+                    scaler.scale(train_dict0['loss']).backward()
+                    scaler.step(optimizer)
+                    scaler.update()
 
                     optimizer.zero_grad()
-                    train_dict1 = used_profile.train(X, Y, dataset_name, flip=True)
-                    train_dict1['loss'].backward()
-                    optimizer.step()
+                    with utils.autocast(device.type, use_amp):
+                        train_dict1 = used_profile.train(X, Y, dataset_name, flip=True)
+                    scaler.scale(train_dict1['loss']).backward()
+                    scaler.step(optimizer)
+                    scaler.update()
 
                     wl = width / (2 * width - max_disparity)
                     wr = (width - max_disparity) / (2 * width - max_disparity)
@@ -160,18 +175,27 @@ def main():
                     train_dict = train_dict0
                 else:
                     optimizer.zero_grad()
-                    train_dict = used_profile.train(X, Y, dataset_name)
-                    train_dict['loss'].backward()
+                    with utils.autocast(device.type, use_amp):
+                        train_dict = used_profile.train(X, Y, dataset_name)
+                    scaler.scale(train_dict['loss']).backward()
                     loss = train_dict['loss']
                     epe_loss = train_dict['epe_loss']
-                    optimizer.step()
+                    scaler.step(optimizer)
+                    scaler.update()
+
+                train_metrics.add(loss=loss, epe_loss=epe_loss)
 
-                train_loss.append(float(epe_loss))
+                if train_metrics.ready(last=batch_index + 1 == len(train_loader)):
+                    metrics = train_metrics.synchronize()
+                    time = utils.timespan_str(utils.toc(True))
+                    loss, epe_loss = metrics['loss'], metrics['epe_loss']
+                    loss_str = f'loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}'
+                    epe_loss_str = f'epe_loss = {utils.threshold_color(epe_loss)}{epe_loss:.3f}{Style.RESET_ALL}'
+                    print(f'[{batch_index + 1}/{len(train_loader)} {time}] {loss_str}, {epe_loss_str}')
+                    utils.tic()
 
-                time = utils.timespan_str(utils.toc(True))
-                loss_str = f'loss = {utils.threshold_color(loss)}{loss:.3f}{Style.RESET_ALL}'
-                epe_loss_str = f'epe_loss = {utils.threshold_color(epe_loss)}{epe_loss:.3f}{Style.RESET_ALL}'
-                print(f'[{batch_index + 1}/{len(train_loader)} {time}] {loss_str}, {epe_loss_str}')
+                    if np.isnan(loss):
+                        raise Exception('detect loss nan in training')
 
                 if is_plot_image:
                     plotter = utils.CostPlotter()
@@ -180,31 +204,37 @@ def main():
                                                  max_disparity=max_disparity, use_resize=False,
                                                  use_padding_crop_size=False, pass_info=pass_info)
 
-                if torch.isnan(loss):
-                    raise Exception('detect loss nan in training')
-
-            train_loss = float(torch.tensor(train_loss).mean())
+            train_loss = train_metrics.mean('epe_loss')
+            if np.isnan(train_loss):
+                raise Exception('detect loss nan in training')
             print(f'Avg train loss = {utils.threshold_color(train_loss)}{train_loss:.3f}{Style.RESET_ALL}')
+            train_time = (datetime.datetime.now() - epoch_start_time).total_seconds()
 
             print('Start testing, version = {}'.format(v))
+            test_start_time = datetime.datetime.now()
             model.eval()
+            utils.tic()
             for batch_index, (X, Y, pass_info) in enumerate(test_loader):
                 if torch.all(Y == 0):
                     print('Detect Y are all zero')
                     continue
-                X, Y = X.cuda(), Y.cuda()
+                X, Y = utils.to_device(X, Y, device)
 
-                utils.tic()
-                with torch.no_grad():
+                with torch.no_grad(), utils.autocast(device.type, use_amp):
                     eval_dict = used_profile.eval(X, Y, pass_info, dataset_name)
-                    time = utils.timespan_str(utils.toc(True))
-                    loss_str = f'epe loss = {utils.threshold_color(eval_dict["epe_loss"])}{eval_dict["epe_loss"]:.3f}{Style.RESET_ALL}'
-                    error_rate_str = f'error rate = {eval_dict["error_sum"] / eval_dict["total_eval"]:.2%}'
-                    print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, {error_rate_str}')
+                    test_metrics.add(epe_loss=eval_dict['epe_loss'], error_sum=eval_dict['error_sum'],
+                                     total_eval=eval_dict['total_eval'])
+
+                    if test_metrics.ready(last=batch_index + 1 == len(test_loader)):
+                        metrics = test_metrics.synchronize()
+                        time = utils.timespan_str(utils.toc(True))
+                        loss_str = f'epe loss = {utils.threshold_color(metrics["epe_loss"])}{metrics["epe_loss"]:.3f}{Style.RESET_ALL}'
+                        error_rate_str = f'error rate = {metrics["error_sum"] / metrics["total_eval"]:.2%}'
+                        print(f'[{batch_index + 1}/{len(test_loader)} {time}] {loss_str}, {error_rate_str}')
+                        utils.tic()
 
-                    test_loss.append(float(eval_dict["epe_loss"]))
-                    error.append(float(eval_dict["error_sum"]))
-                    total_eval.append(float(eval_dict["total_eval"]))
+                        if np.isnan(metrics['epe_loss']):
+                            raise Exception('detect loss nan in testing')
 
                     if is_plot_image:
                         plotter = utils.CostPlotter()
@@ -212,20 +242,18 @@ def main():
                                                      max_disparity=max_disparity, use_resize=False,
                                                      use_padding_crop_size=False, pass_info=pass_info)
 
-                    if torch.isnan(eval_dict["epe_loss"]):
-                        raise Exception('detect loss nan in testing')
-
-            test_loss = float(torch.tensor(test_loss).mean())
-            test_error_rate = np.array(error).sum() / np.array(total_eval).sum()
+            test_loss = test_metrics.mean('epe_loss')
+            test_error_rate = test_metrics.rate()
             loss_str = f'epe loss = {utils.threshold_color(test_loss)}{test_loss:.3f}{Style.RESET_ALL}'
             error_rate_str = f'error rate = {test_error_rate:.2%}'
             print(f'Avg {loss_str}, {error_rate_str}')
-
-            loss_history['train'].append(train_loss)
-            loss_history['test'].append(test_loss)
+            test_time = (datetime.datetime.now() - test_start_time).total_seconds()
 
             print('Start save model')
-            used_profile.save_version(model, loss_history, v)
+            used_profile.save_version(model, v, train_epe=train_loss, test_epe=test_loss,
+                                      test_error_rate=test_error_rate, train_time=train_time, test_time=test_time,
+                                      train_throughput=train_metrics.count * batch / train_time,
+                                      test_throughput=test_metrics.count * batch / test_time)
             epoch_end_time = datetime.datetime.now()
             print(f'[{utils.timespan_str(epoch_end_time - epoch_start_time)}] version = {v}')
             v += 1
@@ -234,12 +262,16 @@ def main():
             # traceback.format_exc()  # Traceback string
             traceback.print_exc()
             exception_count += 1
+            train_loader = test_loader = None  # respawn the workers in case one of them died
             v -= 1
             # if exception_count >= 50:
             #     exit(-1)
             if is_debug:
                 exit(-1)
 
+    if used_profile.checkpoint_writer is not None:
+        used_profile.checkpoint_writer.close()
+
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,13 @@
 import torch
 import torch.nn.functional as F
-import gdnet_lib
 import utils
+from GDNet import cpu_lib
+
+try:
+    import gdnet_lib
+except ImportError:
+    # CPU only installation, calc_cost and sgm run GDNet/cpu_lib.py on CPU tensors
+    gdnet_lib = None
 
 def calc_cost(left_image, right_image, disparity, kenel_size, method):
     batch, channel, height, width = left_image.size()
@@ -14,7 +20,10 @@ def calc_cost(left_image, right_image, disparity, kenel_size, method):
     with torch.cuda.device_of(left_image):
         disparity_range = max_disparity - min_disparity
         cost = torch.zeros((batch, disparity_range, height, width), dtype=torch.float).to(left_image.device).contiguous()
-        gdnet_lib.cuda_calc_cost(left_image, right_image, cost, kenel_size, min_disparity, method)
+        if left_image.is_cuda:
+            gdnet_lib.cuda_calc_cost(left_image, right_image, cost, kenel_size, min_disparity, method)
+        else:
+            cpu_lib.cpu_calc_cost(left_image, right_image, cost, kenel_size, min_disparity, method)
         # return cost[:, :, :, (max_disparity - 1): (width + min_disparity)].contiguous()
         return cost
 
@@ -23,9 +32,14 @@ def sgm(cost, p1, p2):
     assert cost.is_contiguous()
 
     with torch.cuda.device_of(cost):
-        cost_agg = cost.new().resize_((batch, 8, max_disparity, height, width)).zero_()
-        gdnet_lib.cuda_sgm(cost, cost_agg, p1, p2)
-        disparity = cost_agg.sum(dim=1).argmin(dim=1)
+        if cost.is_cuda:
+            cost_agg = cost.new().resize_((batch, 8, max_disparity, height, width)).zero_()
+            gdnet_lib.cuda_sgm(cost, cost_agg, p1, p2)
+            cost_agg = cost_agg.sum(dim=1)
+        else:
+            # summed one direction at a time, the 8 directions do not fit in memory at full resolution
+            cost_agg = sum(cpu_lib.cpu_sgm_direction(cost, direction, p1, p2) for direction in range(8))
+        disparity = cost_agg.argmin(dim=1)
         return disparity.float()
 
 class SGM:
@@ -72,7 +86,10 @@ class SGM:
             disp_left = sgm(cost, self.P1, self.P2)
             disp_left[:, :, :(self.max_disparity - 1)] = -1
 
-            gdnet_lib.cuda_left_right_consistency_check(disp_left, disp_right, self.max_disparity_diff)
+            if disp_left.is_cuda:
+                gdnet_lib.cuda_left_right_consistency_check(disp_left, disp_right, self.max_disparity_diff)
+            else:
+                cpu_lib.cpu_left_right_consistency_check(disp_left, disp_right, self.max_disparity_diff)
         else:
             cost = calc_cost(left_image, right_image, (0, self.max_disparity), self.kernel_size, self.cost_method)
             disp_left = sgm(cost, self.P1, self.P2)
@@ -91,68 +108,77 @@ class CostVolumeData:
         self.line_width = 5
         self.color = None
 
-def diff_location(input, target):
+def diff_location(input, target, k=None):
     assert input.dim() == 2
     assert target.dim() == 2
-
-    valid_indices = (input != -1) & (target != 0)
-    epe = (input - target).abs()
-
-    epe = epe.data.cpu().numpy()
-    valid_indices = valid_indices.data.cpu().numpy()
-
-    epe_list = []
-    for r in range(input.shape[0]):
-        for c in range(input.shape[1]):
-            if valid_indices[r, c]:
-                epe_list.append((r, c, epe[r, c]))
-    epe_list.sort(key=lambda x: x[2], reverse=True)
-    return epe_list
-
-def sgm_better_location(model_disp, sgm_disp, target, pixel_range=10):
+    return diff_locations(input.unsqueeze(0), target.unsqueeze(0), k)[0]
+
+def diff_locations(inputs, targets, k=None):
+    # (r, c, epe) of every valid pixel of every map, largest epe first, only the first k if k is given
+    assert inputs.dim() == 3
+    assert targets.dim() == 3
+
+    valid_indices = (inputs != -1) & (targets != 0)
+    epe = (inputs - targets).abs().masked_fill(~valid_indices, -float('inf')).flatten(1)
+    width = inputs.size(2)
+
+    if k is None:
+        epe, index = epe.sort(dim=1, descending=True, stable=True)
+        count = valid_indices.flatten(1).sum(dim=1).tolist()
+    else:
+        epe, index = epe.topk(min(k, epe.size(1)), dim=1)
+        count = valid_indices.flatten(1).sum(dim=1).clamp(max=epe.size(1)).tolist()
+
+    epe_lists = []
+    for n, (r, c, e) in enumerate(zip((index // width).tolist(), (index % width).tolist(), epe.tolist())):
+        epe_lists.append(list(zip(r[:count[n]], c[:count[n]], e[:count[n]])))
+    return epe_lists
+
+def sgm_better_location(model_disp, sgm_disp, target, pixel_range=10, k=5):
     assert model_disp.dim() == 2
     assert sgm_disp.dim() == 2
     assert target.dim() == 2
+    sgm_better, model_better = sgm_better_locations(model_disp.unsqueeze(0), sgm_disp.unsqueeze(0),
+                                                    target.unsqueeze(0), pixel_range, k)
+    return sgm_better[0], model_better[0]
 
-    valid_indices = (model_disp != 0) & (model_disp != -1) & (sgm_disp != -1) & (target != 0)
-    epe_model = (model_disp - target).abs()
-    epe_sgm = (sgm_disp - target).abs()
-
-    epe_model = epe_model.data.cpu().numpy()
-    epe_sgm = epe_sgm.data.cpu().numpy()
-    valid_indices = valid_indices.data.cpu().numpy()
-
-    epe_diff = epe_model - epe_sgm
-
-    epe_list = []
-    for r in range(target.shape[0]):
-        for c in range(target.shape[1]):
-            if valid_indices[r, c]:
-                epe_list.append((r, c, epe_diff[r, c]))
-    epe_list.sort(key=lambda x: x[2], reverse=True)
-
-    sgm_better = []
-    for p in epe_list:
-        if not is_in_range(sgm_better, p, pixel_range):
-            sgm_better.append(p)
-        if len(sgm_better) >= 5:
-            break
-
-    model_better = []
-    for p in epe_list[::-1]:
-        if not is_in_range(model_better, p, pixel_range):
-            model_better.append(p)
-        if len(model_better) >= 5:
-            break
+def sgm_better_locations(model_disps, sgm_disps, targets, pixel_range=10, k=5):
+    assert model_disps.dim() == 3
+    assert sgm_disps.dim() == 3
+    assert targets.dim() == 3
 
-    return sgm_better, model_better
+    valid_indices = (model_disps != 0) & (model_disps != -1) & (sgm_disps != -1) & (targets != 0)
+    epe_diff = (model_disps - targets).abs() - (sgm_disps - targets).abs()
 
-def is_in_range(p_list, x, pixel_range):
-    for p in p_list:
-        if abs(p[0] - x[0]) <= pixel_range:
-            return True
-        if abs(p[1] - x[1]) <= pixel_range:
-            return True
-    return False
+    sgm_better = suppress_location(epe_diff, valid_indices, pixel_range, k)
+    # smallest difference first, ties in reversed scan order
+    model_better = suppress_location(-epe_diff.flip(1, 2), valid_indices.flip(1, 2), pixel_range, k)
+    height, width = targets.shape[1:]
+    model_better = [[(height - 1 - r, width - 1 - c, -e) for r, c, e in p] for p in model_better]
 
+    return sgm_better, model_better
 
+def suppress_location(score, valid_indices, pixel_range, k):
+    # greedy maximum selection, the rows and the columns within pixel_range of a selected pixel are
+    # removed from the grid before the next selection
+    batch, height, width = score.size()
+    score = score.masked_fill(~valid_indices, -float('inf')).flatten(1)
+    rows = torch.arange(height, device=score.device).view(1, height, 1)
+    cols = torch.arange(width, device=score.device).view(1, 1, width)
+
+    locations = []
+    for _ in range(k):
+        index = score.argmax(dim=1)
+        value = score.gather(1, index.unsqueeze(1)).squeeze(1)
+        r, c = index // width, index % width
+        locations.append((r, c, value))
+
+        suppressed = ((rows - r.view(-1, 1, 1)).abs() <= pixel_range) | ((cols - c.view(-1, 1, 1)).abs() <= pixel_range)
+        score = score.masked_fill(suppressed.flatten(1), -float('inf'))
+
+    p_lists = [[] for _ in range(batch)]
+    for r, c, value in locations:
+        for n, (r_n, c_n, value_n) in enumerate(zip(r.tolist(), c.tolist(), value.tolist())):
+            if value_n != -float('inf'):
+                p_lists[n].append((r_n, c_n, value_n))
+    return p_lists
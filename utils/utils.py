@@ -10,6 +10,9 @@ import sys
 import pickle
 import datetime
 import math
+import threading
+import queue
+import atexit
 
 
 def print_progress(message, rate):
@@ -32,6 +35,138 @@ def load(filename):
         return pickle.load(file)
 
 
+class HistoryLog:
+    # one fixed size record per saved version, appended to a single file and read back with np.memmap,
+    # fields that a version did not record (e.g. imported from a .ht file) are nan
+    dtype = np.dtype([
+        ('version', '<i8'),
+        ('train_epe', '<f8'),
+        ('test_epe', '<f8'),
+        ('test_error_rate', '<f8'),
+        ('train_time', '<f8'),  # seconds
+        ('test_time', '<f8'),
+        ('train_throughput', '<f8'),  # images per second
+        ('test_throughput', '<f8'),
+    ])
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, version, **fields):
+        unknown = set(fields) - set(self.dtype.names)
+        if unknown:
+            raise Exception('Unknown history fields: ' + ', '.join(sorted(unknown)))
+        record = np.zeros(1, dtype=self.dtype)
+        for name in self.dtype.names[1:]:
+            record[name] = np.nan
+        record['version'] = version
+        for name, value in fields.items():
+            record[name] = float(value)
+        with open(self.filename, 'ab') as file:
+            file.write(record.tobytes())
+
+    def read(self, latest=True):
+        # latest: the last record of every version (a retried or resumed version appends again), sorted by version
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        count = size // self.dtype.itemsize  # a record cut off by a crash is ignored
+        if count == 0:
+            return np.zeros(0, dtype=self.dtype)
+        records = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=(count,))
+        if not latest:
+            return records
+        versions, index = np.unique(records['version'][::-1], return_index=True)
+        return np.array(records[count - 1 - index])
+
+    def __len__(self):
+        return len(self.read())
+
+    def import_ht(self, ht_file):
+        # a .ht file holds the epe of every version up to its own, {'train': [...], 'test': [...]}
+        loss_history = load(ht_file)
+        known = set(self.read()['version'].tolist())
+        count = 0
+        for i, (train_epe, test_epe) in enumerate(zip(loss_history['train'], loss_history['test'])):
+            if i + 1 not in known:
+                self.append(i + 1, train_epe=train_epe, test_epe=test_epe)
+                count += 1
+        return count
+
+
+class CheckpointWriter:
+    # torch.save on a background thread from a host copy of the state dict, the file is written under a
+    # temporary name and renamed when complete, so a crash never leaves a truncated .nn file.
+    # keep_every: the versions of this writer that are kept on disk are every keep_every-th one, the best test epe
+    # of the history and the latest (resume), None keeps all of them
+    def __init__(self, max_pending=2, keep_every=None):
+        self.queue = queue.Queue(max_pending)
+        self.keep_every = keep_every
+        self.written = []  # (version, filename)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, model, filename, version, history_log, **fields):
+        # blocks while max_pending checkpoints are waiting
+        self.check()
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        self.queue.put((state_dict, filename, version, history_log, fields))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.write(*item)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+
+    def write(self, state_dict, filename, version, history_log, fields):
+        temp_file = filename + '.tmp'
+        torch.save(state_dict, temp_file)
+        os.replace(temp_file, filename)
+        # appended only once the rename succeeded, so no record points at a partial file;
+        # records of versions that keep_every removes later stay in the log
+        history_log.append(version, **fields)
+        self.written.append((version, filename))
+        if self.keep_every is not None:
+            self.remove_old(history_log)
+
+    def remove_old(self, history_log):
+        history = history_log.read()
+        test_epe = history['test_epe']
+        best = int(history['version'][np.nanargmin(test_epe)]) if not np.all(np.isnan(test_epe)) else None
+        latest = self.written[-1][0]
+
+        kept = []
+        for version, filename in self.written:
+            if version in [latest, best] or version % self.keep_every == 0:
+                kept.append((version, filename))
+            elif os.path.exists(filename):
+                os.remove(filename)
+        self.written = kept
+
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception('Cannot write checkpoint') from error
+
+
 TOOLS_CURRENT_TIME = None
 
 
@@ -587,8 +722,8 @@ def save_comparision(X, Y, ganet_disp, sgm_disp, ganet_loss, sgm_loss, root, fil
 
 
 def get_latest_version(file_path):
-    version_codes = [version_code(x) for x in os.listdir(file_path)]
-    if len(version_codes) > 1:
+    version_codes = [version_code(x) for x in os.listdir(file_path) if x.endswith('.nn')]
+    if len(version_codes) > 0:
         version_codes.sort()
         return version_codes[-1]
     else:
@@ -596,29 +731,92 @@ def get_latest_version(file_path):
 
 
 class SGM:
-    def __init__(self, block_size=5, max_disparity=192, mode=cv2.STEREO_SGBM_MODE_SGBM):
+    def __init__(self, block_size=5, max_disparity=192, mode=cv2.STEREO_SGBM_MODE_SGBM, num_workers=0,
+                 context='fork'):
         P1 = int(8 * 3 * block_size * block_size)
         P2 = int(32 * 3 * block_size * block_size)
         self.max_disparity = max_disparity
+        self.params = (max_disparity, block_size, P1, P2, mode)
+        self.num_workers = num_workers
+        self.context = context
+
+        self.sgbm = create_sgbm(*self.params)
+        self.pool = None
+        self.buffers = None
+
+    def process(self, X, max_disparity_diff=1, lr_check=False, device=None):
+        # device: where the disparity is returned, X.device if None
+        device = X.device if device is None else device
+        X = (X * 255).data.cpu().permute(0, 2, 3, 1).to(torch.uint8)
+
+        if self.num_workers == 0:
+            disps = [sgbm_disparity(self.sgbm, X[i].numpy(), lr_check, max_disparity_diff) for i in range(X.size(0))]
+            return torch.from_numpy(np.stack(disps)).to(device)
+
+        if self.pool is None:
+            context = torch.multiprocessing.get_context(self.context)
+            self.pool = context.Pool(self.num_workers, initializer=sgm_worker_init, initargs=self.params)
+
+        # the images and the disparities stay in shared memory, a task only sends the handles and the index
+        if self.buffers is None or self.buffers[0].size() != X.size():
+            self.buffers = (torch.empty(X.size(), dtype=torch.uint8).share_memory_(),
+                            torch.empty(X.size()[:3], dtype=torch.float).share_memory_())
+        X_shared, disp_shared = self.buffers
+        X_shared.copy_(X)
+        self.pool.starmap(sgm_worker_process, [(X_shared, disp_shared, i, lr_check, max_disparity_diff)
+                                                for i in range(X.size(0))])
+        return disp_shared.to(device, copy=True)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.buffers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
-        self.sgbm = cv2.StereoSGBM.create(0, max_disparity, block_size, P1=P1, P2=P2, mode=mode, disp12MaxDiff=1)
+def create_sgbm(max_disparity, block_size, P1, P2, mode):
+    return cv2.StereoSGBM.create(0, max_disparity, block_size, P1=P1, P2=P2, mode=mode, disp12MaxDiff=1)
 
-    def process(self, X, max_disparity_diff=1):
-        X = (X * 255).data.cpu().numpy().astype('uint8')
-        X = X.swapaxes(2, 3).swapaxes(1, 3)
-        disps = []
 
-        for i in range(X.shape[0]):
-            disp_left = self.sgbm.compute(X[i, :, :, 0:3], X[i, :, :, 3:6])
-            # disp_right = self.sgbm.compute(X[i, :, ::-1, 3:6], X[i, :, ::-1, 0:3])
-            # disp_right = disp_right[:, ::-1]
+def sgbm_disparity(sgbm, X, lr_check, max_disparity_diff):
+    # X: (height, width, 6) uint8, invalid pixels are -1
+    left, right = X[:, :, 0:3], X[:, :, 3:6]
+    disp_left = (sgbm.compute(left, right) / 16).astype(np.float32)
 
-            disp_left = torch.tensor(disp_left / 16).unsqueeze(0)
-            # disp_right = torch.tensor(disp_right / 16).unsqueeze(0)
-            disps.append(disp_left)
+    if lr_check:
+        # right reference map from the mirrored pair
+        disp_right = sgbm.compute(np.ascontiguousarray(right[:, ::-1]), np.ascontiguousarray(left[:, ::-1]))
+        disp_right = disp_right[:, ::-1] / 16
 
-        disps = torch.cat(disps, dim=0)
-        return disps.cuda()
+        height, width = disp_left.shape
+        right_col = np.round(np.arange(width) - disp_left).astype(np.int64)
+        inside = (right_col >= 0) & (right_col < width)
+        right_disp = np.take_along_axis(disp_right, right_col.clip(0, width - 1), axis=1)
+        consistent = inside & (right_disp >= 0) & (np.abs(disp_left - right_disp) <= max_disparity_diff)
+        disp_left[~consistent] = -1
+
+    return disp_left
+
+
+sgm_worker_sgbm = None
+
+
+def sgm_worker_init(*params):
+    global sgm_worker_sgbm
+    # one image per process, OpenCV threads would only compete with the other workers
+    cv2.setNumThreads(1)
+    sgm_worker_sgbm = create_sgbm(*params)
+
+
+def sgm_worker_process(X, disp, index, lr_check, max_disparity_diff):
+    disp[index] = torch.from_numpy(sgbm_disparity(sgm_worker_sgbm, X[index].numpy(), lr_check, max_disparity_diff))
 
 
 def EPE_loss(input, target):
@@ -697,18 +895,199 @@ def timespan_str(timespan):
 
 
 def flip_X(X, Y):
-    flip_x = X[:, 0:3, :, :].data.cpu().numpy()
-    flip_y = X[:, 3:6, :, :].data.cpu().numpy()
-    flip_x = torch.tensor(flip_x[..., ::-1].copy())
-    flip_y = torch.tensor(flip_y[..., ::-1].copy())
-
-    X = torch.cat([flip_y, flip_x], dim=1).cuda()
+    # same as GDNet.function.flip_stereo on the stacked pair, left/right disparity are swapped as well
+    X = torch.flip(torch.cat([X[:, 3:6, :, :], X[:, 0:3, :, :]], dim=1), dims=[-1])
+    Y = torch.flip(Y, dims=[1, 3])
+    return X, Y
 
-    flip_d = Y.data.cpu().numpy()
-    flip_d = torch.tensor(flip_d[:, ::-1, :, ::-1].copy())
-    Y = flip_d.cuda()
 
-    return X, Y
+def autocast(device_type, enabled=True):
+    # float16 on CUDA, bfloat16 on CPU where float16 has no fast kernels, bfloat16 needs no loss scaling
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+
+
+def to_device(X, Y, device='cuda'):
+    # datasets with use_uint8=True keep the images as uint8 through the DataLoader workers, pinning and the
+    # host to device copy (4x fewer bytes than float), the batch is normalized here after the transfer
+    X, Y = X.to(device, non_blocking=True), Y.to(device, non_blocking=True)
+    if X.dtype == torch.uint8:
+        X = X.float() / 255
+    return X, Y.float()
+
+
+def quantize_cost(cost):
+    # cost: (disparity, height, width), quantized per pixel along the disparity to uint8,
+    # cost ~ q * scale + offset, offset_scale: (2, height, width) float32
+    cost = cost.float()
+    offset = cost.amin(dim=0)
+    scale = (cost.amax(dim=0) - offset) / 255
+    q = torch.round((cost - offset) / scale.clamp(min=1e-12)).to(torch.uint8)
+    return q, torch.stack([offset, scale])
+
+
+def dequantize_cost(q, offset_scale):
+    return q.float() * offset_scale[1] + offset_scale[0]
+
+
+class MetricAccumulator:
+    # Running sums of per batch metrics (epe_loss, error_sum from error_rate, total_eval, CE_avg, ...) kept as
+    # tensors on their device, so adding a batch does not wait for the GPU. The host only reads them in
+    # synchronize(), every sync_interval batches, and in the epoch results (mean, std, rate).
+    def __init__(self, sync_interval=1):
+        self.sync_interval = sync_interval
+        self.count = 0
+        self.counts = {}
+        self.sums = {}
+        self.square_sums = {}
+        self.window = {}
+        self.window_counts = {}
+        self.window_count = 0
+
+    def add(self, **metrics):
+        for key, value in metrics.items():
+            if value is None:
+                continue
+            value = value.detach().float() if isinstance(value, torch.Tensor) else torch.tensor(float(value))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.sums[key] = self.sums.get(key, 0) + value
+            self.square_sums[key] = self.square_sums.get(key, 0) + value * value
+            self.window_counts[key] = self.window_counts.get(key, 0) + 1
+            self.window[key] = self.window.get(key, 0) + value
+        self.count += 1
+        self.window_count += 1
+
+    def ready(self, last=False):
+        return self.window_count > 0 and (self.window_count >= self.sync_interval or last)
+
+    def synchronize(self):
+        # means of the batches since the last call, one host copy for all metrics
+        keys = list(self.window.keys())
+        values = []
+        if keys:
+            device = self.window[keys[0]].device
+            values = torch.stack([self.window[k].to(device) for k in keys]).tolist()
+        means = {k: v / self.window_counts[k] for k, v in zip(keys, values)}
+        self.window = {}
+        self.window_counts = {}
+        self.window_count = 0
+        return means
+
+    def sum(self, key):
+        return float(self.sums[key])
+
+    def mean(self, key):
+        return self.sum(key) / self.counts[key]
+
+    def std(self, key):
+        mean = self.mean(key)
+        return math.sqrt(max(float(self.square_sums[key]) / self.counts[key] - mean * mean, 0))
+
+    def rate(self, numerator='error_sum', denominator='total_eval'):
+        return self.sum(numerator) / self.sum(denominator)
+
+
+def tile_starts(size, tile_size, step):
+    # start of every tile along one axis, the last tile ends at size
+    starts = list(range(0, max(size - tile_size, 0), step)) + [max(size - tile_size, 0)]
+    return sorted(set(starts))
+
+
+def blend_weight(size, begin, end, overlap, ramp_begin, ramp_end):
+    # 1 on [begin, end), linear ramps over the overlap at interior edges, 0 elsewhere
+    weight = torch.zeros(size)
+    weight[begin:end] = 1
+    ramp = torch.arange(1, overlap + 1, dtype=torch.float) / (overlap + 1)
+    n = min(overlap, end - begin)
+    if ramp_begin:
+        weight[begin:begin + n] = ramp[:n]
+    if ramp_end:
+        weight[end - n:end] = torch.min(weight[end - n:end], ramp[:n].flip(0))
+    return weight
+
+
+def tiled_disparity(produce, X, max_disparity, tile_height, tile_width, overlap=32, batch_size=1,
+                    memory_budget=None):
+    # produce: (N, 6, tile_height, tile_width) -> (N, tile_height, tile_width) disparity
+    # Every tile is widened by max_disparity on the left so the matches of its output columns stay inside,
+    # only columns with full context (all of them in the first tile) are kept. Outputs of neighbouring
+    # tiles overlap by `overlap` pixels and are blended linearly.
+    # memory_budget: bytes of CUDA memory, the first tile is run alone to measure the peak of one tile and
+    # the batch size is set to what fits, batch_size is used otherwise
+    B, _, height, width = X.size()
+    step_x = tile_width - max_disparity - overlap
+    step_y = tile_height - overlap
+    if step_x <= 0 or step_y <= 0:
+        raise Exception(f'Tile {(tile_height, tile_width)} is too small for max disparity {max_disparity} '
+                        f'and overlap {overlap}')
+
+    # smaller images are padded to one tile
+    pad_height, pad_width = max(height, tile_height), max(width, tile_width)
+    if (pad_height, pad_width) != (height, width):
+        X = torch.nn.functional.pad(X, (0, pad_width - width, 0, pad_height - height))
+
+    xs = tile_starts(pad_width, tile_width, step_x)
+    ys = tile_starts(pad_height, tile_height, step_y)
+    tiles = []
+    for b in range(B):
+        for i, y in enumerate(ys):
+            weight_y = blend_weight(pad_height, y, y + tile_height, overlap, i > 0, i < len(ys) - 1)
+            for j, x in enumerate(xs):
+                valid_x = x + max_disparity if j > 0 else 0
+                weight_x = blend_weight(pad_width, valid_x, x + tile_width, overlap, j > 0, j < len(xs) - 1)
+                weight = weight_y[y:y + tile_height, None] * weight_x[None, x:x + tile_width]
+                tiles.append((b, y, x, weight.to(X.device)))
+
+    disparity = torch.zeros((B, pad_height, pad_width), device=X.device)
+    weight_sum = torch.zeros((B, pad_height, pad_width), device=X.device)
+
+    def run(batch):
+        X_tiles = torch.stack([X[b, :, y:y + tile_height, x:x + tile_width] for b, y, x, _ in batch])
+        disp = produce(X_tiles).float()
+        for (b, y, x, weight), d in zip(batch, disp):
+            disparity[b, y:y + tile_height, x:x + tile_width] += d * weight
+            weight_sum[b, y:y + tile_height, x:x + tile_width] += weight
+
+    start = 0
+    if memory_budget is not None and X.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        run(tiles[:1])
+        tile_peak = max(torch.cuda.max_memory_allocated() - base, 1)
+        batch_size = max(1, int((memory_budget - base) // tile_peak))
+        start = 1
+
+    for i in range(start, len(tiles), batch_size):
+        run(tiles[i:i + batch_size])
+
+    disparity /= weight_sum
+    return disparity[:, :height, :width]
+
+
+def split_prduce_disparity(used_profile, X, Y, dataset_name, max_disparity, split_height, split_width, overlap=32,
+                           batch_size=1, memory_budget=None, **eval_kwargs):
+    # full resolution disparity of a *_basic profile from overlapping tiles (see tiled_disparity),
+    # eval_kwargs go to used_profile.eval of every tile batch
+    confidence_error = []
+
+    def produce(X_tiles):
+        Y_tiles = torch.zeros_like(X_tiles[:, :1])
+        eval_dict = used_profile.eval(X_tiles, Y_tiles, {}, dataset_name, **eval_kwargs)
+        if eval_dict.get('CE_avg') is not None:
+            confidence_error.append(float(eval_dict['CE_avg']))
+        return eval_dict['disp']
+
+    disp = tiled_disparity(produce, X, max_disparity, split_height, split_width, overlap, batch_size, memory_budget)
+    Y = Y[:, 0, :, :]
+    mask = y_mask(Y, max_disparity, dataset_name)
+    return {
+        'error_sum': error_rate(disp[mask], Y[mask], dataset_name),
+        'total_eval': mask.float().sum(),
+        'epe_loss': EPE_loss(disp[mask], Y[mask]),
+        'CE_avg': np.mean(confidence_error) if confidence_error else None,
+        'disp': disp,
+    }
 
 
 def trend_regression(loss_trend, method='corr'):